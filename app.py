@@ -4,33 +4,119 @@
 # - Thêm setup_webhook (Render) để bot tự set webhook khi deploy/restart
 # - DB init an toàn + validate BOT_TOKEN/DATABASE_URL
 # - Không đụng bảng leads (vì code này chỉ dùng bảng users) => tránh lỗi cột leads không tồn tại
-
+#   -> lead của flow lưu vào bảng riêng bot_leads (ghi theo lô, chạy nền)
+# - DB: dùng ConnectionPool chung (psycopg_pool) + prepared statement cho query nóng, thay vì connect mới mỗi lần
+# - Nhiều bot trong 1 process (BOTS): mỗi bot /webhook/<id> + schema DB riêng, dùng chung pool / worker
+
+import atexit
+from collections import OrderedDict, deque
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+import cProfile
+import csv
+import gzip
+import io
+from contextlib import contextmanager
+import json
 import os
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+import pstats
+import queue
+import random
+import re
+import sys
+import tempfile
 import threading
 import time
+import uuid
+from zoneinfo import ZoneInfo
 
 import psycopg
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool
 import requests
+from requests.adapters import HTTPAdapter
 import telebot
-from telebot import types
-from flask import Flask, request
+from telebot import apihelper, types
+from telebot.apihelper import ApiTelegramException
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+from flask import Flask, Response, request
 
 # ============ CẤU HÌNH ============
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-if not BOT_TOKEN:
-    raise RuntimeError("Missing BOT_TOKEN")
-
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 
-REG_LINK = "https://u888u.online"
-WEBAPP_LINK = "https://u888u.online"  # hiện chưa dùng
+# Brand của bản build: link đăng ký, CSKH, ảnh mặc định (BRAND_MEDIA). Text/bàn phím dùng chung (TEMPLATE).
+BRANDS = {
+    "u888u": {
+        "name": "U888",
+        "reg_link": "https://u888u.online",
+        "support_name": "Trúc Linh CSKH U888",
+        "support_link": "https://t.me/truclinh_u888",
+    },
+    # bản trong test.html
+    "u88top": {
+        "name": "U888",
+        "reg_link": "https://u88top.live",
+        "support_name": "CSKH U888",
+        "support_link": "https://t.me/HAIANH_U888",
+    },
+}
+BRAND = os.getenv("BRAND", "u888u").lower()
+if BRAND not in BRANDS:
+    raise RuntimeError(f"BRAND không hợp lệ: {BRAND} (có: {', '.join(BRANDS)})")
 
 # Webhook URL (Render env) - khuyến nghị set để bot tự set lại mỗi lần deploy/restart
 # Ví dụ: https://toolbottele-n0cs.onrender.com/webhook
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 
+# Nhiều bot trong 1 process (dùng chung pool DB, HTTP, worker):
+#   BOTS='[{"id": "u888u", "token": "...", "brand": "u888u", "admin_chat_id": 123, "schema": "public"},
+#          {"id": "u88top", "token": "...", "brand": "u88top", "admin_chat_id": 456}]'
+# Mỗi bot: webhook WEBHOOK_URL/<id>, dữ liệu riêng trong schema Postgres "bot_<id>" (hoặc "schema").
+# Bot đang chạy 1 mình muốn gộp vào: đặt "schema": "public" để giữ dữ liệu cũ.
+# Schema đổi bằng SET search_path trên connection -> cần Postgres trực tiếp / pooler session mode (5432).
+# Không có BOTS -> 1 bot từ BOT_TOKEN / BRAND / ADMIN_CHAT_ID, webhook WEBHOOK_URL, schema public (như cũ).
+BOTS = os.getenv("BOTS")
+
+
+def _load_bot_configs():
+    if not BOTS:
+        if not BOT_TOKEN:
+            raise RuntimeError("Missing BOT_TOKEN")
+        return [{"id": BRAND, "token": BOT_TOKEN, "brand": BRAND, "admin_chat_id": ADMIN_CHAT_ID,
+                 "schema": "public", "webhook_url": WEBHOOK_URL}]
+    configs = json.loads(BOTS)
+    if not configs:
+        raise RuntimeError("BOTS rỗng")
+    for cfg in configs:
+        bot_id = str(cfg.get("id", ""))
+        if not re.fullmatch(r"[a-z0-9_]{1,32}", bot_id):
+            raise RuntimeError(f"BOTS: id không hợp lệ: {bot_id!r} (chỉ a-z, 0-9, _)")
+        if not cfg.get("token"):
+            raise RuntimeError(f"BOTS: bot {bot_id} thiếu token")
+        cfg.setdefault("brand", BRAND)
+        if cfg["brand"] not in BRANDS:
+            raise RuntimeError(f"BOTS: bot {bot_id} có brand không hợp lệ: {cfg['brand']}")
+        cfg["admin_chat_id"] = int(cfg.get("admin_chat_id") or 0)
+        cfg.setdefault("schema", f"bot_{bot_id}")
+        if not re.fullmatch(r"[a-z_][a-z0-9_]{0,62}", cfg["schema"]):
+            raise RuntimeError(f"BOTS: bot {bot_id} có schema không hợp lệ: {cfg['schema']}")
+        cfg["webhook_url"] = f"{WEBHOOK_URL.rstrip('/')}/{bot_id}" if WEBHOOK_URL else None
+    for key in ("id", "token", "schema"):
+        values = [cfg[key] for cfg in configs]
+        if len(set(values)) != len(values):
+            raise RuntimeError(f"BOTS: trùng {key}")
+    return configs
+
+
+BOT_CONFIGS = _load_bot_configs()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))   # Telegram mặc định 40
+# Chỉ nhận loại update có handler (edited_message, channel_post, my_chat_member... Telegram không gửi nữa)
+ALLOWED_UPDATES = ["message", "callback_query"]
+
 # Keep-alive
 ENABLE_KEEP_ALIVE = os.getenv("ENABLE_KEEP_ALIVE", "false").lower() == "true"
 PING_URL = os.getenv("PING_URL")  # ví dụ: https://your-app.onrender.com/
@@ -39,18 +125,1017 @@ PING_INTERVAL = int(os.getenv("PING_INTERVAL", "300"))  # 5 phút
 # DB
 DATABASE_URL = os.getenv("DATABASE_URL")  # Supabase pooler URL (đã encode ký tự đặc biệt trong password)
 
+# DB pool: dùng chung cho mọi thread của 1 worker gunicorn
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))          # chờ lấy connection tối đa (giây)
+DB_POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))       # đóng connection rảnh quá lâu
+DB_POOL_CHECK_INTERVAL = int(os.getenv("DB_POOL_CHECK_INTERVAL", "60"))  # health check connection rảnh
+# Prepared statement cho các query nóng. Supabase pooler transaction mode (port 6543)
+# không giữ prepared statement giữa các transaction -> khi đó set DB_PREPARE=false
+DB_PREPARE = os.getenv("DB_PREPARE", "true").lower() == "true"
+if DATABASE_URL and not DB_PREPARE and len({cfg["schema"] for cfg in BOT_CONFIGS}) > 1:
+    raise RuntimeError("BOTS nhiều schema cần connection session mode, không chạy được với DB_PREPARE=false")
+
+# Broadcast (chạy nền, ngoài request webhook)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "28"))          # msg/s toàn cục (Telegram giới hạn ~30/s)
+BROADCAST_PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", "1.0"))  # giây giữa 2 tin cùng 1 chat
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", "3"))
+BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", "1000"))    # số chat_id mỗi trang (keyset theo chat_id)
+# Có DATABASE_URL: job + trạng thái từng người nhận lưu Postgres, mọi worker/instance cùng nhận lô để gửi.
+# BROADCAST_RATE là của 1 process -> chạy N instance thì đặt ~ 28 / N (giới hạn Telegram tính theo bot).
+BROADCAST_CLAIM_SIZE = int(os.getenv("BROADCAST_CLAIM_SIZE", "100"))     # số người nhận mỗi lần nhận lô
+BROADCAST_LEASE = int(os.getenv("BROADCAST_LEASE", "300"))               # lô nhận mà chưa báo kết quả quá lâu -> nhận lại
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+BROADCAST_RETENTION_DAYS = int(os.getenv("BROADCAST_RETENTION_DAYS", "7"))   # xóa trạng thái người nhận của job cũ
+
+# Webhook: nhận update -> xếp hàng -> worker xử lý (không xử lý trong request)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "500"))            # mỗi worker
+UPDATE_ENQUEUE_TIMEOUT = float(os.getenv("UPDATE_ENQUEUE_TIMEOUT", "2"))  # queue đầy chờ tối đa rồi trả 503
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "20"))     # khi tắt: chờ xử lý nốt update
+
+# Chống spam theo chat ngay ở webhook: mỗi chat FLOOD_RATE update/s, dồn tối đa FLOOD_BURST (album ảnh ~10).
+# Cùng 1 lệnh / nút bấm lặp lại trong FLOOD_COLLAPSE_WINDOW giây -> gộp, chỉ xử lý lần đầu. FLOOD_RATE=0: tắt.
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))
+FLOOD_BURST = int(os.getenv("FLOOD_BURST", "10"))
+FLOOD_COLLAPSE_WINDOW = float(os.getenv("FLOOD_COLLAPSE_WINDOW", "1.5"))
+FLOOD_SWEEP_INTERVAL = float(os.getenv("FLOOD_SWEEP_INTERVAL", "60"))
+
+# /metrics (Prometheus). Đặt METRICS_TOKEN thì phải gọi /metrics?token=... hoặc header Authorization: Bearer ...
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# HTTP client dùng chung (Telegram API + keep-alive)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", str(UPDATE_WORKERS + BROADCAST_WORKERS + 4)))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "20"))
+HTTP_CONNECT_RETRIES = int(os.getenv("HTTP_CONNECT_RETRIES", "2"))   # chỉ retry lúc connect (request chưa gửi đi)
+
+# Mọi request Telegram API đi qua hàng đợi ưu tiên (trả lời khách > việc nền của admin > broadcast/digest)
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", str(UPDATE_WORKERS + 4)))
+OUTBOUND_QUEUE_MAX = int(os.getenv("OUTBOUND_QUEUE_MAX", "500"))           # mỗi mức ưu tiên
+OUTBOUND_ENQUEUE_TIMEOUT = float(os.getenv("OUTBOUND_ENQUEUE_TIMEOUT", "5"))
+OUTBOUND_RETRIES = int(os.getenv("OUTBOUND_RETRIES", "2"))                 # lỗi tạm (mạng, 5xx, 429)
+OUTBOUND_BREAKER_THRESHOLD = int(os.getenv("OUTBOUND_BREAKER_THRESHOLD", "8"))   # lỗi mạng/5xx liên tiếp
+OUTBOUND_BREAKER_COOLDOWN = float(os.getenv("OUTBOUND_BREAKER_COOLDOWN", "15"))
+
+# State hội thoại: "memory" (1 worker) hoặc "postgres" (nhiều worker gunicorn dùng chung DATABASE_URL)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").lower()
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "86400"))     # flow username -> bill -> 4 số: giữ 1 ngày
+ADMIN_STATE_TTL = int(os.getenv("ADMIN_STATE_TTL", "3600"))    # nháp broadcast: giữ 1 giờ
+GETID_TTL = int(os.getenv("GETID_TTL", "86400"))
+STATE_SWEEP_INTERVAL = int(os.getenv("STATE_SWEEP_INTERVAL", "300"))
+# cache đọc cục bộ cho backend postgres. Nhiều worker: state có thể cũ tối đa STATE_CACHE_TTL giây (0 = tắt)
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", "1"))
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "2000"))
+
+# Gom thông báo lead cho admin (tên tài khoản / bill) thành 1 tin mỗi LEAD_DIGEST_INTERVAL giây
+# hoặc mỗi LEAD_DIGEST_MAX sự kiện, thay vì mỗi khách 2-3 tin riêng. Mặc định tắt.
+LEAD_DIGEST = os.getenv("LEAD_DIGEST", "false").lower() == "true"
+LEAD_DIGEST_INTERVAL = float(os.getenv("LEAD_DIGEST_INTERVAL", "30"))
+LEAD_DIGEST_MAX = int(os.getenv("LEAD_DIGEST_MAX", "10"))
+
+# Lưu lead (tên tài khoản / bill / 4 số đuôi) vào bảng bot_leads: handler chỉ bỏ vào hàng đợi,
+# thread nền ghi 1 câu INSERT nhiều dòng mỗi LEADS_FLUSH_INTERVAL giây (hoặc khi đủ LEADS_BATCH_MAX)
+LEADS_FLUSH_INTERVAL = float(os.getenv("LEADS_FLUSH_INTERVAL", "2"))
+LEADS_BATCH_MAX = int(os.getenv("LEADS_BATCH_MAX", "200"))
+LEADS_QUEUE_MAX = int(os.getenv("LEADS_QUEUE_MAX", "20000"))   # DB chết lâu: giữ tối đa chừng này sự kiện
+LEADS_PAGE_SIZE = int(os.getenv("LEADS_PAGE_SIZE", "10"))
+RECEIPT_CACHE_SIZE = int(os.getenv("RECEIPT_CACHE_SIZE", "50000"))   # file_unique_id bill gần nhất (check trùng)
+
+# Chống xử lý trùng update (Telegram gửi lại khi timeout): nhớ update_id gần nhất trong RAM,
+# DEDUP_BACKEND=postgres -> thêm bảng processed_updates để chống trùng giữa các worker / sau restart
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "20000"))
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "memory").lower()
+DEDUP_RETENTION_HOURS = int(os.getenv("DEDUP_RETENTION_HOURS", "48"))   # Telegram giữ update tối đa 24h
+
+# Export users: đọc theo lô từ server-side cursor, ghi vào buffer RAM (tràn thì ra file tạm)
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", "5000"))
+EXPORT_SPOOL_MAX = int(os.getenv("EXPORT_SPOOL_MAX", str(8 * 1024 * 1024)))
+
+# Đếm user: cache tối đa USER_COUNT_TTL giây (user mới trong process này được cộng ngay)
+USER_COUNT_TTL = int(os.getenv("USER_COUNT_TTL", "300"))
+
+# last_seen ghi kiểu write-behind: user đã biết chỉ cập nhật trong RAM, thread nền ghi gộp 1 câu nhiều dòng
+# mỗi USER_TOUCH_INTERVAL giây (last_seen trong DB trễ tối đa chừng đó). User mới vẫn INSERT ngay.
+USER_TOUCH_INTERVAL = float(os.getenv("USER_TOUCH_INTERVAL", "30"))
+USER_TOUCH_BATCH = int(os.getenv("USER_TOUCH_BATCH", "1000"))
+USER_KNOWN_CACHE = int(os.getenv("USER_KNOWN_CACHE", "50000"))   # chat_id đã upsert (mỗi bot)
+STATS_TZ = os.getenv("STATS_TZ", "Asia/Ho_Chi_Minh")   # "hôm nay" tính theo giờ VN
+
+# Ảnh của flow: tên logic -> file_id. Ảnh gốc để upload lại khi file_id hỏng: MEDIA_DIR/<tên>.jpg|.png
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")
+MEDIA_CHECK_INTERVAL = int(os.getenv("MEDIA_CHECK_INTERVAL", "0"))     # 0 = chỉ kiểm tra lúc khởi động
+MEDIA_NEGATIVE_TTL = int(os.getenv("MEDIA_NEGATIVE_TTL", "21600"))     # file_id hỏng: bỏ qua send_photo 6 giờ
+
+# Log: 1 dòng JSON mỗi sự kiện, ghi ra stdout bằng thread nền (handler chỉ bỏ vào hàng đợi, đầy thì bỏ log).
+# Cùng 1 sự kiện quá LOG_RATE dòng/s (burst LOG_BURST) -> bỏ bớt, báo số dòng đã bỏ.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "info").lower()         # debug | info | warning | error
+LOG_QUEUE_MAX = int(os.getenv("LOG_QUEUE_MAX", "10000"))
+LOG_RATE = float(os.getenv("LOG_RATE", "20"))
+LOG_BURST = int(os.getenv("LOG_BURST", "50"))
+LOG_UPDATE_SAMPLE = float(os.getenv("LOG_UPDATE_SAMPLE", "0.05"))   # tỉ lệ update bình thường được log
+LOG_SLOW_MS = float(os.getenv("LOG_SLOW_MS", "1000"))               # update chậm hơn -> luôn log
+
+
+# ============ LOG (JSON, GHI NỀN) ============
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+_log_ctx = threading.local()
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    with log_context(update_id=..., chat_id=...): mọi log() trong khối (cùng thread) tự kèm các field này.
+    """
+    prev = getattr(_log_ctx, "fields", None)
+    _log_ctx.fields = {**prev, **fields} if prev else fields
+    try:
+        yield
+    finally:
+        _log_ctx.fields = prev
+
+
+class AsyncLogger:
+    """
+    log() chỉ dựng dict rồi put_nowait vào queue có trần -> không bao giờ chặn handler
+    (stdout dưới gunicorn là pipe, ghi trực tiếp sẽ chặn khi pipe đầy). Queue đầy -> bỏ log, đếm dropped.
+    Thread nền serialize JSON và ghi theo lô.
+    Mỗi event 1 token bucket: vượt rate -> bỏ, số dòng bỏ được báo kèm dòng kế tiếp (field "suppressed")
+    hoặc dòng "log.suppressed" khi rảnh. Tên event là chuỗi cố định -> số bucket không tăng theo dữ liệu.
+    """
+
+    _STOP = object()
+
+    def __init__(self, stream, level: str, queue_max: int, rate: float, burst: int):
+        self.stream = stream
+        self.min_level = LOG_LEVELS.get(level, 20)
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.q = queue.Queue(maxsize=queue_max)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.pid = None
+        self.thread = None
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.q = queue.Queue(maxsize=self.q.maxsize)
+            self.thread = threading.Thread(target=self._loop, name="log-writer", daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def _admit(self, event: str, now: float):
+        """
+        -> số dòng đã bỏ trước đó (để báo) nếu cho qua, None nếu bị giới hạn.
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            b = self.buckets.get(event)
+            if b is None:
+                b = self.buckets[event] = [float(self.burst), now, 0]
+            b[0] = min(float(self.burst), b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+            if b[0] < 1:
+                b[2] += 1
+                return None
+            b[0] -= 1
+            suppressed, b[2] = b[2], 0
+            return suppressed
+
+    def log(self, level: str, event: str, msg: str = "", sample: float = 1.0, **fields):
+        if LOG_LEVELS[level] < self.min_level or (sample < 1 and random.random() >= sample):
+            return
+        suppressed = self._admit(event, time.monotonic())
+        if suppressed is None:
+            return
+        rec = {"ts": round(time.time(), 3), "level": level, "event": event}
+        ctx = getattr(_log_ctx, "fields", None)
+        if ctx:
+            rec.update(ctx)
+        if msg:
+            rec["msg"] = msg
+        rec.update(fields)
+        if suppressed:
+            rec["suppressed"] = suppressed
+        self._ensure_started()
+        try:
+            self.q.put_nowait(rec)
+        except queue.Full:
+            self.dropped += 1
+
+    def _pending_suppressed(self):
+        with self.lock:
+            out = [(event, b[2]) for event, b in self.buckets.items() if b[2]]
+            for event, _ in out:
+                self.buckets[event][2] = 0
+        return [{"ts": round(time.time(), 3), "level": "warning", "event": "log.suppressed", "of": event, "count": n}
+                for event, n in out]
+
+    def _write(self, records):
+        lines = []
+        for rec in records:
+            try:
+                lines.append(json.dumps(rec, ensure_ascii=False, default=str))
+            except Exception as e:
+                lines.append(json.dumps({"level": "error", "event": "log.encode_error", "err": repr(e)}))
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except Exception:
+            pass
+
+    def _loop(self):
+        reported_drops = 0
+        while True:
+            try:
+                batch = [self.q.get(timeout=1.0)]
+            except queue.Empty:
+                batch = self._pending_suppressed()
+            else:
+                while len(batch) < 500:
+                    try:
+                        batch.append(self.q.get_nowait())
+                    except queue.Empty:
+                        break
+            stop = self._STOP in batch
+            batch = [r for r in batch if r is not self._STOP]
+            if self.dropped != reported_drops:
+                batch.append({"ts": round(time.time(), 3), "level": "warning", "event": "log.dropped",
+                              "count": self.dropped - reported_drops})
+                reported_drops = self.dropped
+            if batch:
+                self._write(batch)
+            if stop:
+                return
+
+    def close(self, timeout: float = 2.0):
+        """
+        Lúc tắt process: ghi nốt log đang chờ.
+        """
+        if self.pid != os.getpid():
+            return
+        try:
+            self.q.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+
+logger = AsyncLogger(sys.stdout, LOG_LEVEL, LOG_QUEUE_MAX, LOG_RATE, LOG_BURST)
+log = logger.log
+atexit.register(logger.close)
+
+
+# ============ METRICS (PROMETHEUS /metrics) ============
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _fmt_labels(names, values, extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Histogram:
+    """
+    Histogram rẻ: mỗi bộ label giữ list đếm theo bucket + sum + count (không lưu từng mẫu).
+    """
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}    # {labels: [bucket_counts, sum, count]}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self.lock:
+            items = [(k, list(v[0]), v[1], v[2]) for k, v in self.series.items()]
+        for labels, counts, total, count in items:
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                le_label = 'le="%s"' % le
+                yield f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, le_label)} {acc}"
+            inf_label = 'le="+Inf"'
+            yield f"{self.name}_bucket{_fmt_labels(self.labelnames, labels, inf_label)} {count}"
+            yield f"{self.name}_sum{_fmt_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_fmt_labels(self.labelnames, labels)} {count}"
+
+
+class _Timer:
+    __slots__ = ("hist", "labels", "t0")
+
+    def __init__(self, hist: Histogram, labels):
+        self.hist = hist
+        self.labels = labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.t0, *self.labels)
+        return False
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield f"{self.name}{_fmt_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge:
+    """
+    Gauge tính lúc scrape (gọi fn), không tốn gì trên hot path.
+    """
+
+    def __init__(self, name: str, help_text: str, fn):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        try:
+            yield f"{self.name} {float(self.fn())}"
+        except Exception:
+            pass
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        m = Histogram(*args, **kwargs)
+        self.metrics.append(m)
+        return m
+
+    def counter(self, *args, **kwargs) -> Counter:
+        m = Counter(*args, **kwargs)
+        self.metrics.append(m)
+        return m
+
+    def gauge(self, name: str, help_text: str, fn) -> Gauge:
+        m = Gauge(name, help_text, fn)
+        self.metrics.append(m)
+        return m
+
+    def render(self) -> str:
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+WEBHOOK_LATENCY = metrics.histogram("bot_webhook_request_seconds", "Thời gian xử lý request /webhook")
+UPDATE_LATENCY = metrics.histogram("bot_update_seconds", "Thời gian xử lý 1 update ở worker")
+HANDLER_LATENCY = metrics.histogram("bot_handler_seconds", "Thời gian chạy handler", ["handler"])
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Số lần handler lỗi", ["handler"])
+DB_LATENCY = metrics.histogram("bot_db_query_seconds", "Thời gian query DB", ["query"])
+TG_LATENCY = metrics.histogram("bot_telegram_api_seconds", "Thời gian gọi Telegram API", ["method"])
+TG_ERRORS = metrics.counter("bot_telegram_api_errors_total", "Lỗi Telegram API", ["method", "code"])
+BROADCAST_MESSAGES = metrics.counter("bot_broadcast_messages_total", "Tin broadcast đã xử lý", ["result"])
+
+
+# đo mọi call Telegram: telebot gọi apihelper._make_request cho từng method
+_orig_make_request = apihelper._make_request
+
+
+def _timed_make_request(token, method_name, method="get", params=None, files=None):
+    t0 = time.perf_counter()
+    try:
+        return _orig_make_request(token, method_name, method=method, params=params, files=files)
+    except ApiTelegramException as e:
+        TG_ERRORS.inc(method_name, str(e.error_code))
+        raise
+    except Exception:
+        TG_ERRORS.inc(method_name, "network")
+        raise
+    finally:
+        TG_LATENCY.observe(time.perf_counter() - t0, method_name)
+
+
+apihelper._make_request = _timed_make_request
+
+
+class UpdateProfiler:
+    """
+    Bật bằng /profile <giây> <1/N>: trong cửa sổ thời gian, cứ N update thì profile 1 update bằng cProfile,
+    hết giờ gửi top hàm tốn thời gian (cumulative) cho admin. Mỗi lúc chỉ profile 1 update.
+    """
+
+    def __init__(self):
+        self.until = 0.0
+        self.every = 1
+        self.seen = 0
+        self.samples = 0
+        self.stats = None
+        self.busy = threading.Lock()
+        self.lock = threading.Lock()
+
+    def start(self, seconds: float, every: int, report_to: int):
+        with self.lock:
+            self.until = time.monotonic() + seconds
+            self.every = max(1, every)
+            self.seen = 0
+            self.samples = 0
+            self.stats = None
+        threading.Timer(seconds, self._report, args=(current_bot(), report_to)).start()
+
+    def run(self, fn, *args):
+        if time.monotonic() >= self.until:
+            return fn(*args)
+        with self.lock:
+            self.seen += 1
+            take = self.seen % self.every == 0
+        if not take or not self.busy.acquire(blocking=False):
+            return fn(*args)
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+            try:
+                return fn(*args)
+            finally:
+                prof.disable()
+                with self.lock:
+                    self.samples += 1
+                    if self.stats is None:
+                        self.stats = pstats.Stats(prof)
+                    else:
+                        self.stats.add(prof)
+        finally:
+            self.busy.release()
+
+    def _report(self, rt, chat_id: int):
+        with self.lock:
+            stats, samples = self.stats, self.samples
+            self.stats = None
+        if not stats:
+            text = "🧪 Profile: không có update nào được lấy mẫu."
+        else:
+            out = io.StringIO()
+            stats.stream = out
+            stats.sort_stats("cumulative").print_stats(25)
+            text = f"🧪 Profile {samples} update:\n" + out.getvalue()[-3800:]
+        try:
+            with use_bot(rt):
+                bot.send_message(chat_id, text)
+        except Exception as e:
+            log("error", "profile.report_error", err=repr(e))
+
+
+update_profiler = UpdateProfiler()
+
+
+# ============ HTTP CLIENT (DÙNG CHUNG) ============
+
+class HttpStats:
+    """
+    Đếm request vs connection mới: reuse = requests - new_connections.
+    Tỉ lệ reuse cao = ít phải bắt tay TLS với api.telegram.org.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, field: str):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            reused = max(0, self.requests - self.new_connections)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused": reused,
+                "reuse_ratio": reused / self.requests if self.requests else 0.0,
+                "errors": self.errors,
+            }
+
+
+http_stats = HttpStats()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        http_stats.add("new_connections")
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        http_stats.add("new_connections")
+        return super()._new_conn()
+
+
+class TunedHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter: pool đủ cho số thread gửi đồng thời, timeout mặc định, đếm connection mới.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+        http_stats.add("requests")
+        try:
+            return super().send(request, timeout=timeout, **kwargs)
+        except Exception:
+            http_stats.add("errors")
+            raise
+
+
+def make_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = TunedHTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=HTTP_CONNECT_RETRIES, connect=HTTP_CONNECT_RETRIES, read=0, status=0,
+                          other=0, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+    return session
+
+
+http_session = make_http_session()
+
+# telebot: mọi thread dùng chung session này (không tạo session riêng mỗi thread, không reset định kỳ)
+apihelper.session = http_session
+apihelper.SESSION_TIME_TO_LIVE = None
+apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
+
+# ============ OUTBOUND (HÀNG ĐỢI GỬI TELEGRAM) ============
+
+PRIO_INTERACTIVE, PRIO_ADMIN, PRIO_BULK = 0, 1, 2
+PRIO_NAMES = ("interactive", "admin", "bulk")
+_outbound_ctx = threading.local()
+
+
+@contextmanager
+def outbound_priority(prio: int):
+    """
+    with outbound_priority(PRIO_BULK): bot.send_message(...) -> request trong khối này xếp hàng ở mức đó.
+    Mặc định (handler trả lời khách) là PRIO_INTERACTIVE.
+    """
+    prev = getattr(_outbound_ctx, "prio", PRIO_INTERACTIVE)
+    _outbound_ctx.prio = prio
+    try:
+        yield
+    finally:
+        _outbound_ctx.prio = prev
+
+
+def telegram_retry_after(e) -> float:
+    """
+    Lỗi 429 của Telegram -> số giây phải chờ (parameters.retry_after). Không phải 429 -> 0.
+    """
+    if isinstance(e, ApiTelegramException) and e.error_code == 429:
+        params = (e.result_json or {}).get("parameters") or {}
+        return float(params.get("retry_after") or 1)
+    return 0.0
+
+
+class TelegramUnavailable(Exception):
+    """
+    Circuit breaker đang mở (api.telegram.org lỗi liên tục) -> báo lỗi ngay thay vì chờ timeout.
+    """
+
+
+class OutboundGate:
+    """
+    Thay apihelper._make_request -> mọi bot.* đi qua đây:
+    - mỗi mức ưu tiên 1 deque có trần (bộ nhớ cố định), N thread gửi luôn lấy mức cao trước
+    - 429: dừng gửi request của bot (token) đó retry_after giây (giới hạn của Telegram tính theo bot)
+    - lỗi tạm (mạng, 5xx, 429): thread gọi chờ backoff có jitter rồi gửi lại. Mức bulk không retry ở đây
+      vì broadcast / digest đã tự retry (tránh retry lồng nhau)
+    - circuit breaker: threshold lỗi mạng/5xx liên tiếp -> mở cooldown giây, request báo TelegramUnavailable ngay;
+      hết cooldown cho request đi thử, lỗi tiếp thì mở lại
+    Thread gọi vẫn chờ kết quả như cũ (handler dùng được message trả về).
+    """
+
+    BACKOFF_BASE = 0.5
+    BACKOFF_CAP = 5.0
+
+    def __init__(self, send_fn, workers: int, queue_max: int, enqueue_timeout: float, retries: int,
+                 breaker_threshold: int, breaker_cooldown: float):
+        self.send_fn = send_fn
+        self.workers = max(1, workers)
+        self.queue_max = max(1, queue_max)
+        self.enqueue_timeout = enqueue_timeout
+        self.retries = retries
+        self.breaker_threshold = max(1, breaker_threshold)
+        self.breaker_cooldown = breaker_cooldown
+        self.levels = [deque() for _ in PRIO_NAMES]
+        self.cond = threading.Condition()
+        self.paused = {}     # {token: monotonic} - giới hạn 429 của Telegram tính theo từng bot
+        self.failures = 0
+        self.open_until = 0.0
+        self.pid = None
+        self.start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.levels = [deque() for _ in PRIO_NAMES]
+            self.cond = threading.Condition()
+            for i in range(self.workers):
+                threading.Thread(target=self._loop, name=f"outbound-{i}", daemon=True).start()
+            self.pid = os.getpid()
+
+    # --- phía thread gọi ---
+    def make_request(self, token, method_name, method="get", params=None, files=None):
+        prio = getattr(_outbound_ctx, "prio", PRIO_INTERACTIVE)
+        # upload file: stream đã đọc dở, không gửi lại được
+        retries = 0 if prio == PRIO_BULK or files else self.retries
+        for attempt in range(retries + 1):
+            try:
+                return self._call(prio, (token, method_name, method, params, files))
+            except Exception as e:
+                delay = self.retry_delay(e, method_name, attempt)
+                if delay is None or attempt >= retries:
+                    raise
+                OUTBOUND_RETRIED.inc(method_name)
+                time.sleep(delay)
+
+    def _call(self, prio: int, args):
+        if time.monotonic() < self.open_until:
+            OUTBOUND_REJECTED.inc("breaker_open")
+            raise TelegramUnavailable(f"circuit breaker mở, bỏ {args[1]}")
+        self._ensure_started()
+        fut = Future()
+        with self.cond:
+            dq = self.levels[prio]
+            if len(dq) >= self.queue_max and not self.cond.wait_for(
+                    lambda: len(dq) < self.queue_max, timeout=self.enqueue_timeout):
+                OUTBOUND_REJECTED.inc("queue_full")
+                raise TelegramUnavailable(f"hàng đợi gửi {PRIO_NAMES[prio]} đầy, bỏ {args[1]}")
+            dq.append((fut, args))
+            self.cond.notify_all()
+        return fut.result()
+
+    def retry_delay(self, e, method_name: str, attempt: int):
+        """
+        Lỗi tạm -> số giây chờ trước khi gửi lại; lỗi không nên gửi lại (4xx, breaker mở...) -> None.
+        Read timeout: request có thể đã tới Telegram -> chỉ gửi lại method đọc (get*), không gửi lại tin nhắn.
+        """
+        if isinstance(e, TelegramUnavailable):
+            return None
+        if telegram_retry_after(e):
+            return 0.0      # thread gửi tự chờ hết pause toàn cục
+        if not self.is_transient(e):
+            return None
+        if isinstance(e, requests.Timeout) and not isinstance(e, requests.ConnectTimeout) \
+                and not method_name.startswith("get"):
+            return None
+        return random.uniform(0, min(self.BACKOFF_CAP, self.BACKOFF_BASE * (2 ** attempt)))
+
+    @staticmethod
+    def is_transient(e) -> bool:
+        """
+        Lỗi phía Telegram / mạng (tính vào circuit breaker): 5xx, lỗi kết nối, timeout.
+        """
+        if isinstance(e, ApiTelegramException):
+            return e.error_code >= 500
+        if isinstance(e, apihelper.ApiHTTPException):
+            return getattr(e.result, "status_code", 500) >= 500
+        return isinstance(e, (requests.ConnectionError, requests.Timeout))
+
+    # --- phía thread gửi ---
+    def _take(self):
+        with self.cond:
+            while True:
+                for dq in self.levels:
+                    if dq:
+                        item = dq.popleft()
+                        self.cond.notify_all()   # có chỗ trống cho thread đang chờ xếp hàng
+                        return item
+                self.cond.wait()
+
+    def _loop(self):
+        while True:
+            fut, (token, method_name, method, params, files) = self._take()
+            wait = self.paused.get(token, 0.0) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            if not fut.set_running_or_notify_cancel():
+                continue
+            try:
+                result = self.send_fn(token, method_name, method=method, params=params, files=files)
+            except Exception as e:
+                self._on_error(token, e)
+                fut.set_exception(e)
+            else:
+                self.failures = 0
+                fut.set_result(result)
+
+    def _on_error(self, token, e):
+        retry_after = telegram_retry_after(e)
+        if retry_after:
+            self.paused[token] = max(self.paused.get(token, 0.0), time.monotonic() + retry_after)
+            return
+        if not self.is_transient(e):
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= self.breaker_threshold and time.monotonic() >= self.open_until:
+            self.open_until = time.monotonic() + self.breaker_cooldown
+            log("error", "outbound.breaker_open", "lỗi liên tiếp -> ngắt gửi", failures=self.failures,
+                cooldown=self.breaker_cooldown, err=repr(e))
+
+    def depth(self, prio: int) -> int:
+        return len(self.levels[prio])
+
+    def status_text(self) -> str:
+        now = time.monotonic()
+        state = f"mở thêm {self.open_until - now:.0f}s" if now < self.open_until else "đóng"
+        paused_until = max(self.paused.values(), default=0.0)
+        paused = f", đang chờ 429 {paused_until - now:.0f}s" if now < paused_until else ""
+        queued = ", ".join(f"{name} {len(dq)}" for name, dq in zip(PRIO_NAMES, self.levels))
+        return f"📤 Outbound: breaker {state}{paused}, hàng đợi: {queued}"
+
+
+OUTBOUND_RETRIED = metrics.counter("bot_outbound_retries_total", "Request Telegram gửi lại do lỗi tạm", ["method"])
+OUTBOUND_REJECTED = metrics.counter("bot_outbound_rejected_total", "Request Telegram bị từ chối ngay", ["reason"])
+outbound = OutboundGate(
+    _timed_make_request, OUTBOUND_WORKERS, OUTBOUND_QUEUE_MAX, OUTBOUND_ENQUEUE_TIMEOUT, OUTBOUND_RETRIES,
+    OUTBOUND_BREAKER_THRESHOLD, OUTBOUND_BREAKER_COOLDOWN,
+)
+apihelper._make_request = outbound.make_request
+
 
 # ============ KHỞI TẠO ============
 
-bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
 server = Flask(__name__)
+bots = {}            # {bot_id: BotRuntime}, thứ tự như BOT_CONFIGS - dựng ở mục NHIỀU BOT cuối file
+_bot_ctx = threading.local()
+
+
+def current_bot():
+    """
+    Bot mà thread này đang xử lý (update / job nền đã vào use_bot), ngoài ngữ cảnh -> bot đầu tiên.
+    """
+    rt = getattr(_bot_ctx, "rt", None)
+    return rt if rt is not None else next(iter(bots.values()))
+
+
+@contextmanager
+def use_bot(rt):
+    prev = getattr(_bot_ctx, "rt", None)
+    _bot_ctx.rt = rt
+    try:
+        yield rt
+    finally:
+        _bot_ctx.rt = prev
+
+
+def bot_thread(target, *args, **kwargs) -> threading.Thread:
+    """
+    Thread nền chạy trong ngữ cảnh bot hiện tại (threading.local không truyền sang thread mới).
+    """
+    rt = current_bot()
+
+    def _run():
+        with use_bot(rt):
+            target(*args)
+
+    return threading.Thread(target=_run, **kwargs)
+
+
+class BotScoped:
+    """
+    Tên dùng chung trong handler (bot, templates, media, state_store...) -> object cùng tên của current_bot().
+    Handler giữ nguyên `bot.send_message(...)` dù process chạy nhiều bot.
+    """
+
+    __slots__ = ("attr",)
+
+    def __init__(self, attr: str):
+        self.attr = attr
 
-# State user (RAM)
-user_state = {}       # {chat_id: "WAITING_USERNAME" ... hoặc dict}
-debug_get_id_mode = set()
+    def __getattr__(self, name):
+        return getattr(getattr(current_bot(), self.attr), name)
 
-# Admin broadcast state (RAM)
-admin_state = {}      # {chat_id: {"mode": "BROADCAST_WAIT_MEDIA", "payload": {...}}}
+
+bot = BotScoped("bot")
+
+
+# ============ DISPATCHER (TRA BẢNG THAY VÌ DUYỆT LAMBDA) ============
+
+class Dispatcher:
+    """
+    Định tuyến update bằng dict: command / text cố định / callback_data / state / content_type.
+    Mỗi update chỉ tra vài dict (O(1)) thay vì chạy lần lượt từng filter lambda như telebot.
+
+    Thứ tự với message: command -> text cố định (có guard) -> (state, content_type) -> content_type.
+    Callback: khớp nguyên callback_data trước, rồi tới prefix trước dấu ":".
+    """
+
+    def __init__(self, state_key=None):
+        self.commands = {}      # {"start": handler}
+        self.texts = {}         # {"📊 Stats": (guard, handler)}
+        self.callbacks = {}     # {"BC_CONFIRM": handler}
+        self.callback_prefixes = {}  # {"LEADS": handler} cho callback_data dạng "LEADS:<tham số>"
+        self.states = {}        # {("BROADCAST_WAIT_MEDIA", "text"): handler}
+        self.contents = {}      # {"photo": handler}
+        self.state_key = state_key
+        self._content_types = None   # tính 1 lần, sau khi đăng ký xong handler
+        self.stats = {}         # {handler_name: [calls, errors, total_s, max_s]}
+        self.stats_lock = threading.Lock()
+
+    # --- đăng ký ---
+    def command(self, *names):
+        def deco(fn):
+            for name in names:
+                self.commands[name] = fn
+            return fn
+        return deco
+
+    def text(self, value: str, guard=None):
+        def deco(fn):
+            self.texts[value] = (guard, fn)
+            return fn
+        return deco
+
+    def callback(self, *datas):
+        def deco(fn):
+            for data in datas:
+                self.callbacks[data] = fn
+            return fn
+        return deco
+
+    def callback_prefix(self, *prefixes):
+        def deco(fn):
+            for prefix in prefixes:
+                self.callback_prefixes[prefix] = fn
+            return fn
+        return deco
+
+    def state(self, key: str, content_types=("text",)):
+        def deco(fn):
+            for ct in content_types:
+                self.states[(key, ct)] = fn
+            return fn
+        return deco
+
+    def content(self, *content_types):
+        def deco(fn):
+            for ct in content_types:
+                self.contents[ct] = fn
+            return fn
+        return deco
+
+    # --- lọc sớm (dict JSON thô, trước khi dựng object telebot) ---
+    def routes_message(self, msg: dict) -> bool:
+        """
+        Message có content_type nào mà handler (content / state) nhận không. Sticker, voice... -> False.
+        """
+        routed = self.content_types()
+        return any(ct in msg for ct in routed)
+
+    def routes_callback(self, data: str) -> bool:
+        data = data or ""
+        return data in self.callbacks or data.split(":", 1)[0] in self.callback_prefixes
+
+    def content_types(self):
+        if self._content_types is None:
+            self._content_types = frozenset(self.contents) | frozenset(ct for _, ct in self.states)
+        return self._content_types
+
+    # --- tra handler ---
+    def resolve_message(self, message):
+        ct = message.content_type
+        if ct == "text":
+            text = message.text
+            if text.startswith("/"):
+                handler = self.commands.get(text.split(maxsplit=1)[0][1:].split("@", 1)[0])
+                if handler:
+                    return handler
+            hit = self.texts.get(text)
+            if hit and (hit[0] is None or hit[0](message)):
+                return hit[1]
+        if self.states and self.state_key:
+            key = self.state_key(message)
+            if key is not None:
+                handler = self.states.get((key, ct))
+                if handler:
+                    return handler
+        return self.contents.get(ct)
+
+    def dispatch(self, update):
+        if update.message is not None:
+            obj = update.message
+            handler = self.resolve_message(obj)
+        elif update.callback_query is not None:
+            obj = update.callback_query
+            data = obj.data or ""
+            handler = self.callbacks.get(data) or self.callback_prefixes.get(data.split(":", 1)[0])
+        else:
+            return
+        if handler is not None:
+            self._run(handler, obj)
+
+    def _run(self, handler, obj):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            handler(obj)
+            ok = True
+        finally:
+            took = time.perf_counter() - t0
+            HANDLER_LATENCY.observe(took, handler.__name__)
+            # update bình thường chỉ log 1 phần (LOG_UPDATE_SAMPLE); lỗi / chậm luôn log
+            slow = took * 1000 >= LOG_SLOW_MS
+            log("info" if ok and not slow else "warning", "update.handled", handler=handler.__name__,
+                latency_ms=round(took * 1000, 1), ok=ok, sample=1.0 if not ok or slow else LOG_UPDATE_SAMPLE)
+            if not ok:
+                HANDLER_ERRORS.inc(handler.__name__)
+            with self.stats_lock:
+                st = self.stats.setdefault(handler.__name__, [0, 0, 0.0, 0.0])
+                st[0] += 1
+                st[1] += 0 if ok else 1
+                st[2] += took
+                st[3] = max(st[3], took)
+
+    def stats_text(self) -> str:
+        with self.stats_lock:
+            rows = sorted(self.stats.items(), key=lambda kv: kv[1][2], reverse=True)
+        if not rows:
+            return "Chưa có số liệu dispatch."
+        return "\n".join(
+            f"{name}: {calls} lần, lỗi {errors}, TB {total / calls * 1000:.1f}ms, max {mx * 1000:.0f}ms"
+            for name, (calls, errors, total, mx) in rows
+        )
+
+
+def _dispatch_state_key(message):
+    # chỉ admin mới có state định tuyến (đang soạn broadcast)
+    return admin_mode(message.chat.id) if is_admin(message.chat.id) else None
+
+
+dispatcher = Dispatcher(state_key=_dispatch_state_key)
 
 
 # ============ HELPERS: SAFE SEND PHOTO ============
@@ -59,512 +1144,2802 @@ def safe_send_photo(chat_id: int, photo_id_or_url: str, caption: str = "", reply
     """
     Tránh lỗi 400 'wrong file identifier/HTTP URL specified'.
     Nếu gửi ảnh fail -> fallback sang send_message (caption).
+    file_id đã biết là hỏng (media.is_bad) -> gửi text luôn, khỏi tốn 1 round-trip send_photo.
     """
-    try:
-        return bot.send_photo(
-            chat_id,
-            photo_id_or_url,
-            caption=caption,
-            reply_markup=reply_markup,
-            parse_mode=parse_mode
-        )
-    except Exception as e:
-        print("[PHOTO_FALLBACK] send_photo failed:", repr(e))
-        # fallback: gửi text
-        text = caption if caption else "⚠️ Không gửi được ảnh, vui lòng thử lại."
+    if photo_id_or_url and not media.is_bad(photo_id_or_url):
         try:
-            return bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
-        except Exception as e2:
-            print("[PHOTO_FALLBACK] send_message also failed:", repr(e2))
-            return None
+            return bot.send_photo(
+                chat_id,
+                photo_id_or_url,
+                caption=caption,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode
+            )
+        except Exception as e:
+            log("warning", "photo_fallback.photo_failed", err=repr(e))
+            if is_bad_file_error(e):
+                media.mark_bad(photo_id_or_url)
+    # fallback: gửi text
+    text = caption if caption else "⚠️ Không gửi được ảnh, vui lòng thử lại."
+    try:
+        return bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except Exception as e2:
+        log("error", "photo_fallback.message_failed", err=repr(e2))
+        return None
+
+
+def is_bad_file_error(e) -> bool:
+    """
+    Lỗi do chính file_id (sai/hết hạn/không thuộc bot này), không phải lỗi mạng hay 429.
+    """
+    if not isinstance(e, ApiTelegramException) or e.error_code != 400:
+        return False
+    desc = (e.description or "").lower()
+    return "file" in desc or "identifier" in desc
 
 
 # ============ DB LƯU USERS (POSTGRES) ============
 
-def db_conn():
+_db_pool = None
+_db_pool_pid = None
+_db_pool_lock = threading.Lock()
+
+
+def db_pool() -> ConnectionPool:
+    """
+    Pool connection dùng chung cả process (thread-safe).
+    Tạo lazy + tạo lại nếu process bị fork (gunicorn --preload) vì thread của pool không sống qua fork.
+    """
+    global _db_pool, _db_pool_pid
     if not DATABASE_URL:
         raise RuntimeError("Missing DATABASE_URL")
-    # psycopg v3: autocommit để khỏi quên commit
-    return psycopg.connect(DATABASE_URL, connect_timeout=10, autocommit=True)
+    pid = os.getpid()
+    if _db_pool is not None and _db_pool_pid == pid:
+        return _db_pool
+    with _db_pool_lock:
+        if _db_pool is None or _db_pool_pid != pid:
+            _db_pool = ConnectionPool(
+                DATABASE_URL,
+                min_size=DB_POOL_MIN,
+                max_size=max(DB_POOL_MIN, DB_POOL_MAX),
+                timeout=DB_POOL_TIMEOUT,
+                max_idle=DB_POOL_MAX_IDLE,
+                reconnect_timeout=60,
+                # psycopg v3: autocommit để khỏi quên commit
+                kwargs={
+                    "connect_timeout": 10,
+                    "autocommit": True,
+                    "prepare_threshold": 5 if DB_PREPARE else None,
+                },
+                name="users",
+                open=True,
+            )
+            _db_pool_pid = pid
+    return _db_pool
+
+
+@contextmanager
+def db_conn():
+    """
+    Mượn 1 connection từ pool: `with db_conn() as conn: ...` (trả lại pool khi ra khỏi with).
+    Pool dùng chung cho mọi bot -> connection đang trỏ schema của bot khác thì đổi search_path
+    (nhớ trên chính connection, chỉ tốn thêm 1 lệnh khi đổi bot). Connection mới luôn ở public.
+    """
+    schema = current_bot().schema
+    with db_pool().connection(timeout=DB_POOL_TIMEOUT) as conn:
+        if getattr(conn, "bot_schema", "public") != schema:
+            conn.execute(psycopg.sql.SQL("SET search_path TO {}").format(psycopg.sql.Identifier(schema)))
+            conn.bot_schema = schema
+        yield conn
+
+
+def db_run(fn, retries: int = 1, name: str = None):
+    """
+    Chạy fn(cur) trên connection của pool.
+    Connection bị server cắt (Supabase đóng idle, restart...) -> pool tự bỏ connection hỏng,
+    mình thử lại với connection mới. Chỉ dùng cho query idempotent.
+    name: nhãn cho metric bot_db_query_seconds.
+    """
+    for attempt in range(retries + 1):
+        try:
+            with DB_LATENCY.time(name or fn.__name__), db_conn() as conn:
+                with conn.cursor() as cur:
+                    return fn(cur)
+        except psycopg.OperationalError:
+            if attempt >= retries:
+                raise
+            log("warning", "db.retry", "connection lỗi, thử lại với connection mới", op=name or fn.__name__)
+
+
+def _db_health_loop():
+    while True:
+        time.sleep(DB_POOL_CHECK_INTERVAL)
+        try:
+            db_pool().check()
+        except Exception as e:
+            log("error", "db.pool_check_error", err=repr(e))
 
 
-def init_db():
+def close_db_pool():
+    global _db_pool
+    if _db_pool is not None and _db_pool_pid == os.getpid():
+        try:
+            _db_pool.close(timeout=5)
+        except Exception as e:
+            log("error", "db.close_pool_error", err=repr(e))
+        _db_pool = None
+
+
+atexit.register(close_db_pool)
+
+
+# Tăng mỗi khi sửa DDL trong _apply_schema -> lần khởi động sau mới chạy lại DDL
+SCHEMA_VERSION = 2
+SQL_SCHEMA_VERSION = "SELECT MAX(version) FROM bot_schema_version"
+
+
+def _db_schema_version(cur) -> int:
+    cur.execute(SQL_SCHEMA_VERSION)
+    row = cur.fetchone()
+    return int(row[0]) if row and row[0] is not None else 0
+
+
+def init_db() -> bool:
+    """
+    Tạo / nâng cấp schema của mọi bot. Trả True nếu lần này có chạy DDL.
+    """
+    applied = False
+    for rt in bots.values():
+        with use_bot(rt):
+            applied = _init_bot_schema(rt.schema) or applied
+    return applied
+
+
+def _init_bot_schema(schema: str) -> bool:
     """
-    Tạo bảng users để lưu chat_id.
+    Chạy 1 lần cho mỗi SCHEMA_VERSION (trong schema Postgres của bot):
+    - boot bình thường: 1 câu SELECT version, không chạy DDL
+    - DB cũ hơn: advisory lock -> 1 worker chạy DDL + ghi version, worker khác chờ lock rồi thấy đã xong
     """
     with db_conn() as conn:
-        with conn.cursor() as cur:
+        try:
+            with conn.cursor() as cur:
+                if _db_schema_version(cur) >= SCHEMA_VERSION:
+                    return False
+        except psycopg.errors.UndefinedTable:
+            pass
+        with conn.transaction(), conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"bot:init_db:{schema}",))
+            cur.execute(psycopg.sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(psycopg.sql.Identifier(schema)))
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    chat_id BIGINT PRIMARY KEY,
-                    first_seen TIMESTAMPTZ DEFAULT NOW(),
-                    last_seen  TIMESTAMPTZ DEFAULT NOW()
+                CREATE TABLE IF NOT EXISTS bot_schema_version (
+                    version    INT PRIMARY KEY,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
                 )
             """)
+            if _db_schema_version(cur) >= SCHEMA_VERSION:
+                return False
+            _apply_schema(cur)
+            cur.execute("INSERT INTO bot_schema_version (version) VALUES (%s) ON CONFLICT DO NOTHING", (SCHEMA_VERSION,))
+            return True
+
+
+def _apply_schema(cur):
+    """
+    DDL idempotent (IF NOT EXISTS) -> chạy lại trên DB đã có bảng vẫn an toàn.
+    Tạo đủ mọi bảng kể cả bảng của backend chưa bật, để đổi DEDUP_BACKEND / STATE_BACKEND không cần tăng version.
+    """
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            chat_id BIGINT PRIMARY KEY,
+            first_seen TIMESTAMPTZ DEFAULT NOW(),
+            last_seen  TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS media_assets (
+            name       TEXT PRIMARY KEY,
+            file_id    TEXT NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+    # user chặn bot / xóa tài khoản -> is_active = FALSE, broadcast + thống kê bỏ qua
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active BOOLEAN NOT NULL DEFAULT TRUE")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS inactive_reason TEXT")
+    cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS inactive_at TIMESTAMPTZ")
+    cur.execute("CREATE INDEX IF NOT EXISTS users_inactive_idx ON users (chat_id) WHERE NOT is_active")
+    # cho thống kê mới hôm nay / hoạt động 24h, 7 ngày (không quét cả bảng)
+    cur.execute("CREATE INDEX IF NOT EXISTS users_first_seen_idx ON users (first_seen)")
+    cur.execute("CREATE INDEX IF NOT EXISTS users_last_seen_idx ON users (last_seen)")
+    # lead của flow: id sinh ở app (ghi nền theo lô nên cần biết id trước khi INSERT)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_leads (
+            id                TEXT PRIMARY KEY,
+            chat_id           BIGINT NOT NULL,
+            tg_username       TEXT,
+            username_game     TEXT,
+            receipt_file_id   TEXT,
+            receipt_unique_id TEXT,
+            receipt_dup_of    TEXT,
+            tail              TEXT,
+            status            TEXT NOT NULL,
+            created_at        TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at        TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS bot_leads_chat_idx ON bot_leads (chat_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS bot_leads_username_idx ON bot_leads (lower(username_game))")
+    cur.execute("CREATE INDEX IF NOT EXISTS bot_leads_created_idx ON bot_leads (created_at, id)")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS bot_leads_pending_idx ON bot_leads (created_at, id) WHERE status = 'pending'"
+    )
+    # check bill trùng: so bằng, không cần thứ tự -> hash index
+    cur.execute("CREATE INDEX IF NOT EXISTS bot_leads_receipt_idx ON bot_leads USING hash (receipt_unique_id)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            seen_at   TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS processed_updates_seen_idx ON processed_updates (seen_at)")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conv_state (
+            scope      TEXT   NOT NULL,
+            chat_id    BIGINT NOT NULL,
+            data       JSONB,
+            expires_at TIMESTAMPTZ NOT NULL,
+            PRIMARY KEY (scope, chat_id)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS conv_state_expires_idx ON conv_state (expires_at)")
+    # v2: broadcast bền - job + trạng thái từng người nhận (pending -> sending -> sent | failed | pruned)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id            TEXT PRIMARY KEY,
+            payload       JSONB NOT NULL,
+            segment       JSONB NOT NULL DEFAULT '{}',
+            admin_chat_id BIGINT,
+            status        TEXT NOT NULL,
+            total         INT NOT NULL DEFAULT 0,
+            sent          INT NOT NULL DEFAULT 0,
+            failed        INT NOT NULL DEFAULT 0,
+            pruned        INT NOT NULL DEFAULT 0,
+            created_at    TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            started_at    TIMESTAMPTZ,
+            finished_at   TIMESTAMPTZ
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS broadcast_jobs_running_idx ON broadcast_jobs (created_at) WHERE status = 'running'")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id     TEXT   NOT NULL REFERENCES broadcast_jobs (id) ON DELETE CASCADE,
+            chat_id    BIGINT NOT NULL,
+            status     TEXT   NOT NULL DEFAULT 'pending',
+            attempts   SMALLINT NOT NULL DEFAULT 0,
+            claimed_at TIMESTAMPTZ,
+            PRIMARY KEY (job_id, chat_id)
+        )
+    """)
+    # nhận lô chỉ quét phần chưa xong của job
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS broadcast_deliveries_open_idx ON broadcast_deliveries (job_id, chat_id) "
+        "WHERE status IN ('pending', 'sending')"
+    )
+
+
+# Query nóng (chạy mỗi update) -> prepared statement
+# xmax = 0 <=> dòng vừa được INSERT (không phải UPDATE) -> biết ngay có user mới
+SQL_UPSERT_USER = """
+    INSERT INTO users(chat_id)
+    VALUES (%s)
+    ON CONFLICT (chat_id)
+    DO UPDATE SET last_seen = NOW(), is_active = TRUE, inactive_reason = NULL, inactive_at = NULL
+    RETURNING (xmax = 0) AS inserted
+"""
+# ghi gộp last_seen: chỉ sửa dòng khi mốc mới hơn; chat bị đánh dấu inactive SAU lần nhắn cuối thì giữ inactive
+SQL_TOUCH_USERS = """
+    INSERT INTO users(chat_id, last_seen)
+    VALUES {values}
+    ON CONFLICT (chat_id) DO UPDATE SET
+        last_seen = EXCLUDED.last_seen,
+        is_active = users.is_active OR COALESCE(users.inactive_at < EXCLUDED.last_seen, FALSE),
+        inactive_reason = CASE WHEN users.inactive_at < EXCLUDED.last_seen THEN NULL ELSE users.inactive_reason END,
+        inactive_at = CASE WHEN users.inactive_at < EXCLUDED.last_seen THEN NULL ELSE users.inactive_at END
+    WHERE users.last_seen < EXCLUDED.last_seen
+"""
+SQL_COUNT_USERS = "SELECT COUNT(*) FROM users WHERE is_active"
+SQL_USER_BREAKDOWN = """
+    SELECT
+        (SELECT COUNT(*) FROM users WHERE first_seen >= date_trunc('day', NOW() AT TIME ZONE %(tz)s) AT TIME ZONE %(tz)s),
+        (SELECT COUNT(*) FROM users WHERE last_seen >= NOW() - INTERVAL '24 hours' AND is_active),
+        (SELECT COUNT(*) FROM users WHERE last_seen >= NOW() - INTERVAL '7 days' AND is_active),
+        (SELECT COUNT(*) FROM users WHERE NOT is_active)
+"""
+SQL_AUDIENCE_PAGE = "SELECT chat_id FROM users WHERE chat_id > %s AND is_active{where} ORDER BY chat_id LIMIT %s"
+SQL_MARK_INACTIVE = """
+    UPDATE users SET is_active = FALSE, inactive_reason = %s, inactive_at = NOW()
+    WHERE chat_id = ANY(%s) AND is_active
+"""
 
 
 def upsert_user(chat_id: int):
     if not DATABASE_URL:
         return
+    # user đã upsert trong process này -> chỉ dời last_seen trong RAM, không tốn round-trip DB
+    if user_touches.touch(chat_id):
+        return
+
+    def _q(cur):
+        cur.execute(SQL_UPSERT_USER, (chat_id,), prepare=DB_PREPARE)
+        row = cur.fetchone()
+        return bool(row and row[0])
+
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("""
-                    INSERT INTO users(chat_id)
-                    VALUES (%s)
-                    ON CONFLICT (chat_id)
-                    DO UPDATE SET last_seen = NOW()
-                """, (chat_id,))
+        if db_run(_q, name="upsert_user"):
+            user_counter.on_new_user()
+        user_touches.remember(chat_id)
     except Exception as e:
-        print("[DB] upsert_user error:", repr(e))
+        log("error", "db.upsert_user_error", err=repr(e))
+
+
+class UserTouchBuffer:
+    """
+    Write-behind cho last_seen: mỗi tin nhắn của user đã biết chỉ ghi đè {chat_id: thời điểm} trong RAM
+    (nhắn 50 tin trong 1 khoảng = 1 dòng), thread nền ghi mỗi interval giây (hoặc khi đủ batch_max chat)
+    bằng 1 câu INSERT ... ON CONFLICT nhiều dòng -> 1 row version / user / khoảng thay vì / tin nhắn.
+    Dòng sắp theo chat_id: nhiều worker ghi cùng lúc khóa dòng theo cùng thứ tự, không deadlock.
+    "known": LRU chat_id đã upsert đồng bộ (user mới, user quay lại sau restart) - ngoài LRU thì upsert lại.
+    DB lỗi -> trả về buffer (giữ mốc mới hơn), lần sau ghi lại. Tắt process -> flush (atexit).
+    """
+
+    def __init__(self, interval: float, batch_max: int, known_size: int):
+        self.interval = interval
+        self.batch_max = max(1, batch_max)
+        self.known_size = known_size
+        self.pending = {}   # {bot_id: {chat_id: datetime}}
+        self.known = {}     # {bot_id: OrderedDict{chat_id: None}}
+        self.cond = threading.Condition()
+        self.thread = None
+        self.written = 0
+
+    def touch(self, chat_id: int) -> bool:
+        """
+        True nếu đã ghi nhận vào buffer; False nếu chưa biết user -> caller upsert đồng bộ rồi remember().
+        """
+        bot_id = current_bot().id
+        with self.cond:
+            known = self.known.get(bot_id)
+            if known is None or chat_id not in known:
+                return False
+            known.move_to_end(chat_id)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="user-touch", daemon=True)
+                self.thread.start()
+            pending = self.pending.setdefault(bot_id, {})
+            pending[chat_id] = datetime.now(timezone.utc)
+            if len(pending) >= self.batch_max:
+                self.cond.notify()
+        return True
+
+    def remember(self, chat_id: int):
+        with self.cond:
+            known = self.known.setdefault(current_bot().id, OrderedDict())
+            known[chat_id] = None
+            known.move_to_end(chat_id)
+            while len(known) > self.known_size:
+                known.popitem(last=False)
+
+    def depth(self) -> int:
+        return sum(len(p) for p in list(self.pending.values()))
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: any(len(p) >= self.batch_max for p in self.pending.values()),
+                                   timeout=self.interval)
+            self.flush()
+
+    def _restore(self, bot_id: str, rows):
+        with self.cond:
+            pending = self.pending.setdefault(bot_id, {})
+            for chat_id, seen in rows:
+                if pending.get(chat_id, seen) <= seen:
+                    pending[chat_id] = seen
+
+    def flush(self) -> bool:
+        """
+        Ghi hết buffer. Trả False nếu DB lỗi (phần chưa ghi đã quay lại buffer).
+        """
+        with self.cond:
+            pending, self.pending = self.pending, {}
+        ok = True
+        for bot_id, touches in pending.items():
+            rows = sorted(touches.items())
+            for i in range(0, len(rows), self.batch_max):
+                chunk = rows[i:i + self.batch_max]
+                sql = SQL_TOUCH_USERS.format(values=", ".join(["(%s, %s)"] * len(chunk)))
+                params = [v for row in chunk for v in row]
+                try:
+                    with use_bot(bots[bot_id]):
+                        db_run(lambda cur: cur.execute(sql, params), name="touch_users")
+                except Exception as e:
+                    log("error", "db.touch_users_error", bot=bot_id, err=repr(e))
+                    self._restore(bot_id, rows[i:])
+                    ok = False
+                    break
+                self.written += len(chunk)
+        return ok
+
+
+user_touches = UserTouchBuffer(USER_TOUCH_INTERVAL, USER_TOUCH_BATCH, USER_KNOWN_CACHE)
+atexit.register(user_touches.flush)
+
+
+class UserCounter:
+    """
+    Đếm user không COUNT(*) mỗi lần bấm Stats:
+    - tổng: đọc DB tối đa 1 lần / ttl giây, giữa 2 lần đọc cộng dần khi upsert_user insert user mới
+    - breakdown (mới hôm nay, hoạt động 24h/7 ngày): query theo index first_seen/last_seen, cũng cache ttl giây
+    Nhiều worker: mỗi worker có cache riêng, lệch tối đa ttl giây.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self.total = None
+        self.total_at = 0.0
+        self.extra = None
+        self.extra_at = 0.0
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()    # 1 query làm mới mỗi lúc, không giữ self.lock khi query
+
+    def on_new_user(self):
+        with self.lock:
+            if self.total is not None:
+                self.total += 1
+            if self.extra is not None:
+                self.extra = (self.extra[0] + 1, self.extra[1] + 1, self.extra[2] + 1, self.extra[3])
+
+    def on_inactive(self, n: int):
+        with self.lock:
+            if self.total is not None:
+                self.total = max(0, self.total - n)
+            if self.extra is not None:
+                self.extra = self.extra[:3] + (self.extra[3] + n,)
+
+    def total_users(self) -> int:
+        def _q(cur):
+            cur.execute(SQL_COUNT_USERS, prepare=DB_PREPARE)
+            row = cur.fetchone()
+            return int(row[0]) if row else 0
+
+        return self._cached("total", lambda: db_run(_q, name="count_users"))
+
+    def breakdown(self):
+        """
+        (mới hôm nay, hoạt động 24h, hoạt động 7 ngày, đã chặn bot/không còn tồn tại)
+        """
+        def _q(cur):
+            cur.execute(SQL_USER_BREAKDOWN, {"tz": STATS_TZ})
+            return tuple(int(x) for x in cur.fetchone())
+
+        return self._cached("extra", lambda: db_run(_q, name="user_breakdown"))
+
+    def _cached(self, key: str, fetch):
+        """
+        Cache (self.<key>, self.<key>_at) còn hạn -> trả luôn. Hết hạn -> 1 thread query, thread khác chờ kết quả đó.
+        Query chạy ngoài self.lock: on_new_user / on_inactive ở luồng xử lý update không phải chờ query thống kê
+        (user mới trong lúc query có thể lệch 1-2, tự đúng lại sau ttl giây).
+        """
+        with self.lock:
+            if getattr(self, key) is not None and time.monotonic() - getattr(self, key + "_at") < self.ttl:
+                return getattr(self, key)
+        with self.refresh_lock:
+            with self.lock:
+                # thread khác vừa query xong trong lúc chờ
+                if getattr(self, key) is not None and time.monotonic() - getattr(self, key + "_at") < self.ttl:
+                    return getattr(self, key)
+            value = fetch()
+            with self.lock:
+                setattr(self, key, value)
+                setattr(self, key + "_at", time.monotonic())
+            return value
+
+
+user_counter = BotScoped("user_counter")
 
 
 def count_users() -> int:
     if not DATABASE_URL:
         return 0
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM users")
-                row = cur.fetchone()
-                return int(row[0]) if row else 0
+        return user_counter.total_users()
     except Exception as e:
-        print("[DB] count_users error:", repr(e))
+        log("error", "db.count_users_error", err=repr(e))
         return 0
 
 
-def get_all_users():
+def user_stats_text() -> str:
+    text = f"👥 Tổng user đang hoạt động: {count_users()}"
     if not DATABASE_URL:
-        return []
+        return text
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT chat_id FROM users")
-                return [row[0] for row in cur.fetchall()]
+        new_today, active_24h, active_7d, inactive = user_counter.breakdown()
     except Exception as e:
-        print("[DB] get_all_users error:", repr(e))
-        return []
+        log("error", "db.user_breakdown_error", err=repr(e))
+        return text
+    return (
+        text + "\n"
+        f"🆕 Mới hôm nay: {new_today}\n"
+        f"🔥 Hoạt động 24h: {active_24h}\n"
+        f"📅 Hoạt động 7 ngày: {active_7d}\n"
+        f"🚫 Đã chặn bot / không còn: {inactive}"
+    )
 
 
-def is_admin(chat_id: int) -> bool:
-    return bool(ADMIN_CHAT_ID) and chat_id == ADMIN_CHAT_ID
+def classify_send_error(e):
+    """
+    Lỗi gửi tin có nghĩa là chat không bao giờ nhận được nữa -> lý do (lưu vào users.inactive_reason).
+    Lỗi tạm thời (mạng, 429, 5xx...) -> None.
+    """
+    if not isinstance(e, ApiTelegramException) or e.error_code not in (400, 403):
+        return None
+    desc = (e.description or "").lower()
+    if "blocked by the user" in desc:
+        return "blocked"
+    if "user is deactivated" in desc:
+        return "deactivated"
+    if "chat not found" in desc:
+        return "chat_not_found"
+    if "kicked" in desc or "not a member" in desc:
+        return "kicked"
+    return None
+
+
+def mark_users_inactive(chat_ids, reason: str) -> int:
+    """
+    Đánh dấu nhiều chat không còn nhận tin (1 câu UPDATE). User /start lại -> upsert_user bật lại is_active.
+    """
+    if not DATABASE_URL or not chat_ids:
+        return 0
 
+    def _q(cur):
+        cur.execute(SQL_MARK_INACTIVE, (reason, list(chat_ids)))
+        return cur.rowcount
+
+    n = db_run(_q, name="mark_inactive")
+    user_counter.on_inactive(n)
+    return n
+
+
+# Phân khúc người nhận broadcast: {key: (nhãn, segment)}
+AUDIENCE_SEGMENTS = {
+    "all": ("Tất cả", {}),
+    "a7": ("Hoạt động 7 ngày", {"active_days": 7}),
+    "a30": ("Hoạt động 30 ngày", {"active_days": 30}),
+    "n7": ("User mới 7 ngày", {"new_days": 7}),
+}
+
+
+def _segment_where(segment: dict):
+    """
+    segment -> (điều kiện SQL thêm vào WHERE, params).
+    active_days: last_seen trong N ngày | new_days: first_seen trong N ngày | first_seen_after: ISO datetime
+    """
+    clauses, params = [], []
+    segment = segment or {}
+    if segment.get("active_days"):
+        clauses.append("last_seen >= NOW() - make_interval(days => %s)")
+        params.append(int(segment["active_days"]))
+    if segment.get("new_days"):
+        clauses.append("first_seen >= NOW() - make_interval(days => %s)")
+        params.append(int(segment["new_days"]))
+    if segment.get("first_seen_after"):
+        clauses.append("first_seen > %s::timestamptz")
+        params.append(segment["first_seen_after"])
+    return "".join(" AND " + c for c in clauses), params
+
+
+def iter_audience(segment: dict = None, page_size: int = BROADCAST_PAGE_SIZE):
+    """
+    Duyệt chat_id theo trang (keyset: chat_id > chat_id cuối của trang trước, ORDER BY chat_id dùng PK).
+    Mỗi trang là 1 query ngắn -> không giữ connection/transaction suốt broadcast, bộ nhớ = 1 trang,
+    và broadcast có thể dừng ở ranh giới trang bất kỳ.
+    """
+    if not DATABASE_URL:
+        return
+    where, params = _segment_where(segment)
+    sql = SQL_AUDIENCE_PAGE.format(where=where)
+    after = -(2 ** 63)
+    while True:
+        def _q(cur):
+            cur.execute(sql, (after, *params, page_size), prepare=DB_PREPARE)
+            return [row[0] for row in cur.fetchall()]
+
+        page = db_run(_q, name="audience_page")
+        if not page:
+            return
+        yield page
+        if len(page) < page_size:
+            return
+        after = page[-1]
+
+
+def count_audience(segment: dict = None) -> int:
+    where, params = _segment_where(segment)
+    if not where:
+        return count_users()
+    if not DATABASE_URL:
+        return 0
+
+    def _q(cur):
+        cur.execute("SELECT COUNT(*) FROM users WHERE is_active" + where, params)
+        return int(cur.fetchone()[0])
 
-# Init DB (safe)
-if not DATABASE_URL:
-    print("❌ DATABASE_URL chưa có. Vào Render > Service > Environment thêm DATABASE_URL.")
-else:
     try:
-        init_db()
-        print("✅ Postgres users table ready.")
+        return db_run(_q, name="count_audience")
     except Exception as e:
-        print("❌ init_db error:", repr(e))
+        log("error", "db.count_audience_error", err=repr(e))
+        return 0
+
+
+def is_admin(chat_id: int) -> bool:
+    admin_chat_id = current_bot().admin_chat_id
+    return bool(admin_chat_id) and chat_id == admin_chat_id
+
+
+# ============ STATE HỘI THOẠI (MEMORY / POSTGRES, CÓ TTL) ============
+
+class UserFlow:
+    """
+    State của user trong flow: WAITING_USERNAME -> WAITING_RECEIPT -> WAITING_GAME.
+    lead_id: dòng bot_leads của lượt này | receipt_dup_of: bill trùng với lead nào (nếu có).
+    receipt_kind: bill gửi dạng "photo" hay "document" (None = photo, state lưu trước khi có field này).
+    """
+    __slots__ = ("state", "username_game", "receipt_file_id", "lead_id", "receipt_dup_of", "receipt_kind")
+
+    def __init__(self, state: str, username_game: str = None, receipt_file_id: str = None,
+                 lead_id: str = None, receipt_dup_of: str = None, receipt_kind: str = None):
+        self.state = state
+        self.username_game = username_game
+        self.receipt_file_id = receipt_file_id
+        self.lead_id = lead_id
+        self.receipt_dup_of = receipt_dup_of
+        self.receipt_kind = receipt_kind
+
+    def pack(self):
+        return [self.state, self.username_game, self.receipt_file_id, self.lead_id, self.receipt_dup_of,
+                self.receipt_kind]
+
+    @classmethod
+    def unpack(cls, data):
+        return cls(*data)
+
+
+class AdminDraft:
+    """
+    State admin đang soạn broadcast: mode + payload (text/photo/video) + phân khúc người nhận (key AUDIENCE_SEGMENTS).
+    """
+    __slots__ = ("mode", "payload", "segment")
+
+    def __init__(self, mode: str, payload: dict = None, segment: str = "all"):
+        self.mode = mode
+        self.payload = payload
+        self.segment = segment
+
+    def pack(self):
+        return [self.mode, self.payload, self.segment]
+
+    @classmethod
+    def unpack(cls, data):
+        return cls(*data)
+
+
+class MemoryStateStore:
+    """
+    State trong RAM của 1 process, mỗi entry có hạn (TTL). Chỉ đúng khi chạy 1 worker.
+    Lưu giá trị đã pack (list/bool) -> gọn hơn dict tự do.
+    """
+
+    def __init__(self):
+        self.data = {}      # {(scope, chat_id): (expires_at, value)}
+        self.lock = threading.Lock()
+
+    def get(self, scope: str, chat_id: int):
+        entry = self.data.get((scope, chat_id))
+        if entry is None:
+            return None
+        if entry[0] < time.time():
+            self.delete(scope, chat_id)
+            return None
+        return entry[1]
+
+    def set(self, scope: str, chat_id: int, value, ttl: int):
+        with self.lock:
+            self.data[(scope, chat_id)] = (time.time() + ttl, value)
+
+    def delete(self, scope: str, chat_id: int):
+        with self.lock:
+            self.data.pop((scope, chat_id), None)
+
+    def evict_expired(self) -> int:
+        now = time.time()
+        with self.lock:
+            dead = [k for k, (exp, _) in self.data.items() if exp < now]
+            for k in dead:
+                del self.data[k]
+        return len(dead)
+
+    def size(self) -> int:
+        return len(self.data)
+
+
+class PostgresStateStore:
+    """
+    State lưu ở bảng conv_state (DATABASE_URL) -> mọi worker gunicorn thấy cùng state.
+    Có cache đọc cục bộ nhỏ (LRU, STATE_CACHE_TTL giây); ghi thì ghi thẳng DB + cập nhật cache.
+    """
+
+    def __init__(self, cache_ttl: float, cache_size: int):
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # {(scope, chat_id): (cached_at, expires_at, value)}
+        self.lock = threading.Lock()
+
+    def _cache_put(self, key, expires_at, value):
+        if self.cache_ttl <= 0:
+            return
+        with self.lock:
+            self.cache[key] = (time.time(), expires_at, value)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def get(self, scope: str, chat_id: int):
+        key = (scope, chat_id)
+        now = time.time()
+        with self.lock:
+            hit = self.cache.get(key)
+        if hit is not None and now - hit[0] < self.cache_ttl:
+            return hit[2] if hit[1] > now else None
+
+        def _q(cur):
+            cur.execute(
+                "SELECT data, EXTRACT(EPOCH FROM expires_at) FROM conv_state "
+                "WHERE scope = %s AND chat_id = %s AND expires_at > NOW()",
+                (scope, chat_id),
+                prepare=DB_PREPARE,
+            )
+            return cur.fetchone()
+
+        row = db_run(_q, name="state_get")
+        if row is None:
+            self._cache_put(key, 0, None)
+            return None
+        self._cache_put(key, float(row[1]), row[0])
+        return row[0]
+
+    def set(self, scope: str, chat_id: int, value, ttl: int):
+        db_run(lambda cur: cur.execute(
+            """
+            INSERT INTO conv_state(scope, chat_id, data, expires_at)
+            VALUES (%s, %s, %s, NOW() + make_interval(secs => %s))
+            ON CONFLICT (scope, chat_id)
+            DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+            """,
+            (scope, chat_id, Jsonb(value), ttl),
+            prepare=DB_PREPARE,
+        ), name="state_set")
+        self._cache_put((scope, chat_id), time.time() + ttl, value)
+
+    def delete(self, scope: str, chat_id: int):
+        db_run(lambda cur: cur.execute(
+            "DELETE FROM conv_state WHERE scope = %s AND chat_id = %s",
+            (scope, chat_id),
+            prepare=DB_PREPARE,
+        ), name="state_delete")
+        self._cache_put((scope, chat_id), 0, None)
+
+    def evict_expired(self) -> int:
+        def _q(cur):
+            cur.execute("DELETE FROM conv_state WHERE expires_at < NOW()")
+            return cur.rowcount
+
+        with self.lock:
+            now = time.time()
+            for k in [k for k, v in self.cache.items() if v[1] < now]:
+                del self.cache[k]
+        return db_run(_q, name="state_evict")
+
+    def size(self) -> int:
+        return len(self.cache)
+
+
+def make_state_store():
+    if STATE_BACKEND == "postgres":
+        if not DATABASE_URL:
+            log("warning", "state.no_db", "STATE_BACKEND=postgres nhưng thiếu DATABASE_URL -> dùng memory")
+        else:
+            return PostgresStateStore(STATE_CACHE_TTL, STATE_CACHE_SIZE)
+    return MemoryStateStore()
+
+
+state_store = BotScoped("state_store")
+
+
+def _state_sweep_loop():
+    while True:
+        time.sleep(STATE_SWEEP_INTERVAL)
+        for rt in bots.values():
+            try:
+                with use_bot(rt):
+                    state_store.evict_expired()
+            except Exception as e:
+                log("error", "state.evict_error", bot=rt.id, err=repr(e))
+
+
+def get_user_flow(chat_id: int):
+    data = state_store.get("user", chat_id)
+    return UserFlow.unpack(data) if data else None
+
+
+def set_user_flow(chat_id: int, flow):
+    if flow is None:
+        state_store.delete("user", chat_id)
+    else:
+        state_store.set("user", chat_id, flow.pack(), USER_STATE_TTL)
+
+
+def get_admin_draft(chat_id: int):
+    data = state_store.get("admin", chat_id)
+    return AdminDraft.unpack(data) if data else None
+
+
+def set_admin_draft(chat_id: int, draft):
+    if draft is None:
+        state_store.delete("admin", chat_id)
+    else:
+        state_store.set("admin", chat_id, draft.pack(), ADMIN_STATE_TTL)
+
+
+def admin_mode(chat_id: int):
+    draft = get_admin_draft(chat_id)
+    return draft.mode if draft else None
+
+
+def getid_enabled(chat_id: int) -> bool:
+    return bool(state_store.get("getid", chat_id))
+
+
+def set_getid(chat_id: int, enabled: bool):
+    if enabled:
+        state_store.set("getid", chat_id, True, GETID_TTL)
+    else:
+        state_store.delete("getid", chat_id)
+
+
+# ============ MEDIA REGISTRY (TÊN ẢNH -> FILE_ID) ============
+
+# file_id mặc định (lấy bằng /getid). Đổi ảnh: reply vào ảnh mới bằng /setmedia <tên>
+# file_id gắn với bot đã upload -> mỗi brand (mỗi bot) 1 bộ
+BRAND_MEDIA = {
+    "u888u": {
+        "welcome": "AgACAgUAAxkBAANRaaL4LVK8dSDX1UahnrRSsOTMMzEAAlMRaxuw1hhVx2resvJZOuQBAAMCAAN5AAM6BA",
+        "register": "AgACAgUAAxkBAAMtaaLyZrV1tDiNTPxSWOvKBQbciicAAk8Raxuw1hhVlMruFA81BtEBAAMCAAN5AAM6BA",
+        "ask_username": "AgACAgUAAxkBAANLaaL4HZUlbi3ACLs9QunVSI-HQAADUBFrG7DWGFXn-RTioxpqWgEAAwIAA3kAAzoE",
+        "username_received": "AgACAgUAAxkBAANNaaL4Iq88aw9msu4h--gX0zzgLiIAAlERaxuw1hhVB78TvJHpCpkBAAMCAAN5AAM6BA",
+    },
+    "u88top": {
+        "welcome": "AgACAgUAAxkBAAIBbWkln42l0QufAXVKVmH_Qa6oeFhZAALxDGsbpw8pVY05zyDcJpCbAQADAgADeQADNgQ",
+        "register": "AgACAgUAAxkBAAIBl2klrFRo8Jc_nRjNC5lYhd6W2C7QAAIEDWsbpw8pVU1UjNopuH29AQADAgADeQADNgQ",
+        "ask_username": "AgACAgUAAxkBAAIBa2kln2_x2fvUTdTJH7U4Kl2Z-AABUwAC8AxrG6cPKVVZLLurvibZGAEAAwIAA3kAAzYE",
+        "username_received": "AgACAgUAAxkBAAIBbWkln42l0QufAXVKVmH_Qa6oeFhZAALxDGsbpw8pVY05zyDcJpCbAQADAgADeQADNgQ",
+    },
+}
+
+
+class MediaRegistry:
+    """
+    Quản lý ảnh dùng trong flow theo tên logic:
+    - file_id lưu ở bảng media_assets (nếu có DB), mặc định lấy BRAND_MEDIA của brand
+    - kiểm tra file_id bằng getFile lúc khởi động (và định kỳ nếu MEDIA_CHECK_INTERVAL > 0)
+    - negative cache: file_id hỏng -> safe_send_photo gửi text luôn trong MEDIA_NEGATIVE_TTL giây
+    - có ảnh gốc trong MEDIA_DIR -> tự upload lại (gửi vào chat admin) và lưu file_id mới
+    """
+
+    def __init__(self, defaults: dict, media_dir: str):
+        self.ids = dict(defaults)
+        self.media_dir = media_dir
+        self.bad = {}       # {file_id: hết hạn (time.time())}
+        self.reuploading = set()    # tên đang upload lại -> mỗi tên chỉ 1 lượt upload cùng lúc
+        self.lock = threading.Lock()
+
+    def get(self, name: str) -> str:
+        return self.ids.get(name)
+
+    def names(self):
+        return list(self.ids)
+
+    def is_bad(self, file_id: str) -> bool:
+        until = self.bad.get(file_id)
+        if until is None:
+            return False
+        if until < time.time():
+            self.bad.pop(file_id, None)
+            return False
+        return True
+
+    def mark_bad(self, file_id: str):
+        with self.lock:
+            self.bad[file_id] = time.time() + MEDIA_NEGATIVE_TTL
+            # nhiều lượt gửi cùng gặp file_id hỏng -> chỉ lượt đầu upload lại
+            names = [name for name, fid in self.ids.items() if fid == file_id and name not in self.reuploading]
+            self.reuploading.update(names)
+        for name in names:
+            bot_thread(self._reupload, name, daemon=True).start()
+
+    def set(self, name: str, file_id: str):
+        with self.lock:
+            self.ids[name] = file_id
+            self.bad.pop(file_id, None)
+        if DATABASE_URL:
+            db_run(lambda cur: cur.execute(
+                """
+                INSERT INTO media_assets(name, file_id) VALUES (%s, %s)
+                ON CONFLICT (name) DO UPDATE SET file_id = EXCLUDED.file_id, updated_at = NOW()
+                """,
+                (name, file_id),
+            ), name="media_set")
+
+    def load(self):
+        """
+        Lấy file_id đã lưu trong DB (ảnh đã đổi/upload lại ở lần chạy trước).
+        """
+        if not DATABASE_URL:
+            return
+
+        def _q(cur):
+            cur.execute("SELECT name, file_id FROM media_assets")
+            return cur.fetchall()
+
+        with self.lock:
+            self.ids.update(dict(db_run(_q, name="media_load")))
+
+    def local_file(self, name: str):
+        for ext in (".jpg", ".jpeg", ".png"):
+            path = os.path.join(self.media_dir, name + ext)
+            if os.path.isfile(path):
+                return path
+        return None
+
+    def reupload(self, name: str) -> bool:
+        with self.lock:
+            if name in self.reuploading:
+                return False    # thread khác đang upload lại tên này
+            self.reuploading.add(name)
+        return self._reupload(name)
+
+    def _reupload(self, name: str) -> bool:
+        # gọi khi đã giữ chỗ name trong self.reuploading
+        try:
+            path = self.local_file(name)
+            admin_chat_id = current_bot().admin_chat_id
+            if not path or not admin_chat_id:
+                return False
+            with open(path, "rb") as f, outbound_priority(PRIO_ADMIN):
+                msg = bot.send_photo(admin_chat_id, f, caption=f"[media] upload lại: {name}", disable_notification=True)
+            self.set(name, msg.photo[-1].file_id)
+            log("info", "media.reuploaded", name=name, file_id=msg.photo[-1].file_id)
+            return True
+        except Exception as e:
+            log("error", "media.reupload_error", name=name, err=repr(e))
+            return False
+        finally:
+            with self.lock:
+                self.reuploading.discard(name)
+
+    def validate(self, name: str) -> bool:
+        file_id = self.ids.get(name)
+        if not file_id:
+            return False
+        try:
+            bot.get_file(file_id)
+            return True
+        except Exception as e:
+            if not is_bad_file_error(e):
+                # lỗi mạng/429: chưa kết luận được, lần sau kiểm tra lại
+                log("warning", "media.check_error", name=name, err=repr(e))
+                return True
+            log("warning", "media.bad_file_id", name=name)
+            with self.lock:
+                self.bad[file_id] = time.time() + MEDIA_NEGATIVE_TTL
+            return self.reupload(name)
+
+    def validate_all(self):
+        return {name: self.validate(name) for name in self.names()}
+
+    def status_text(self) -> str:
+        lines = []
+        for name in self.names():
+            fid = self.ids[name]
+            mark = "❌" if self.is_bad(fid) else "✅"
+            local = " (có ảnh gốc)" if self.local_file(name) else ""
+            lines.append(f"{mark} {name}{local}: {fid[:24]}…")
+        return "\n".join(lines)
+
+
+media = BotScoped("media")
+
+
+def _media_check_loop():
+    while True:
+        for rt in bots.values():
+            with use_bot(rt):
+                try:
+                    media.load()
+                except Exception as e:
+                    log("error", "media.load_error", bot=rt.id, err=repr(e))
+                with outbound_priority(PRIO_ADMIN):
+                    media.validate_all()
+        if MEDIA_CHECK_INTERVAL <= 0:
+            return
+        time.sleep(MEDIA_CHECK_INTERVAL)
+
+
+# ============ TEMPLATE TIN NHẮN (DỰNG SẴN 1 LẦN) ============
+
+class FrozenMarkup(types.JsonSerializable):
+    """
+    Bàn phím đã JSON-encode sẵn. telebot gọi to_json() mỗi lần gửi -> trả luôn chuỗi có sẵn.
+    """
+    __slots__ = ("json",)
+
+    def __init__(self, markup):
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+
+class _KeepField(dict):
+    # format_map chỉ điền field của brand, field động giữ nguyên "{field}" để điền lúc gửi
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+
+class MessageTemplate:
+    """
+    1 tin nhắn tĩnh: text (đã điền brand), parse_mode, bàn phím đã serialize, tên ảnh trong media registry.
+    """
+    __slots__ = ("name", "text", "parse_mode", "markup", "media", "dynamic")
+
+    def __init__(self, name: str, text: str, parse_mode=None, markup=None, media_name: str = None):
+        self.name = name
+        self.text = text
+        self.parse_mode = parse_mode
+        self.markup = FrozenMarkup(markup) if markup is not None else None
+        self.media = media_name
+        self.dynamic = "{" in text
+
+    def render(self, **fields) -> str:
+        return self.text.format(**fields) if self.dynamic else self.text
+
+
+class TemplateRegistry:
+    """
+    Tên -> MessageTemplate, dựng 1 lần lúc khởi động theo brand. Handler chỉ gọi send(chat_id, tên, field động).
+    """
+
+    def __init__(self, brand: dict):
+        self.brand = brand
+        self.items = {}
+
+    def add(self, name: str, text: str, parse_mode=None, markup=None, media_name: str = None):
+        text = text.format_map(_KeepField(brand=self.brand["name"], **self.brand))
+        self.items[name] = MessageTemplate(name, text, parse_mode, markup, media_name)
+
+    def get(self, name: str) -> MessageTemplate:
+        return self.items[name]
+
+    def send(self, chat_id: int, name: str, **fields):
+        tpl = self.items[name]
+        text = tpl.render(**fields)
+        if tpl.media:
+            return safe_send_photo(
+                chat_id, media.get(tpl.media), caption=text, reply_markup=tpl.markup, parse_mode=tpl.parse_mode
+            )
+        return bot.send_message(chat_id, text, reply_markup=tpl.markup, parse_mode=tpl.parse_mode)
+
+
+def _inline_rows(*rows):
+    kb = types.InlineKeyboardMarkup()
+    for row in rows:
+        kb.row(*[types.InlineKeyboardButton(label, callback_data=data) for label, data in row])
+    return kb
+
+
+def build_templates(brand: dict) -> TemplateRegistry:
+    reg = TemplateRegistry(brand)
+
+    # --- flow khách ---
+    reg.add(
+        "welcome",
+        "👋 Chào anh/chị!\n"
+        "Em là Bot hỗ trợ nhận CODE ưu đãi {brand}.\n\n"
+        "👉 Anh/chị đã có tài khoản chơi {brand} chưa ạ?\n\n"
+        "Chỉ cần bấm nút bên dưới: ĐÃ CÓ hoặc CHƯA CÓ, em hỗ trợ ngay!",
+        markup=_inline_rows(
+            [("✅ ĐÃ CÓ TÀI KHOẢN", "have_account")],
+            [("🆕 CHƯA CÓ – ĐĂNG KÝ NGAY", "no_account")],
+        ),
+        media_name="welcome",
+    )
+    reg.add(
+        "register",
+        "Tuyệt vời, em gửi anh/chị link đăng ký nè 👇\n\n"
+        "🔗 Link đăng ký: {reg_link}\n\n"
+        "Anh/chị đăng ký xong bấm nút bên dưới để em hỗ trợ tiếp nhé.",
+        markup=_inline_rows([("✅ MÌNH ĐĂNG KÝ XONG RỒI", "registered_done")]),
+        media_name="register",
+    )
+    reg.add(
+        "ask_username",
+        "Dạ ok anh/chị ❤️\n\n"
+        "Anh/chị vui lòng gửi đúng *tên tài khoản* để em kiểm tra.\n\n"
+        "Ví dụ:\n"
+        "`abc123`",
+        parse_mode="Markdown",
+        media_name="ask_username",
+    )
+    reg.add(
+        "username_received",
+        "Em đã nhận được tên tài khoản: *{username_game}* ✅\n\n"
+        "Mình vào {brand} lên vốn theo mốc để nhận khuyến mãi giúp em nhé.\n\n"
+        "Lên thành công mình gửi *ảnh chuyển khoản* để em cộng điểm trực tiếp vào tài khoản cho mình ạ.\n\n"
+        "Có bất cứ thắc mắc gì nhắn tin trực tiếp cho CSKH {brand}:\n"
+        "👉 [{support_name}]({support_link})\n",
+        parse_mode="Markdown",
+        media_name="username_received",
+    )
+    reg.add(
+        "ask_tail",
+        "🔔Dạ mình vui lòng cho em xin *4 số đuôi* của tài khoản ngân hàng 🧾 với ạ!",
+        parse_mode="Markdown",
+    )
+    reg.add("ask_receipt", "Mình gửi *ảnh chuyển khoản* giúp em nhé ạ.", parse_mode="Markdown")
+    reg.add("lead_received", "✅ Em đã nhận đủ thông tin, em xử lý và cộng điểm cho mình ngay nhé ạ ❤️")
+    reg.add("lead_error", "⚠️ Em gửi thông tin bị lỗi, mình đợi em 1 chút hoặc nhắn CSKH giúp em nhé ạ.")
+
+    # --- admin ---
+    panel = types.ReplyKeyboardMarkup(resize_keyboard=True)
+    panel.row("📣 Broadcast", "📊 Stats")
+    panel.row("❌ Thoát")
+    reg.add("admin_panel", "🔧 Admin Panel", markup=panel)
+    reg.add("admin_exit", "Đã thoát admin.", markup=types.ReplyKeyboardRemove())
+    reg.add("admin_stats", "{stats}", markup=_inline_rows([("🔄 Làm mới", "STATS_REFRESH")]))
+    reg.add(
+        "broadcast_ask",
+        "📣 Hãy gửi *nội dung cần broadcast*.\n"
+        "✅ Hỗ trợ: *Text / Ảnh / Video* (có thể kèm caption).\n"
+        "Hủy: /cancel",
+        parse_mode="Markdown",
+    )
+    # xác nhận broadcast: mỗi phân khúc 1 bàn phím (đánh dấu phân khúc đang chọn)
+    for selected, (label, _) in AUDIENCE_SEGMENTS.items():
+        kb = types.InlineKeyboardMarkup()
+        kb.row(*[
+            types.InlineKeyboardButton(("• " if key == selected else "") + name, callback_data=f"BC_SEG:{key}")
+            for key, (name, _) in AUDIENCE_SEGMENTS.items()
+        ])
+        kb.add(
+            types.InlineKeyboardButton("✅ Xác nhận gửi", callback_data="BC_CONFIRM"),
+            types.InlineKeyboardButton("❌ Hủy", callback_data="BC_CANCEL")
+        )
+        reg.add(
+            f"broadcast_confirm:{selected}",
+            "Bạn sắp gửi đến *{count}* user (" + label + ").\n\n{preview}\n\nXác nhận?",
+            parse_mode="Markdown",
+            markup=kb,
+        )
+    return reg
+
+
+templates = BotScoped("templates")
+
+
+# ================== SETUP WEBHOOK (Render) ==================
+
+def webhook_settings() -> dict:
+    """
+    Cấu hình webhook mong muốn (tên khóa = tham số set_webhook = thuộc tính của getWebhookInfo).
+    """
+    return {
+        "url": current_bot().webhook_url,
+        "max_connections": WEBHOOK_MAX_CONNECTIONS,
+        "allowed_updates": ALLOWED_UPDATES,
+    }
+
+
+def _same_webhook_value(current, wanted) -> bool:
+    # allowed_updates: Telegram không hứa giữ thứ tự
+    if isinstance(wanted, list):
+        return sorted(current or []) == sorted(wanted)
+    return current == wanted
+
+
+def sync_webhook() -> bool:
+    """
+    getWebhookInfo khác cấu hình mong muốn mới set_webhook (set thẳng, không remove trước
+    -> không có lúc Telegram mất webhook). Trả True nếu có set lại.
+    """
+    want = webhook_settings()
+    info = bot.get_webhook_info()
+    diff = [k for k, v in want.items() if not _same_webhook_value(getattr(info, k, None), v)]
+    if not diff:
+        log("info", "webhook.unchanged", "webhook đã đúng cấu hình -> không set lại", bot=current_bot().id)
+        return False
+    ok = bot.set_webhook(**want)
+    log("info", "webhook.set", url=want["url"], changed=diff, ok=ok)
+    return True
+
+
+def setup_webhook():
+    """
+    Đảm bảo webhook của mọi bot đúng sau mỗi lần Render restart/deploy, chạy nền lúc khởi động.
+    Nhiều worker: worker giữ advisory lock mới kiểm tra, worker khác bỏ qua (không gọi API N lần).
+    """
+    if not WEBHOOK_URL:
+        log("info", "webhook.not_configured", "WEBHOOK_URL chưa cấu hình -> bỏ qua set webhook")
+        return
+    for rt in bots.values():
+        with use_bot(rt):
+            try:
+                if not DATABASE_URL:
+                    sync_webhook()
+                    continue
+                with db_conn() as conn, conn.transaction(), conn.cursor() as cur:
+                    cur.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", (f"bot:setup_webhook:{rt.id}",))
+                    if not cur.fetchone()[0]:
+                        log("info", "webhook.locked", "worker khác đang kiểm tra webhook -> bỏ qua", bot=rt.id)
+                        continue
+                    sync_webhook()
+            except Exception as e:
+                log("error", "webhook.set_error", bot=rt.id, err=repr(e))
+
+
+# ===================== EXPORT USERS (STREAM) =====================
+
+def iter_users_export(active_days: int = None):
+    """
+    Duyệt (chat_id, first_seen, last_seen) bằng server-side cursor, mỗi lần lấy EXPORT_FETCH_SIZE dòng
+    -> RAM không tăng theo số user. active_days: chỉ lấy user có last_seen trong N ngày gần nhất.
+    """
+    sql = "SELECT chat_id, first_seen, last_seen FROM users"
+    params = ()
+    if active_days:
+        sql += " WHERE last_seen >= NOW() - make_interval(days => %s)"
+        params = (active_days,)
+    sql += " ORDER BY chat_id"
+
+    with db_conn() as conn:
+        # server-side cursor (DECLARE) chỉ sống trong transaction
+        with conn.transaction():
+            with conn.cursor(name=f"export_{uuid.uuid4().hex[:8]}") as cur:
+                cur.itersize = EXPORT_FETCH_SIZE
+                cur.execute(sql, params)
+                yield from cur
+
+
+def build_users_export(fmt: str = "txt", active_days: int = None, compress: bool = False):
+    """
+    Ghi export vào SpooledTemporaryFile (mỗi lần export 1 buffer riêng -> 2 admin export cùng lúc không đè nhau).
+    Trả về (file_obj đã seek 0, số dòng).
+    """
+    buf = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX, mode="w+b")
+    raw = gzip.GzipFile(fileobj=buf, mode="wb") if compress else buf
+    out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    count = 0
+    try:
+        if fmt == "csv":
+            writer = csv.writer(out)
+            writer.writerow(["chat_id", "first_seen", "last_seen"])
+            for chat_id, first_seen, last_seen in iter_users_export(active_days):
+                writer.writerow([
+                    chat_id,
+                    first_seen.isoformat() if first_seen else "",
+                    last_seen.isoformat() if last_seen else "",
+                ])
+                count += 1
+        else:
+            for row in iter_users_export(active_days):
+                out.write(f"{row[0]}\n")
+                count += 1
+        out.flush()
+    finally:
+        out.detach()
+        if compress:
+            raw.close()
+    buf.seek(0)
+    return buf, count
+
+
+@dispatcher.command("export_users", "export_users_txt")
+def export_users_txt_cmd(message):
+    """
+    /export_users_txt           -> txt, mỗi dòng 1 chat_id
+    /export_users csv 30 gz     -> csv (chat_id, first_seen, last_seen), chỉ user hoạt động 30 ngày, nén gzip
+    """
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    if not DATABASE_URL:
+        return bot.send_message(chat_id, "⚠️ Chưa cấu hình DATABASE_URL.")
+
+    args = message.text.split()[1:]
+    fmt = "csv" if "csv" in args else "txt"
+    compress = "gz" in args
+    days = next((int(a) for a in args if a.isdigit()), None)
+
+    try:
+        buf, count = build_users_export(fmt, days, compress)
+    except Exception as e:
+        log("error", "export.error", err=repr(e))
+        return bot.send_message(chat_id, "⚠️ Export lỗi, thử lại sau.")
+
+    with buf:
+        if not count:
+            return bot.send_message(chat_id, "⚠️ Chưa có user nào trong database.")
+        filename = f"users_export.{fmt}" + (".gz" if compress else "")
+        note = f" (hoạt động {days} ngày gần nhất)" if days else ""
+        bot.send_document(chat_id, buf, caption=f"✅ Export xong: {count} users{note}", visible_file_name=filename)
+
+
+# ============ KEEP ALIVE ============
+
+def keep_alive():
+    if not PING_URL:
+        log("info", "keep_alive.disabled", "PING_URL chưa cấu hình, không bật keep-alive")
+        return
+    log("info", "keep_alive.start", url=PING_URL, interval=PING_INTERVAL)
+    while True:
+        try:
+            r = http_session.get(PING_URL)
+            log("debug", "keep_alive.ping", url=PING_URL, status=r.status_code)
+        except Exception as e:
+            log("warning", "keep_alive.error", err=repr(e))
+        time.sleep(PING_INTERVAL)
+
+
+if ENABLE_KEEP_ALIVE:
+    threading.Thread(target=keep_alive, daemon=True).start()
+
+
+# ============ DEBUG GET FILE_ID ============
+
+@dispatcher.command("getid")
+def enable_getid(message):
+    chat_id = message.chat.id
+    set_getid(chat_id, True)
+    bot.send_message(
+        chat_id,
+        "✅ Đã bật chế độ lấy FILE_ID.\n"
+        "Gửi ảnh/video/file, bot sẽ trả FILE_ID.\n"
+        "Tắt bằng /stopgetid",
+        parse_mode="Markdown"
+    )
+
+
+@dispatcher.command("stopgetid")
+def disable_getid(message):
+    chat_id = message.chat.id
+    set_getid(chat_id, False)
+    bot.send_message(chat_id, "🛑 Đã tắt chế độ lấy FILE_ID.")
+
+
+# ============ BROADCAST ENGINE (CHẠY NỀN) ============
+
+class TokenBucket:
+    """
+    Token bucket thread-safe: acquire() chặn tới khi có token.
+    pause(s): Telegram trả 429 -> dừng cả bucket s giây (mọi worker cùng chờ).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = max(rate, 0.1)
+        self.capacity = capacity or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds: float):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class PerChatLimiter:
+    """
+    Giới hạn tốc độ gửi vào từng chat (Telegram ~1 msg/s mỗi chat).
+    Chỉ giữ chat vừa gửi gần đây -> dict không phình theo số user.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.next_at = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, chat_id: int):
+        with self.lock:
+            now = time.monotonic()
+            if len(self.next_at) > 10000:
+                self.next_at = {k: v for k, v in self.next_at.items() if v > now}
+            at = max(now, self.next_at.get(chat_id, 0.0))
+            self.next_at[chat_id] = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+
+class BroadcastJob:
+    __slots__ = ("id", "bot_id", "payload", "segment", "admin_chat_id", "status", "total", "sent", "failed",
+                 "pruned", "pruned_pending", "started_at", "finished_at", "cancelled", "lock")
+
+    def __init__(self, payload: dict, admin_chat_id: int, segment: dict = None):
+        self.id = uuid.uuid4().hex[:8]
+        self.bot_id = current_bot().id
+        self.payload = payload
+        self.segment = segment or {}
+        self.admin_chat_id = admin_chat_id
+        self.cancelled = False
+        self.status = "queued"
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.pruned = 0
+        self.pruned_pending = {}    # {reason: [chat_id]} chờ ghi DB theo lô
+        self.started_at = None
+        self.finished_at = None
+        self.lock = threading.Lock()
+
+    def summary(self) -> str:
+        took = (self.finished_at or time.time()) - (self.started_at or time.time())
+        return (
+            f"Job {self.id}: {self.status}\n"
+            f"Sent: {self.sent}/{self.total}\nFailed: {self.failed} (đã loại {self.pruned} chat chặn bot/không còn)\n"
+            f"Thời gian: {took:.0f}s"
+        )
+
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+broadcast_chat_limiter = PerChatLimiter(BROADCAST_PER_CHAT_INTERVAL)
+broadcast_jobs = {}          # {job_id: BroadcastJob} - chỉ giữ vài job gần nhất (mọi bot)
+_broadcast_executor = None
+_broadcast_lock = threading.Lock()
+
+
+def _get_broadcast_executor() -> ThreadPoolExecutor:
+    global _broadcast_executor
+    with _broadcast_lock:
+        if _broadcast_executor is None:
+            _broadcast_executor = ThreadPoolExecutor(max_workers=BROADCAST_WORKERS, thread_name_prefix="broadcast")
+        return _broadcast_executor
+
+
+def send_broadcast_payload(uid: int, payload: dict):
+    if payload["type"] == "text":
+        bot.send_message(uid, payload["text"], disable_web_page_preview=True)
+    elif payload["type"] == "photo":
+        bot.send_photo(uid, payload["file_id"], caption=payload.get("caption") or None)
+    elif payload["type"] == "video":
+        bot.send_video(uid, payload["file_id"], caption=payload.get("caption") or None)
+    else:
+        raise ValueError("Unsupported payload type")
+
+
+# kết quả "lỗi tạm, gửi lại sau" (không phải lý do chat không còn nhận tin)
+BROADCAST_RETRY_LATER = "retry_later"
+
+
+def _broadcast_send_one(payload: dict, uid: int):
+    """
+    -> (gửi được?, lý do chat không còn nhận tin | BROADCAST_RETRY_LATER | None)
+    Lỗi tạm (mạng, 5xx, breaker mở) -> chờ backoff có jitter rồi gửi lại; hết lượt mà vẫn lỗi tạm
+    -> BROADCAST_RETRY_LATER. Read timeout: tin có thể đã tới -> không gửi lại (giống OutboundGate).
+    """
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        broadcast_bucket.acquire()
+        broadcast_chat_limiter.acquire(uid)
+        try:
+            with outbound_priority(PRIO_BULK):
+                send_broadcast_payload(uid, payload)
+            return True, None
+        except Exception as e:
+            retry_after = telegram_retry_after(e)
+            if retry_after and attempt < BROADCAST_MAX_RETRIES:
+                broadcast_bucket.pause(retry_after)
+                continue
+            transient = isinstance(e, TelegramUnavailable) or OutboundGate.is_transient(e)
+            if transient and isinstance(e, requests.Timeout) and not isinstance(e, requests.ConnectTimeout):
+                transient = False
+            if transient or retry_after:
+                if attempt < BROADCAST_MAX_RETRIES:
+                    time.sleep(random.uniform(
+                        0, min(OutboundGate.BACKOFF_CAP, OutboundGate.BACKOFF_BASE * (2 ** attempt))))
+                    continue
+                log("warning", "broadcast.send_deferred", chat_id=uid, err=repr(e))
+                return False, BROADCAST_RETRY_LATER
+            reason = classify_send_error(e)
+            if reason is None:
+                log("warning", "broadcast.send_failed", chat_id=uid, err=repr(e))
+            return False, reason
+    return False, None
+
+
+def _broadcast_send_as(rt, payload: dict, uid: int):
+    # executor broadcast dùng chung cho mọi bot -> task tự vào ngữ cảnh bot của job
+    with use_bot(rt):
+        return _broadcast_send_one(payload, uid)
+
+
+def bot_broadcast_jobs():
+    """
+    Job broadcast trong RAM của bot hiện tại (mới nhất sau cùng).
+    """
+    bot_id = current_bot().id
+    return [job for job in list(broadcast_jobs.values()) if job.bot_id == bot_id]
+
+
+def _flush_pruned(job: BroadcastJob):
+    with job.lock:
+        pruned, job.pruned_pending = job.pruned_pending, {}
+    for reason, chat_ids in pruned.items():
+        try:
+            job.pruned += mark_users_inactive(chat_ids, reason)
+        except Exception as e:
+            log("error", "broadcast.mark_inactive_error", err=repr(e))
+
+
+def _run_broadcast(job: BroadcastJob):
+    job.status = "running"
+    job.started_at = time.time()
+    executor = _get_broadcast_executor()
+    # giới hạn số task đang chờ trong executor -> bộ nhớ không phụ thuộc số user
+    inflight = threading.BoundedSemaphore(BROADCAST_WORKERS * 4)
+    rt = current_bot()
+
+    def _task(uid):
+        try:
+            ok, reason = _broadcast_send_as(rt, job.payload, uid)
+            BROADCAST_MESSAGES.inc("sent" if ok else (reason or "failed"))
+            with job.lock:
+                if ok:
+                    job.sent += 1
+                else:
+                    # job trong RAM không có chỗ lưu để gửi lại sau -> tính là lỗi
+                    job.failed += 1
+                    if reason and reason != BROADCAST_RETRY_LATER:
+                        job.pruned_pending.setdefault(reason, []).append(uid)
+        finally:
+            inflight.release()
+
+    try:
+        # lấy người nhận theo trang -> gửi được ngay từ trang đầu, dừng được ở ranh giới trang
+        for page in iter_audience(job.segment):
+            if job.cancelled:
+                break
+            job.total += len(page)
+            for uid in page:
+                inflight.acquire()
+                executor.submit(_task, uid)
+            _flush_pruned(job)
+        # chờ các task cuối cùng xong
+        for _ in range(BROADCAST_WORKERS * 4):
+            inflight.acquire()
+        _flush_pruned(job)
+        job.status = "cancelled" if job.cancelled else "done"
+    except Exception as e:
+        job.status = "error"
+        log("error", "broadcast.job_error", job=job.id, err=repr(e))
+    job.finished_at = time.time()
+
+    if job.admin_chat_id:
+        try:
+            bot.send_message(job.admin_chat_id, "✅ Broadcast xong.\n" + job.summary())
+        except Exception as e:
+            log("error", "broadcast.report_error", err=repr(e))
+
+
+def start_broadcast(payload: dict, admin_chat_id: int, segment: dict = None) -> BroadcastJob:
+    """
+    Tạo job broadcast và chạy nền, trả về ngay (không giữ request webhook).
+    Có DB -> ghi job + danh sách người nhận vào Postgres, BroadcastQueue của mọi worker cùng gửi.
+    Không DB -> chạy trong process này (_run_broadcast), restart là mất.
+    """
+    job = BroadcastJob(payload, admin_chat_id, segment)
+    broadcast_jobs[job.id] = job
+    for old_id in list(broadcast_jobs)[:-20]:
+        broadcast_jobs.pop(old_id, None)
+    target = _enqueue_broadcast if DATABASE_URL else _run_broadcast
+    bot_thread(target, job, name=f"broadcast-{job.id}", daemon=True).start()
+    return job
+
+
+# --- Hàng đợi broadcast bền (Postgres): nhiều worker / instance cùng gửi, restart thì gửi tiếp ---
+
+SQL_BC_CREATE = """
+    INSERT INTO broadcast_jobs (id, payload, segment, admin_chat_id, status, started_at)
+    VALUES (%s, %s, %s, %s, 'running', NOW())
+"""
+SQL_BC_FILL = """
+    INSERT INTO broadcast_deliveries (job_id, chat_id)
+    SELECT %s, chat_id FROM users WHERE is_active{where}
+    ON CONFLICT DO NOTHING
+"""
+SQL_BC_SET_TOTAL = "UPDATE broadcast_jobs SET total = %s WHERE id = %s"
+SQL_BC_NEXT_JOB = "SELECT id, payload FROM broadcast_jobs WHERE status = 'running' ORDER BY created_at LIMIT 1"
+# SKIP LOCKED: worker khác đang nhận lô thì bỏ qua dòng đó thay vì chờ -> các worker nhận các lô khác nhau.
+# Dòng 'sending' quá lease (worker chết giữa chừng) được nhận lại -> tối đa 1 lô có thể gửi trùng.
+SQL_BC_CLAIM = """
+    WITH batch AS (
+        SELECT chat_id FROM broadcast_deliveries
+        WHERE job_id = %(job)s
+          AND (status = 'pending' OR (status = 'sending' AND claimed_at < NOW() - make_interval(secs => %(lease)s)))
+        ORDER BY chat_id
+        LIMIT %(n)s
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE broadcast_deliveries d
+    SET status = 'sending', claimed_at = NOW(), attempts = d.attempts + 1
+    FROM batch
+    WHERE d.job_id = %(job)s AND d.chat_id = batch.chat_id
+      AND EXISTS (SELECT 1 FROM broadcast_jobs j WHERE j.id = %(job)s AND j.status = 'running')
+    RETURNING d.chat_id
+"""
+SQL_BC_MARK = "UPDATE broadcast_deliveries SET status = %s WHERE job_id = %s AND chat_id = ANY(%s)"
+SQL_BC_PROGRESS = "UPDATE broadcast_jobs SET sent = sent + %s, failed = failed + %s, pruned = pruned + %s WHERE id = %s"
+# chỉ 1 worker nhận được RETURNING -> worker đó báo admin
+SQL_BC_FINISH = """
+    UPDATE broadcast_jobs SET status = 'done', finished_at = NOW()
+    WHERE id = %s AND status = 'running'
+      AND NOT EXISTS (
+          SELECT 1 FROM broadcast_deliveries WHERE job_id = %s AND status IN ('pending', 'sending')
+      )
+    RETURNING admin_chat_id
+"""
+SQL_BC_CANCEL = "UPDATE broadcast_jobs SET status = 'cancelled', finished_at = NOW() WHERE id = %s AND status = 'running'"
+SQL_BC_RECENT = """
+    SELECT id, status, total, sent, failed, pruned,
+           EXTRACT(EPOCH FROM COALESCE(finished_at, NOW()) - COALESCE(started_at, created_at))
+    FROM broadcast_jobs
+    {where}
+    ORDER BY created_at DESC
+    LIMIT %s
+"""
+SQL_BC_CLEANUP = """
+    DELETE FROM broadcast_deliveries
+    WHERE job_id IN (
+        SELECT id FROM broadcast_jobs WHERE finished_at < NOW() - make_interval(days => %s)
+    )
+"""
+
+
+def _enqueue_broadcast(job: BroadcastJob):
+    """
+    Ghi job + toàn bộ người nhận (1 câu INSERT ... SELECT chạy trên server) trong 1 transaction:
+    worker khác chỉ thấy job khi danh sách người nhận đã đủ.
+    """
+    where, params = _segment_where(job.segment)
+
+    def _q(cur):
+        with cur.connection.transaction():
+            cur.execute(SQL_BC_CREATE, (job.id, Jsonb(job.payload), Jsonb(job.segment), job.admin_chat_id))
+            cur.execute(SQL_BC_FILL.format(where=where), (job.id, *params))
+            total = cur.rowcount
+            cur.execute(SQL_BC_SET_TOTAL, (total, job.id))
+        return total
+
+    try:
+        job.total = db_run(_q, retries=0, name="broadcast_enqueue")
+        job.status = "running"
+        job.started_at = time.time()
+        broadcast_queue.notify()
+    except Exception as e:
+        job.status = "error"
+        log("error", "broadcast.enqueue_error", job=job.id, err=repr(e))
+        if job.admin_chat_id:
+            try:
+                bot.send_message(job.admin_chat_id, f"⚠️ Tạo job broadcast {job.id} lỗi.")
+            except Exception as e2:
+                log("error", "broadcast.report_error", err=repr(e2))
+
+
+class BroadcastQueue:
+    """
+    Mỗi process 1 thread: tìm job đang chạy -> nhận lô người nhận (FOR UPDATE SKIP LOCKED) -> gửi song song
+    qua executor (chung bucket / per-chat limiter) -> ghi kết quả + bộ đếm của job trong 1 transaction.
+    Process chết giữa chừng: phần chưa gửi vẫn 'pending' trong DB, worker nào còn sống / khởi động lại gửi tiếp.
+    Nhiều bot: mỗi vòng lần lượt vào từng bot (bảng broadcast_* nằm trong schema của bot).
+    """
+
+    def __init__(self, claim_size: int, lease: int, poll_interval: float):
+        self.claim_size = max(1, claim_size)
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.wake = threading.Event()
+        self.pid = None
+        self.lock = threading.Lock()
+        self.next_cleanup = {}    # {bot_id: monotonic}
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            threading.Thread(target=self._loop, name="broadcast-queue", daemon=True).start()
+            self.pid = os.getpid()
+
+    def notify(self):
+        self.start()
+        self.wake.set()
+
+    def _next_job(self):
+        def _q(cur):
+            cur.execute(SQL_BC_NEXT_JOB)
+            return cur.fetchone()
+
+        return db_run(_q, name="broadcast_next_job")
+
+    def _loop(self):
+        while True:
+            worked = False
+            for rt in list(bots.values()):
+                with use_bot(rt):
+                    try:
+                        job = self._next_job()
+                        # job còn lô nhưng worker khác đang giữ hết -> chờ poll, không quay vòng query liên tục
+                        if job is not None and self._drain(job[0], job[1]):
+                            worked = True
+                        elif job is None:
+                            self._cleanup()
+                    except Exception as e:
+                        log("error", "broadcast.queue_error", bot=rt.id, err=repr(e))
+            if worked:
+                continue
+            self.wake.wait(self.poll_interval)
+            self.wake.clear()
+
+    def _claim(self, job_id: str):
+        def _q(cur):
+            cur.execute(SQL_BC_CLAIM, {"job": job_id, "lease": float(self.lease), "n": self.claim_size})
+            return [row[0] for row in cur.fetchall()]
+
+        return db_run(_q, retries=0, name="broadcast_claim")
+
+    def _drain(self, job_id: str, payload: dict) -> bool:
+        """
+        Nhận + gửi từng lô tới khi hết. Trả True nếu job đã xong / đã gửi được ít nhất 1 lô.
+        """
+        executor = _get_broadcast_executor()
+        rt = current_bot()
+        worked = False
+        while True:
+            chat_ids = self._claim(job_id)
+            if not chat_ids:
+                break
+            results = list(executor.map(lambda uid: _broadcast_send_as(rt, payload, uid), chat_ids))
+            self._record(job_id, chat_ids, results)
+            worked = True
+        return self._finish(job_id) or worked
+
+    def _record(self, job_id: str, chat_ids, results):
+        groups = {"sent": [], "failed": []}
+        pruned = {}
+        for uid, (ok, reason) in zip(chat_ids, results):
+            BROADCAST_MESSAGES.inc("sent" if ok else (reason or "failed"))
+            if ok:
+                groups["sent"].append(uid)
+            elif reason == BROADCAST_RETRY_LATER:
+                continue    # để nguyên 'sending': hết lease thì được nhận lại và gửi lại
+            elif reason:
+                pruned.setdefault(reason, []).append(uid)
+            else:
+                groups["failed"].append(uid)
+        groups["pruned"] = [uid for ids in pruned.values() for uid in ids]
+
+        def _q(cur):
+            with cur.connection.transaction():
+                for status, ids in groups.items():
+                    if ids:
+                        cur.execute(SQL_BC_MARK, (status, job_id, ids))
+                cur.execute(SQL_BC_PROGRESS, (
+                    len(groups["sent"]), len(groups["failed"]) + len(groups["pruned"]), len(groups["pruned"]), job_id
+                ))
+
+        # sent = sent + n không idempotent: commit xong mà mất connection thì retry sẽ cộng 2 lần.
+        # Lỗi thì để lease hết hạn, batch được claim lại.
+        db_run(_q, retries=0, name="broadcast_record")
+        for reason, ids in pruned.items():
+            try:
+                mark_users_inactive(ids, reason)
+            except Exception as e:
+                log("error", "broadcast.mark_inactive_error", err=repr(e))
+
+    def _finish(self, job_id: str) -> bool:
+        def _q(cur):
+            cur.execute(SQL_BC_FINISH, (job_id, job_id))
+            return cur.fetchone()
+
+        row = db_run(_q, name="broadcast_finish")
+        if row is None:
+            return False
+        local = broadcast_jobs.get(job_id)
+        if local is not None:
+            local.status = "done"
+            local.finished_at = time.time()
+        if row[0]:
+            try:
+                bot.send_message(row[0], "✅ Broadcast xong.\n" + broadcast_summary_text(job_id))
+            except Exception as e:
+                log("error", "broadcast.report_error", err=repr(e))
+        return True
+
+    def _cleanup(self):
+        bot_id = current_bot().id
+        if time.monotonic() < self.next_cleanup.get(bot_id, 0.0):
+            return
+        self.next_cleanup[bot_id] = time.monotonic() + 3600
+
+        def _q(cur):
+            cur.execute(SQL_BC_CLEANUP, (BROADCAST_RETENTION_DAYS,))
+            return cur.rowcount
+
+        n = db_run(_q, name="broadcast_cleanup")
+        if n:
+            log("info", "broadcast.cleanup", "xóa dòng người nhận của job cũ", rows=n, bot=bot_id)
+
+
+broadcast_queue = BroadcastQueue(BROADCAST_CLAIM_SIZE, BROADCAST_LEASE, BROADCAST_POLL_INTERVAL)
+
+
+def recent_broadcast_rows(limit: int = 5, running_only: bool = False):
+    where = "WHERE status = 'running'" if running_only else ""
+
+    def _q(cur):
+        cur.execute(SQL_BC_RECENT.format(where=where), (limit,))
+        return cur.fetchall()
+
+    return db_run(_q, name="broadcast_recent")
+
+
+def broadcast_row_text(row) -> str:
+    job_id, status, total, sent, failed, pruned, took = row
+    return (
+        f"Job {job_id}: {status}\n"
+        f"Sent: {sent}/{total}\nFailed: {failed} (đã loại {pruned} chat chặn bot/không còn)\n"
+        f"Thời gian: {float(took or 0):.0f}s"
+    )
+
+
+def broadcast_summary_text(job_id: str) -> str:
+    if DATABASE_URL:
+        for row in recent_broadcast_rows(limit=20):
+            if row[0] == job_id:
+                return broadcast_row_text(row)
+    job = broadcast_jobs.get(job_id)
+    return job.summary() if job else f"Job {job_id}: không rõ"
+
+
+def broadcast_progress_text() -> str:
+    """
+    Job đang chạy (mọi worker / instance, đọc từ DB) cho màn hình 📊 Stats.
+    """
+    if DATABASE_URL:
+        try:
+            rows = recent_broadcast_rows(running_only=True)
+        except Exception as e:
+            log("error", "broadcast.progress_error", err=repr(e))
+            return ""
+        return "\n\n".join("📣 " + broadcast_row_text(r) for r in rows)
+    return "\n\n".join("📣 " + j.summary() for j in bot_broadcast_jobs() if j.status == "running")
+
+
+# ================= ADMIN PANEL + BROADCAST (TEXT/PHOTO/VIDEO) =================
+
+@dispatcher.command("admin")
+def admin_panel(message):
+    chat_id = message.chat.id
+    upsert_user(chat_id)
+
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+
+    templates.send(chat_id, "admin_panel")
+
+
+@dispatcher.text("📊 Stats", guard=lambda m: is_admin(m.chat.id))
+def admin_stats(message):
+    templates.send(message.chat.id, "admin_stats", stats=admin_stats_text())
+
+
+def admin_stats_text() -> str:
+    progress = broadcast_progress_text()
+    return user_stats_text() + ("\n\n" + progress if progress else "")
+
+
+@dispatcher.callback("STATS_REFRESH")
+def admin_stats_refresh(call):
+    chat_id = call.message.chat.id
+    if not is_admin(chat_id):
+        return bot.answer_callback_query(call.id, "No permission.")
+    bot.answer_callback_query(call.id)
+    tpl = templates.get("admin_stats")
+    try:
+        bot.edit_message_text(tpl.render(stats=admin_stats_text()), chat_id, call.message.message_id,
+                              reply_markup=tpl.markup)
+    except ApiTelegramException as e:
+        # số liệu không đổi -> Telegram trả 400 "message is not modified"
+        if "not modified" not in (e.description or ""):
+            raise
+
+
+@dispatcher.text("❌ Thoát", guard=lambda m: is_admin(m.chat.id))
+def admin_exit(message):
+    set_admin_draft(message.chat.id, None)
+    templates.send(message.chat.id, "admin_exit")
+
+
+@dispatcher.text("📣 Broadcast", guard=lambda m: is_admin(m.chat.id))
+def admin_broadcast_start(message):
+    chat_id = message.chat.id
+    set_admin_draft(chat_id, AdminDraft("BROADCAST_WAIT_MEDIA"))
+    templates.send(chat_id, "broadcast_ask")
+
+
+@dispatcher.command("cancel")
+def cancel_any(message):
+    if is_admin(message.chat.id):
+        set_admin_draft(message.chat.id, None)
+        bot.send_message(message.chat.id, "✅ Đã hủy.")
+
+
+def _broadcast_preview(payload: dict) -> str:
+    if payload["type"] == "text":
+        return f"📝 *Text:*\n{payload['text']}"
+    preview = "🖼️ *Ảnh*" if payload["type"] == "photo" else "🎬 *Video*"
+    if payload.get("caption"):
+        preview += f"\nCaption:\n{payload['caption']}"
+    return preview
+
+
+def _broadcast_confirm_view(draft: AdminDraft):
+    key = draft.segment if draft.segment in AUDIENCE_SEGMENTS else "all"
+    tpl = templates.get(f"broadcast_confirm:{key}")
+    text = tpl.render(count=count_audience(AUDIENCE_SEGMENTS[key][1]), preview=_broadcast_preview(draft.payload))
+    return text, tpl.markup
+
+
+def _ask_broadcast_confirm(chat_id: int, draft: AdminDraft):
+    text, kb = _broadcast_confirm_view(draft)
+    bot.send_message(chat_id, text, parse_mode="Markdown", reply_markup=kb)
+
+
+@dispatcher.state("BROADCAST_WAIT_MEDIA", content_types=["text"])
+def admin_receive_broadcast_text(message):
+    chat_id = message.chat.id
+    text = message.text.strip()
+    draft = AdminDraft("BROADCAST_WAIT_MEDIA", {"type": "text", "text": text})
+    set_admin_draft(chat_id, draft)
+    _ask_broadcast_confirm(chat_id, draft)
+
+
+@dispatcher.state("BROADCAST_WAIT_MEDIA", content_types=["photo"])
+def admin_receive_broadcast_photo(message):
+    chat_id = message.chat.id
+    file_id = message.photo[-1].file_id
+    caption = (message.caption or "").strip()
+    draft = AdminDraft("BROADCAST_WAIT_MEDIA", {"type": "photo", "file_id": file_id, "caption": caption})
+    set_admin_draft(chat_id, draft)
+    _ask_broadcast_confirm(chat_id, draft)
+
+
+@dispatcher.state("BROADCAST_WAIT_MEDIA", content_types=["video"])
+def admin_receive_broadcast_video(message):
+    chat_id = message.chat.id
+    file_id = message.video.file_id
+    caption = (message.caption or "").strip()
+    draft = AdminDraft("BROADCAST_WAIT_MEDIA", {"type": "video", "file_id": file_id, "caption": caption})
+    set_admin_draft(chat_id, draft)
+    _ask_broadcast_confirm(chat_id, draft)
+
+
+@dispatcher.callback(*[f"BC_SEG:{key}" for key in AUDIENCE_SEGMENTS])
+def admin_broadcast_segment(call):
+    chat_id = call.message.chat.id
+    if not is_admin(chat_id):
+        return bot.answer_callback_query(call.id, "No permission.")
+    draft = get_admin_draft(chat_id)
+    if not draft or not draft.payload:
+        return bot.answer_callback_query(call.id, "Không có nội dung.")
+    draft.segment = call.data.split(":", 1)[1]
+    set_admin_draft(chat_id, draft)
+    text, kb = _broadcast_confirm_view(draft)
+    bot.answer_callback_query(call.id)
+    bot.edit_message_text(text, chat_id, call.message.message_id, parse_mode="Markdown", reply_markup=kb)
+
+
+@dispatcher.callback("BC_CONFIRM", "BC_CANCEL")
+def admin_broadcast_confirm(call):
+    chat_id = call.message.chat.id
+    if not is_admin(chat_id):
+        return bot.answer_callback_query(call.id, "No permission.")
+
+    if call.data == "BC_CANCEL":
+        set_admin_draft(chat_id, None)
+        bot.answer_callback_query(call.id, "Đã hủy.")
+        return bot.edit_message_text("❌ Đã hủy broadcast.", chat_id, call.message.message_id)
+
+    draft = get_admin_draft(chat_id)
+    payload = draft.payload if draft else None
+    set_admin_draft(chat_id, None)
+
+    if not payload:
+        bot.answer_callback_query(call.id, "Không có nội dung.")
+        return bot.edit_message_text("⚠️ Không có nội dung để gửi.", chat_id, call.message.message_id)
+
+    segment = AUDIENCE_SEGMENTS.get(draft.segment, AUDIENCE_SEGMENTS["all"])[1]
+    job = start_broadcast(payload, current_bot().admin_chat_id or chat_id, segment)
+    bot.answer_callback_query(call.id, f"Đã tạo job {job.id}")
+    bot.edit_message_text(
+        f"⏳ Đang gửi nền... Job: {job.id}\nXem tiến độ: /broadcast_status\nDừng: /broadcast_stop {job.id}",
+        chat_id,
+        call.message.message_id
+    )
+
+
+@dispatcher.command("broadcast_stop")
+def broadcast_stop_cmd(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    args = message.text.split()[1:]
+    if not args:
+        return bot.send_message(chat_id, "Cách dùng: /broadcast_stop <job_id>")
+    job_id = args[0]
+    job = broadcast_jobs.get(job_id)
+    if job is not None and job.bot_id != current_bot().id:
+        job = None
+    if job is not None:
+        job.cancelled = True
+    stopped = job is not None
+    if DATABASE_URL:
+        def _q(cur):
+            cur.execute(SQL_BC_CANCEL, (job_id,))
+            return cur.rowcount
+
+        stopped = bool(db_run(_q, name="broadcast_cancel")) or stopped
+    if not stopped:
+        return bot.send_message(chat_id, f"Không có job {job_id} đang chạy.")
+    bot.send_message(chat_id, f"🛑 Job {job_id} sẽ dừng sau lô hiện tại.")
+
+
+@dispatcher.command("broadcast_status")
+def broadcast_status_cmd(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    if DATABASE_URL:
+        texts = [broadcast_row_text(row) for row in recent_broadcast_rows()]
+    else:
+        texts = [job.summary() for job in bot_broadcast_jobs()[-5:]]
+    if not texts:
+        return bot.send_message(chat_id, "Chưa có job broadcast nào.")
+    bot.send_message(chat_id, "\n\n".join(texts))
 
 
-# ================== SETUP WEBHOOK (Render) ==================
+@dispatcher.command("media")
+def media_status_cmd(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    bot.send_message(chat_id, "🖼️ Media:\n" + media.status_text())
 
-def setup_webhook():
+
+@dispatcher.command("setmedia")
+def media_set_cmd(message):
     """
-    Đảm bảo webhook luôn được set lại sau mỗi lần Render restart/deploy.
+    Reply vào 1 ảnh: /setmedia welcome -> ảnh đó thành ảnh "welcome" (lưu DB, worker khác nhận khi load lại).
     """
-    if not WEBHOOK_URL:
-        print("[WEBHOOK] WEBHOOK_URL chưa cấu hình -> bỏ qua set webhook.")
-        return
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    args = message.text.split()[1:]
+    reply = message.reply_to_message
+    if not args or args[0] not in media.names() or reply is None or not reply.photo:
+        return bot.send_message(chat_id, "Cách dùng: reply vào ảnh mới + /setmedia <" + "|".join(media.names()) + ">")
     try:
-        bot.remove_webhook()
-        time.sleep(1)
-        ok = bot.set_webhook(url=WEBHOOK_URL)
-        print("[WEBHOOK] set_webhook:", WEBHOOK_URL, "->", ok)
+        media.set(args[0], reply.photo[-1].file_id)
     except Exception as e:
-        print("[WEBHOOK] Lỗi set webhook:", repr(e))
-
+        log("error", "media.set_error", err=repr(e))
+        return bot.send_message(chat_id, "⚠️ Lưu media lỗi.")
+    bot.send_message(chat_id, f"✅ Đã đổi ảnh {args[0]}.")
 
-setup_webhook()
 
-
-# ===================== EXPORT USERS TXT (NEW) =====================
-
-@bot.message_handler(commands=["export_users_txt"])
-def export_users_txt_cmd(message):
+@dispatcher.command("http_stats")
+def http_stats_cmd(message):
     chat_id = message.chat.id
     if not is_admin(chat_id):
         return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    st = http_stats.snapshot()
+    bot.send_message(
+        chat_id,
+        f"🌐 HTTP: {st['requests']} request, {st['new_connections']} connection mới, "
+        f"reuse {st['reuse_ratio'] * 100:.1f}%, lỗi {st['errors']}\n"
+        f"{outbound.status_text()}"
+    )
 
-    users = get_all_users()
-    if not users:
-        return bot.send_message(chat_id, "⚠️ Chưa có user nào trong database.")
 
-    filename = "users_export.txt"
-    with open(filename, "w", encoding="utf-8") as f:
-        for uid in users:
-            f.write(str(uid) + "\n")
+@dispatcher.command("profile")
+def profile_cmd(message):
+    """
+    /profile 60 5 -> trong 60 giây, cứ 5 update thì profile 1 update; xong gửi kết quả cho admin.
+    """
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    args = [int(a) for a in message.text.split()[1:3] if a.isdigit()]
+    seconds = min(args[0], 600) if args else 60
+    every = args[1] if len(args) > 1 else 1
+    update_profiler.start(seconds, every, chat_id)
+    bot.send_message(chat_id, f"🧪 Bắt đầu profile {seconds}s, lấy mẫu 1/{every} update.")
 
-    with open(filename, "rb") as f:
-        bot.send_document(chat_id, f, caption=f"✅ Export xong: {len(users)} users")
 
+@dispatcher.command("dispatch_stats")
+def dispatch_stats_cmd(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    bot.send_message(chat_id, dispatcher.stats_text())
 
-# ============ KEEP ALIVE ============
 
-def keep_alive():
-    if not PING_URL:
-        print("[KEEP_ALIVE] PING_URL chưa cấu hình, không bật keep-alive.")
-        return
-    print(f"[KEEP_ALIVE] Bắt đầu ping {PING_URL} mỗi {PING_INTERVAL}s")
-    while True:
-        try:
-            r = requests.get(PING_URL, timeout=10)
-            print(f"[KEEP_ALIVE] Ping {PING_URL} -> {r.status_code}")
-        except Exception as e:
-            print("[KEEP_ALIVE] Lỗi ping:", repr(e))
-        time.sleep(PING_INTERVAL)
+# ============ LEAD DIGEST (GOM THÔNG BÁO ADMIN) ============
 
+class LeadDigest:
+    """
+    Hàng đợi sự kiện lead -> thread nền gom gửi admin:
+    - "username": gom thành 1 tin text (tách nhiều tin nếu dài quá giới hạn Telegram)
+    - "receipt": gom bill thành media group (tối đa 10/nhóm, caption từng bill); bill gửi dạng file đi nhóm riêng
+      (Telegram không cho trộn ảnh với file trong 1 nhóm). Nhóm lỗi hẳn -> gửi lại từng bill, chỉ bill lỗi bị tính lần thử
+    Telegram trả 429 / lỗi tạm -> chờ rồi gửi lại, không bỏ sự kiện; handler của khách không phải chờ.
+    """
 
-if ENABLE_KEEP_ALIVE:
-    threading.Thread(target=keep_alive, daemon=True).start()
+    MAX_TEXT = 3900
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, chat_id: int, interval: float, max_events: int):
+        self.chat_id = chat_id
+        self.interval = interval
+        self.max_events = max(1, max_events)
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def add(self, event: dict):
+        with self.cond:
+            if self.thread is None:
+                self.thread = bot_thread(self._loop, name=f"lead-digest-{current_bot().id}", daemon=True)
+                self.thread.start()
+            self.events.append(event)
+            if len(self.events) >= self.max_events:
+                self.cond.notify()
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.events) >= self.max_events, timeout=self.interval)
+            with outbound_priority(PRIO_BULK):
+                delay = self.flush()
+            if delay:
+                # gửi lỗi -> chờ rồi mới thử lại (không chờ thì hàng đợi vẫn đủ max_events -> flush liên tục)
+                time.sleep(delay)
+
+    def _take(self):
+        with self.cond:
+            batch = list(self.events)
+            self.events.clear()
+        return batch
+
+    def _requeue(self, failed, rest):
+        """
+        failed: phần vừa gửi lỗi hẳn (tính 1 lần thử, quá MAX_ATTEMPTS thì bỏ); rest: phần chưa gửi, giữ nguyên.
+        """
+        keep = []
+        for ev in failed:
+            ev["attempts"] = ev.get("attempts", 0) + 1
+            if ev["attempts"] < self.MAX_ATTEMPTS:
+                keep.append(ev)
+            else:
+                log("error", "digest.event_dropped", "bỏ sự kiện sau nhiều lần lỗi", ev=ev)
+        with self.cond:
+            self.events.extendleft(reversed(keep + list(rest)))
+
+    def flush(self) -> float:
+        """
+        Gửi hết hàng đợi. -> số giây nên chờ trước lần gửi sau: 0 nếu gửi hết,
+        429 -> retry_after, breaker mở -> phần cooldown còn lại, lỗi khác -> interval.
+        """
+        batch = self._take()
+        if not batch or not self.chat_id:
+            return 0.0
+        usernames = [ev for ev in batch if ev["kind"] == "username"]
+        receipts = [ev for ev in batch if ev["kind"] == "receipt"]
+
+        # tách tin theo độ dài; 1 dòng dài quá (tên tài khoản khách gõ rất dài) thì cắt bớt dòng đó
+        lines = {id(ev): lead_digest_line(ev)[:self.MAX_TEXT] for ev in usernames}
+        chunks, cur, size = [], [], 0
+        for ev in usernames:
+            n = len(lines[id(ev)]) + 1
+            if cur and size + n > self.MAX_TEXT:
+                chunks.append(cur)
+                cur, size = [], 0
+            cur.append(ev)
+            size += n
+        if cur:
+            chunks.append(cur)
+        groups = []
+        for media_kind in ("photo", "document"):
+            same = [ev for ev in receipts if ev["receipt_kind"] == media_kind]
+            groups += [same[i:i + 10] for i in range(0, len(same), 10)]
+
+        work = deque([("text", c) for c in chunks] + [("receipts", g) for g in groups])
+        failed = []
+        while work:
+            kind, evs = work.popleft()
+            try:
+                if kind == "text":
+                    header = f"🔔 {len(evs)} khách mới gửi tên tài khoản\n\n"
+                    bot.send_message(self.chat_id, header + "\n".join(lines[id(e)] for e in evs))
+                elif len(evs) == 1:
+                    # media group cần 2-10 bill
+                    send_lead_receipt(self.chat_id, evs[0])
+                else:
+                    media = types.InputMediaDocument if evs[0]["receipt_kind"] == "document" else types.InputMediaPhoto
+                    bot.send_media_group(self.chat_id, [
+                        media(ev["receipt_file_id"], caption=lead_receipt_caption(ev)) for ev in evs
+                    ])
+            except Exception as e:
+                retry_after = telegram_retry_after(e)
+                log("error", "digest.send_error", err=repr(e))
+                if retry_after or isinstance(e, TelegramUnavailable) or OutboundGate.is_transient(e):
+                    # 429 / lỗi tạm (mạng, 5xx, breaker mở) không tính là 1 lần thử -> không bao giờ bỏ sự kiện
+                    # vì bị throttle; phần chưa gửi quay lại đầu hàng đợi, gửi ở lần flush sau
+                    self._requeue(failed, evs + [ev for _, later in work for ev in later])
+                    if retry_after:
+                        return float(retry_after)
+                    return max(self.interval, outbound.open_until - time.monotonic())
+                if len(evs) > 1:
+                    # lỗi hẳn (400...) thường do 1 bill / 1 dòng trong nhóm -> gửi lại từng cái
+                    work.extendleft((kind, [ev]) for ev in reversed(evs))
+                else:
+                    failed.extend(evs)
+        if failed:
+            self._requeue(failed, [])
+            return self.interval
+        return 0.0
+
+
+def send_lead_receipt(chat_id: int, ev: dict):
+    # bill khách gửi dạng file (document) không gửi được bằng send_photo
+    if ev["receipt_kind"] == "document":
+        return bot.send_document(chat_id, ev["receipt_file_id"], caption=lead_receipt_caption(ev))
+    return bot.send_photo(chat_id, ev["receipt_file_id"], caption=lead_receipt_caption(ev))
+
+
+def lead_digest_line(ev: dict) -> str:
+    return f"• {ev['time']} | {ev['tg_username']} | TK: {ev['username_game']} | ID: {ev['chat_id']} | #{ev['lead_id']}"
+
+
+def lead_receipt_caption(ev: dict) -> str:
+    caption = (
+        "📩 KHÁCH GỬI CHUYỂN KHOẢN + NHẮN 4 SỐ ĐUÔI\n\n"
+        f"👤 Telegram: {ev['tg_username']}\n"
+        f"🧾 Tên tài khoản: {ev['username_game'] or '(không rõ)'}\n"
+        f"🆔 Chat ID: {ev['chat_id']}\n"
+        f"🔢 4 số đuôi: {ev['tail']}\n"
+        f"⏰ Thời gian: {ev['time']}\n"
+        f"🏷️ Mã lead: #{ev['lead_id']}"
+    )
+    if ev.get("dup_of"):
+        caption += f"\n⚠️ BILL TRÙNG với lead #{ev['dup_of']}"
+    # caption tối đa 1024 ký tự (tên tài khoản do khách gõ, có thể rất dài)
+    return caption[:1024]
 
 
-# ============ DEBUG GET FILE_ID ============
+lead_digest = BotScoped("lead_digest")
 
-@bot.message_handler(commands=['getid'])
-def enable_getid(message):
-    chat_id = message.chat.id
-    debug_get_id_mode.add(chat_id)
-    bot.send_message(
-        chat_id,
-        "✅ Đã bật chế độ lấy FILE_ID.\n"
-        "Gửi ảnh/video/file, bot sẽ trả FILE_ID.\n"
-        "Tắt bằng /stopgetid",
-        parse_mode="Markdown"
-    )
 
+# ============ LEADS (LƯU DB, GHI THEO LÔ) ============
 
-@bot.message_handler(commands=['stopgetid'])
-def disable_getid(message):
-    chat_id = message.chat.id
-    debug_get_id_mode.discard(chat_id)
-    bot.send_message(chat_id, "🛑 Đã tắt chế độ lấy FILE_ID.")
+LEAD_COLUMNS = (
+    "id", "chat_id", "tg_username", "username_game", "receipt_file_id",
+    "receipt_unique_id", "receipt_dup_of", "tail", "status", "created_at",
+)
+# sự kiện sau chỉ ghi đè cột nó có (NULL = giữ giá trị cũ); lead admin đã xử lý (done) không bị đổi status
+SQL_LEADS_UPSERT = """
+    INSERT INTO bot_leads ({cols})
+    VALUES {values}
+    ON CONFLICT (id) DO UPDATE SET
+        tg_username       = COALESCE(EXCLUDED.tg_username, bot_leads.tg_username),
+        username_game     = COALESCE(EXCLUDED.username_game, bot_leads.username_game),
+        receipt_file_id   = COALESCE(EXCLUDED.receipt_file_id, bot_leads.receipt_file_id),
+        receipt_unique_id = COALESCE(EXCLUDED.receipt_unique_id, bot_leads.receipt_unique_id),
+        receipt_dup_of    = COALESCE(EXCLUDED.receipt_dup_of, bot_leads.receipt_dup_of),
+        tail              = COALESCE(EXCLUDED.tail, bot_leads.tail),
+        status            = CASE WHEN bot_leads.status = 'done' THEN 'done' ELSE EXCLUDED.status END,
+        updated_at        = NOW()
+"""
+SQL_LEADS_PAGE = """
+    SELECT id, chat_id, tg_username, username_game, tail, status, receipt_dup_of, created_at
+    FROM bot_leads
+    WHERE (created_at, id) < (%s::timestamptz, %s){where}
+    ORDER BY created_at DESC, id DESC
+    LIMIT %s
+"""
+SQL_LEADS_FIND = """
+    SELECT id, chat_id, tg_username, username_game, tail, status, receipt_dup_of, created_at
+    FROM bot_leads
+    WHERE {where}
+    ORDER BY created_at DESC, id DESC
+    LIMIT %s
+"""
+SQL_LEAD_RECEIPT = "SELECT id FROM bot_leads WHERE receipt_unique_id = %s AND id <> %s LIMIT 1"
+SQL_LEAD_DONE = "UPDATE bot_leads SET status = 'done', updated_at = NOW() WHERE id = %s AND status <> 'done'"
+
+LEAD_STATUS_LABELS = {
+    "username": "đã gửi tên TK",
+    "receipt": "đã gửi bill",
+    "pending": "chờ cộng điểm",
+    "done": "đã xử lý",
+}
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+try:
+    _LEADS_TZ = ZoneInfo(STATS_TZ)
+except Exception:
+    _LEADS_TZ = timezone.utc
+
+
+def new_lead_id() -> str:
+    return uuid.uuid4().hex[:10]
+
+
+def lead_event(lead_id: str, chat_id: int, status: str, **fields) -> dict:
+    """
+    1 sự kiện ghi bot_leads. created_at lấy lúc xảy ra (không phải lúc thread nền ghi).
+    "bot": writer dùng chung cho mọi bot, ghi vào schema của bot tạo sự kiện.
+    """
+    return {"id": lead_id, "chat_id": chat_id, "status": status, "created_at": datetime.now(timezone.utc),
+            "bot": current_bot().id, **fields}
 
 
-# ================= ADMIN PANEL + BROADCAST (TEXT/PHOTO/VIDEO) =================
+class LeadWriter:
+    """
+    Ghi bot_leads không chặn handler: add() chỉ bỏ sự kiện vào hàng đợi,
+    thread nền gom tối đa batch_max sự kiện -> 1 câu INSERT ... ON CONFLICT nhiều dòng.
+    Sự kiện cùng lead trong 1 lô được gộp trước (1 câu ON CONFLICT không được sửa 1 dòng 2 lần).
+    DB lỗi -> trả lô về đầu hàng đợi, lần sau ghi lại; hàng đợi có trần max_queue (quá thì bỏ sự kiện cũ nhất).
+    """
 
-@bot.message_handler(commands=["admin"])
-def admin_panel(message):
-    chat_id = message.chat.id
-    upsert_user(chat_id)
+    def __init__(self, interval: float, batch_max: int, max_queue: int):
+        self.interval = interval
+        self.batch_max = max(1, batch_max)
+        self.max_queue = max(self.batch_max, max_queue)
+        self.events = deque()
+        self.cond = threading.Condition()
+        self.thread = None
+        self.written = 0
+        self.dropped = 0
+        self.failures = 0
+        self.flush_lock = threading.Lock()
+
+    def add(self, event: dict):
+        if not DATABASE_URL:
+            return
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name="lead-writer", daemon=True)
+                self.thread.start()
+            self.events.append(event)
+            self._trim()
+            if len(self.events) >= self.batch_max:
+                self.cond.notify()
+
+    def depth(self) -> int:
+        return len(self.events)
+
+    def _trim(self):
+        while len(self.events) > self.max_queue:
+            ev = self.events.popleft()
+            self.dropped += 1
+            log("error", "leads.queue_full", "hàng đợi đầy, bỏ sự kiện", lead_id=ev["id"], status=ev["status"])
+
+    def _loop(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: len(self.events) >= self.batch_max, timeout=self.interval)
+            if not self.flush():
+                time.sleep(self.interval)
+
+    @staticmethod
+    def merge(batch):
+        merged = {}
+        for ev in batch:
+            row = merged.get(ev["id"])
+            if row is None:
+                merged[ev["id"]] = dict(ev)
+            else:
+                row.update((k, v) for k, v in ev.items() if v is not None and k != "created_at")
+        return list(merged.values())
+
+    def flush(self) -> bool:
+        """
+        Ghi hết hàng đợi (theo lô). Trả False nếu DB lỗi (lô đã quay lại hàng đợi).
+        Mỗi lúc chỉ 1 flush (thread nền, /lead_done, atexit): 2 lô commit đảo thứ tự thì
+        sự kiện cũ của 1 lead đè status mới (SQL_LEADS_UPSERT ghi EXCLUDED.status).
+        """
+        with self.flush_lock:
+            return self._flush()
+
+    def _flush(self) -> bool:
+        while True:
+            with self.cond:
+                if not self.events:
+                    return True
+                batch = [self.events.popleft() for _ in range(min(self.batch_max, len(self.events)))]
+            by_bot = {}
+            for ev in batch:
+                by_bot.setdefault(ev["bot"], []).append(ev)
+            groups = list(by_bot.items())
+            for i, (bot_id, events) in enumerate(groups):
+                rows = self.merge(events)
+                sql = SQL_LEADS_UPSERT.format(
+                    cols=", ".join(LEAD_COLUMNS),
+                    values=", ".join(["(" + ", ".join(["%s"] * len(LEAD_COLUMNS)) + ")"] * len(rows)),
+                )
+                params = [row.get(col) for row in rows for col in LEAD_COLUMNS]
+                try:
+                    with use_bot(bots[bot_id]):
+                        db_run(lambda cur: cur.execute(sql, params), name="leads_write")
+                except Exception as e:
+                    self.failures += 1
+                    log("error", "leads.write_error", bot=bot_id, err=repr(e))
+                    unwritten = [ev for _, rest in groups[i:] for ev in rest]
+                    with self.cond:
+                        self.events.extendleft(reversed(unwritten))
+                        self._trim()
+                    return False
+                self.written += len(rows)
+
+
+class ReceiptIndex:
+    """
+    Bill trùng: file_unique_id (cố định cho 1 file, khác file_id) -> lead đầu tiên gửi bill đó.
+    Tra dict LRU trong RAM trước (O(1)), chưa có mới tra DB qua hash index bot_leads_receipt_idx.
+    Lead ở worker khác còn nằm trong hàng đợi ghi thì chưa thấy được (trễ tối đa LEADS_FLUSH_INTERVAL).
+    """
 
-    if not is_admin(chat_id):
-        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    def __init__(self, size: int):
+        self.size = size
+        self.items = OrderedDict()   # {file_unique_id: lead_id}
+        self.lock = threading.Lock()
+
+    def check_and_add(self, unique_id: str, lead_id: str):
+        """
+        Trả lead_id của lead khác đã gửi cùng bill, không trùng -> None (và ghi nhớ bill cho lead này).
+        """
+        with self.lock:
+            prev = self.items.get(unique_id)
+            if prev is not None:
+                self.items.move_to_end(unique_id)
+        if prev is None and DATABASE_URL:
+            def _q(cur):
+                cur.execute(SQL_LEAD_RECEIPT, (unique_id, lead_id), prepare=DB_PREPARE)
+                row = cur.fetchone()
+                return row[0] if row else None
 
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row("📣 Broadcast", "📊 Stats")
-    kb.row("❌ Thoát")
-    bot.send_message(chat_id, "🔧 Admin Panel", reply_markup=kb)
+            try:
+                prev = db_run(_q, name="lead_receipt")
+            except Exception as e:
+                log("error", "leads.receipt_check_error", err=repr(e))
+        with self.lock:
+            self.items.setdefault(unique_id, prev or lead_id)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+        return prev if prev != lead_id else None
 
 
-@bot.message_handler(func=lambda m: is_admin(m.chat.id) and m.text == "📊 Stats")
-def admin_stats(message):
-    bot.send_message(message.chat.id, f"👥 Tổng user đã lưu: {count_users()}")
+lead_writer = LeadWriter(LEADS_FLUSH_INTERVAL, LEADS_BATCH_MAX, LEADS_QUEUE_MAX)
+receipt_index = BotScoped("receipt_index")
+atexit.register(lead_writer.flush)
 
 
-@bot.message_handler(func=lambda m: is_admin(m.chat.id) and m.text == "❌ Thoát")
-def admin_exit(message):
-    admin_state.pop(message.chat.id, None)
-    bot.send_message(message.chat.id, "Đã thoát admin.", reply_markup=types.ReplyKeyboardRemove())
+def _lead_cursor(row) -> str:
+    created_at, lead_id = row[7], row[0]
+    return f"{(created_at - _EPOCH) // timedelta(microseconds=1)}:{lead_id}"
 
 
-@bot.message_handler(func=lambda m: is_admin(m.chat.id) and m.text == "📣 Broadcast")
-def admin_broadcast_start(message):
-    chat_id = message.chat.id
-    admin_state[chat_id] = {"mode": "BROADCAST_WAIT_MEDIA", "payload": None}
-    bot.send_message(
-        chat_id,
-        "📣 Hãy gửi *nội dung cần broadcast*.\n"
-        "✅ Hỗ trợ: *Text / Ảnh / Video* (có thể kèm caption).\n"
-        "Hủy: /cancel",
-        parse_mode="Markdown"
-    )
+def fetch_leads_page(pending: bool = False, cursor: str = None, page_size: int = LEADS_PAGE_SIZE):
+    """
+    1 trang lead mới nhất trước (keyset theo (created_at, id) -> dùng index, không OFFSET/quét bảng).
+    cursor: "<created_at epoch µs>:<id>" của dòng cuối trang trước. Trả (rows, cursor trang sau | None).
+    """
+    after_ts, after_id = "infinity", ""
+    if cursor:
+        us, after_id = cursor.split(":", 1)
+        after_ts = _EPOCH + timedelta(microseconds=int(us))
+    sql = SQL_LEADS_PAGE.format(where=" AND status = 'pending'" if pending else "")
 
+    def _q(cur):
+        cur.execute(sql, (after_ts, after_id, page_size + 1), prepare=DB_PREPARE)
+        return cur.fetchall()
 
-@bot.message_handler(commands=["cancel"])
-def cancel_any(message):
-    if is_admin(message.chat.id):
-        admin_state.pop(message.chat.id, None)
-        bot.send_message(message.chat.id, "✅ Đã hủy.")
+    rows = db_run(_q, name="leads_page")
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, _lead_cursor(rows[-1])
+    return rows, None
 
 
-def _ask_broadcast_confirm(chat_id: int, preview_text: str):
-    kb = types.InlineKeyboardMarkup()
-    kb.add(
-        types.InlineKeyboardButton("✅ Xác nhận gửi", callback_data="BC_CONFIRM"),
-        types.InlineKeyboardButton("❌ Hủy", callback_data="BC_CANCEL")
-    )
-    bot.send_message(
-        chat_id,
-        f"Bạn sắp gửi đến *{count_users()}* user.\n\n{preview_text}\n\nXác nhận?",
-        parse_mode="Markdown",
-        reply_markup=kb
-    )
+def find_leads(query: str, limit: int = LEADS_PAGE_SIZE):
+    """
+    Tìm theo chat_id (số) hoặc mã lead / tên tài khoản game (không phân biệt hoa thường).
+    """
+    if query.lstrip("-").isdigit():
+        where, params = "chat_id = %s", (int(query),)
+    else:
+        where, params = "id = %s OR lower(username_game) = lower(%s)", (query.lstrip("#"), query)
 
+    def _q(cur):
+        cur.execute(SQL_LEADS_FIND.format(where=where), (*params, limit))
+        return cur.fetchall()
 
-@bot.message_handler(
-    func=lambda m: is_admin(m.chat.id) and admin_state.get(m.chat.id, {}).get("mode") == "BROADCAST_WAIT_MEDIA",
-    content_types=["text"]
-)
-def admin_receive_broadcast_text(message):
-    chat_id = message.chat.id
-    text = message.text.strip()
-    admin_state[chat_id]["payload"] = {"type": "text", "text": text}
-    _ask_broadcast_confirm(chat_id, f"📝 *Text:*\n{text}")
+    return db_run(_q, name="leads_find")
 
 
-@bot.message_handler(
-    func=lambda m: is_admin(m.chat.id) and admin_state.get(m.chat.id, {}).get("mode") == "BROADCAST_WAIT_MEDIA",
-    content_types=["photo"]
-)
-def admin_receive_broadcast_photo(message):
-    chat_id = message.chat.id
-    file_id = message.photo[-1].file_id
-    caption = (message.caption or "").strip()
-    admin_state[chat_id]["payload"] = {"type": "photo", "file_id": file_id, "caption": caption}
-    preview = "🖼️ *Ảnh*"
-    if caption:
-        preview += f"\nCaption:\n{caption}"
-    _ask_broadcast_confirm(chat_id, preview)
+def lead_row_text(row) -> str:
+    lead_id, chat_id, tg_username, username_game, tail, status, dup_of, created_at = row
+    text = (
+        f"#{lead_id} | {created_at.astimezone(_LEADS_TZ):%H:%M %d/%m} | {tg_username or '?'} | TK: {username_game or '?'} | "
+        f"ID: {chat_id} | đuôi: {tail or '-'} | {LEAD_STATUS_LABELS.get(status, status)}"
+    )
+    if dup_of:
+        text += f" | ⚠️ bill trùng #{dup_of}"
+    return text
+
+
+def _send_leads_page(chat_id: int, pending: bool, cursor: str = None, edit_message_id: int = None):
+    rows, next_cursor = fetch_leads_page(pending, cursor)
+    title = "⏳ Lead chờ cộng điểm" if pending else "📋 Lead mới nhất"
+    text = title + ":\n\n" + ("\n".join(lead_row_text(r) for r in rows) if rows else "(không có)")
+    kb = None
+    if next_cursor:
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("Trang sau ➡️", callback_data=f"LEADS:{'p' if pending else 'r'}:{next_cursor}"))
+    if edit_message_id:
+        bot.edit_message_text(text, chat_id, edit_message_id, reply_markup=kb)
+    else:
+        bot.send_message(chat_id, text, reply_markup=kb)
 
 
-@bot.message_handler(
-    func=lambda m: is_admin(m.chat.id) and admin_state.get(m.chat.id, {}).get("mode") == "BROADCAST_WAIT_MEDIA",
-    content_types=["video"]
-)
-def admin_receive_broadcast_video(message):
+@dispatcher.command("leads", "leads_pending")
+def leads_cmd(message):
     chat_id = message.chat.id
-    file_id = message.video.file_id
-    caption = (message.caption or "").strip()
-    admin_state[chat_id]["payload"] = {"type": "video", "file_id": file_id, "caption": caption}
-    preview = "🎬 *Video*"
-    if caption:
-        preview += f"\nCaption:\n{caption}"
-    _ask_broadcast_confirm(chat_id, preview)
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    if not DATABASE_URL:
+        return bot.send_message(chat_id, "⚠️ Chưa cấu hình DATABASE_URL.")
+    pending = message.text.split(maxsplit=1)[0][1:].split("@", 1)[0] == "leads_pending"
+    try:
+        _send_leads_page(chat_id, pending)
+    except Exception as e:
+        log("error", "leads.page_error", err=repr(e))
+        bot.send_message(chat_id, "⚠️ Đọc lead lỗi.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data in ["BC_CONFIRM", "BC_CANCEL"])
-def admin_broadcast_confirm(call):
+@dispatcher.callback_prefix("LEADS")
+def leads_page_callback(call):
     chat_id = call.message.chat.id
     if not is_admin(chat_id):
         return bot.answer_callback_query(call.id, "No permission.")
+    _, kind, cursor = call.data.split(":", 2)
+    bot.answer_callback_query(call.id)
+    _send_leads_page(chat_id, kind == "p", cursor, call.message.message_id)
 
-    if call.data == "BC_CANCEL":
-        admin_state.pop(chat_id, None)
-        bot.answer_callback_query(call.id, "Đã hủy.")
-        return bot.edit_message_text("❌ Đã hủy broadcast.", chat_id, call.message.message_id)
-
-    payload = admin_state.get(chat_id, {}).get("payload")
-    admin_state.pop(chat_id, None)
 
-    if not payload:
-        bot.answer_callback_query(call.id, "Không có nội dung.")
-        return bot.edit_message_text("⚠️ Không có nội dung để gửi.", chat_id, call.message.message_id)
-
-    bot.edit_message_text("⏳ Đang gửi...", chat_id, call.message.message_id)
-
-    users = get_all_users()
-    sent, failed = 0, 0
-
-    for uid in users:
-        try:
-            if payload["type"] == "text":
-                bot.send_message(uid, payload["text"], disable_web_page_preview=True)
-            elif payload["type"] == "photo":
-                bot.send_photo(uid, payload["file_id"], caption=payload.get("caption") or None)
-            elif payload["type"] == "video":
-                bot.send_video(uid, payload["file_id"], caption=payload.get("caption") or None)
-            else:
-                raise ValueError("Unsupported payload type")
+@dispatcher.command("lead")
+def lead_find_cmd(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    args = message.text.split(maxsplit=1)[1:]
+    if not args:
+        return bot.send_message(chat_id, "Cách dùng: /lead <mã lead | chat_id | tên tài khoản>")
+    rows = find_leads(args[0].strip())
+    bot.send_message(chat_id, "\n".join(lead_row_text(r) for r in rows) if rows else "Không tìm thấy lead.")
 
-            sent += 1
-            time.sleep(0.05)
-        except Exception as e:
-            failed += 1
-            print("[BROADCAST] failed uid=", uid, "err=", repr(e))
 
-    if ADMIN_CHAT_ID:
-        bot.send_message(ADMIN_CHAT_ID, f"✅ Broadcast xong.\nSent: {sent}\nFailed: {failed}")
-    bot.answer_callback_query(call.id, "Đã gửi!")
+@dispatcher.command("lead_done")
+def lead_done_cmd(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    args = message.text.split()[1:]
+    if not args:
+        return bot.send_message(chat_id, "Cách dùng: /lead_done <mã lead>")
+    lead_id = args[0].lstrip("#")
+    # lead vừa gửi có thể còn trong hàng đợi ghi
+    lead_writer.flush()
+
+    def _q(cur):
+        cur.execute(SQL_LEAD_DONE, (lead_id,))
+        return cur.rowcount
+
+    if db_run(_q, name="lead_done"):
+        bot.send_message(chat_id, f"✅ Lead #{lead_id} đã xử lý.")
+    else:
+        bot.send_message(chat_id, f"Không có lead #{lead_id} (hoặc đã xử lý rồi).")
 
 
 # ============ FLOW CŨ (GIỮ NGUYÊN, FIX NHỎ) ============
 
 def ask_account_status(chat_id):
-    text = (
-        "👋 Chào anh/chị!\n"
-        "Em là Bot hỗ trợ nhận CODE ưu đãi U888.\n\n"
-        "👉 Anh/chị đã có tài khoản chơi U888 chưa ạ?\n\n"
-        "Chỉ cần bấm nút bên dưới: ĐÃ CÓ hoặc CHƯA CÓ, em hỗ trợ ngay!"
-    )
-
-    markup = types.InlineKeyboardMarkup()
-    btn_have = types.InlineKeyboardButton("✅ ĐÃ CÓ TÀI KHOẢN", callback_data="have_account")
-    btn_no = types.InlineKeyboardButton("🆕 CHƯA CÓ – ĐĂNG KÝ NGAY", callback_data="no_account")
-    markup.row(btn_have)
-    markup.row(btn_no)
+    # FIX: nếu file_id ảnh sai -> fallback gửi text (templates.send dùng safe_send_photo)
+    templates.send(chat_id, "welcome")
 
-    # FIX: nếu file_id ảnh sai -> fallback gửi text
-    safe_send_photo(
-        chat_id,
-        "AgACAgUAAxkBAANRaaL4LVK8dSDX1UahnrRSsOTMMzEAAlMRaxuw1hhVx2resvJZOuQBAAMCAAN5AAM6BA",
-        caption=text,
-        reply_markup=markup
-    )
+    set_user_flow(chat_id, None)
 
-    user_state[chat_id] = None
 
-
-@bot.message_handler(commands=['start'])
+@dispatcher.command("start")
 def handle_start(message):
     chat_id = message.chat.id
     upsert_user(chat_id)
-    print(">>> /start from:", chat_id)
+    log("debug", "user.start")
     ask_account_status(chat_id)
 
 
-@bot.callback_query_handler(func=lambda call: call.data in ["no_account", "have_account", "registered_done"])
+@dispatcher.callback("no_account", "have_account", "registered_done")
 def callback_handler(call):
     chat_id = call.message.chat.id
     data = call.data
     upsert_user(chat_id)
 
     if data == "no_account":
-        text = (
-            "Tuyệt vời, em gửi anh/chị link đăng ký nè 👇\n\n"
-            f"🔗 Link đăng ký: {REG_LINK}\n\n"
-            "Anh/chị đăng ký xong bấm nút bên dưới để em hỗ trợ tiếp nhé."
-        )
-
-        markup = types.InlineKeyboardMarkup()
-        btn_done = types.InlineKeyboardButton("✅ MÌNH ĐĂNG KÝ XONG RỒI", callback_data="registered_done")
-        markup.row(btn_done)
-
         try:
             bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
         except Exception as e:
-            print("Lỗi edit_message_reply_markup:", repr(e))
+            log("warning", "ui.edit_markup_error", err=repr(e))
 
-        safe_send_photo(
-            chat_id,
-            "AgACAgUAAxkBAAMtaaLyZrV1tDiNTPxSWOvKBQbciicAAk8Raxuw1hhVlMruFA81BtEBAAMCAAN5AAM6BA",
-            caption=text,
-            reply_markup=markup
-        )
+        templates.send(chat_id, "register")
 
     elif data in ("have_account", "registered_done"):
         ask_for_username(chat_id)
 
 
 def ask_for_username(chat_id):
-    text = (
-        "Dạ ok anh/chị ❤️\n\n"
-        "Anh/chị vui lòng gửi đúng *tên tài khoản* để em kiểm tra.\n\n"
-        "Ví dụ:\n"
-        "`abc123`"
-    )
+    templates.send(chat_id, "ask_username")
 
-    safe_send_photo(
-        chat_id,
-        "AgACAgUAAxkBAANLaaL4HZUlbi3ACLs9QunVSI-HQAADUBFrG7DWGFXn-RTioxpqWgEAAwIAA3kAAzoE",
-        caption=text,
-        parse_mode="Markdown"
-    )
-
-    user_state[chat_id] = "WAITING_USERNAME"
+    set_user_flow(chat_id, UserFlow("WAITING_USERNAME"))
 
 
-# ⚠️ FIX: handler này KHÔNG bắt tin nhắn admin khi admin đang ở mode broadcast
-@bot.message_handler(
-    func=lambda m: (not is_admin(m.chat.id) or admin_state.get(m.chat.id, {}).get("mode") != "BROADCAST_WAIT_MEDIA"),
-    content_types=['text']
-)
+# admin đang ở mode broadcast thì text đã được route sang admin_receive_broadcast_text (state route)
+@dispatcher.content("text")
 def handle_text(message):
     chat_id = message.chat.id
     upsert_user(chat_id)
 
     text = message.text.strip()
-    state = user_state.get(chat_id)
+    state = get_user_flow(chat_id)
 
-    print(">>> text:", text, "from", chat_id)
+    log("debug", "user.text", text=text)
 
     # --- WAITING_GAME ---
-    if isinstance(state, dict) and state.get("state") == "WAITING_GAME":
+    if state is not None and state.state == "WAITING_GAME":
         game_type = text
+        tg_username = f"@{message.from_user.username}" if message.from_user.username else "Không có"
+        lead_id = state.lead_id or new_lead_id()
+        lead_writer.add(lead_event(
+            lead_id, chat_id, "pending",
+            tg_username=tg_username,
+            username_game=state.username_game,
+            receipt_file_id=state.receipt_file_id,
+            tail=game_type,
+        ))
+        event = {
+            "kind": "receipt",
+            "lead_id": lead_id,
+            "tg_username": tg_username,
+            "username_game": state.username_game,
+            "chat_id": chat_id,
+            "tail": game_type,
+            "receipt_file_id": state.receipt_file_id,
+            "receipt_kind": state.receipt_kind or "photo",
+            "dup_of": state.receipt_dup_of,
+            "time": datetime.now().strftime("%H:%M:%S %d/%m/%Y"),
+        }
+        if LEAD_DIGEST:
+            lead_digest.add(event)
+            templates.send(chat_id, "lead_received")
+            set_user_flow(chat_id, None)
+            return
         try:
-            tg_username = f"@{message.from_user.username}" if message.from_user.username else "Không có"
-            time_str = datetime.now().strftime("%H:%M:%S %d/%m/%Y")
-
-            bot.send_photo(
-                ADMIN_CHAT_ID,
-                state["receipt_file_id"],
-                caption=(
-                    "📩 KHÁCH GỬI CHUYỂN KHOẢN + NHẮN 4 SỐ ĐUÔI\n\n"
-                    f"👤 Telegram: {tg_username}\n"
-                    f"🧾 Tên tài khoản: {state.get('username_game', '(không rõ)')}\n"
-                    f"🆔 Chat ID: {chat_id}\n"
-                    f"🔢 4 số đuôi: {game_type}\n"
-                    f"⏰ Thời gian: {time_str}"
-                )
-            )
-
-            bot.send_message(chat_id, "✅ Em đã nhận đủ thông tin, em xử lý và cộng điểm cho mình ngay nhé ạ ❤️")
+            send_lead_receipt(current_bot().admin_chat_id, event)
+            templates.send(chat_id, "lead_received")
         except Exception as e:
-            print("Lỗi gửi admin:", repr(e))
-            bot.send_message(chat_id, "⚠️ Em gửi thông tin bị lỗi, mình đợi em 1 chút hoặc nhắn CSKH giúp em nhé ạ.")
+            log("error", "admin.notify_error", err=repr(e))
+            templates.send(chat_id, "lead_error")
 
-        user_state[chat_id] = None
+        set_user_flow(chat_id, None)
         return
 
     # --- WAITING_USERNAME ---
-    if state == "WAITING_USERNAME":
+    if state is not None and state.state == "WAITING_USERNAME":
         username_game = text
-        user_state[chat_id] = {"state": "WAITING_RECEIPT", "username_game": username_game}
+        lead_id = new_lead_id()
+        set_user_flow(chat_id, UserFlow("WAITING_RECEIPT", username_game, lead_id=lead_id))
 
         tg_username = f"@{message.from_user.username}" if message.from_user.username else "Không có"
         time_str = datetime.now().strftime("%H:%M:%S %d/%m/%Y")
+        lead_writer.add(lead_event(lead_id, chat_id, "username", tg_username=tg_username, username_game=username_game))
 
         admin_text = (
             "🔔 Có khách mới gửi tên tài khoản\n\n"
             f"👤 Telegram: {tg_username}\n"
             f"🧾 Tên tài khoản: {username_game}\n"
             f"⏰ Thời gian: {time_str}\n"
-            f"🆔 Chat ID: {chat_id}"
-        )
-        try:
-            bot.send_message(ADMIN_CHAT_ID, admin_text)
-            bot.forward_message(ADMIN_CHAT_ID, chat_id, message.message_id)
-        except Exception as e:
-            print("Lỗi gửi tin cho admin:", repr(e))
-
-        reply_text = (
-            f"Em đã nhận được tên tài khoản: *{username_game}* ✅\n\n"
-            "Mình vào U888 lên vốn theo mốc để nhận khuyến mãi giúp em nhé.\n\n"
-            "Lên thành công mình gửi *ảnh chuyển khoản* để em cộng điểm trực tiếp vào tài khoản cho mình ạ.\n\n"
-            "Có bất cứ thắc mắc gì nhắn tin trực tiếp cho CSKH U888:\n"
-            "👉 [Trúc Linh CSKH U888](https://t.me/truclinh_u888)\n"
-        )
-
-        safe_send_photo(
-            chat_id,
-            "AgACAgUAAxkBAANNaaL4Iq88aw9msu4h--gX0zzgLiIAAlERaxuw1hhVB78TvJHpCpkBAAMCAAN5AAM6BA",
-            caption=reply_text,
-            parse_mode="Markdown"
+            f"🆔 Chat ID: {chat_id}\n"
+            f"🏷️ Mã lead: #{lead_id}"
         )
+        if LEAD_DIGEST:
+            lead_digest.add({
+                "kind": "username",
+                "lead_id": lead_id,
+                "tg_username": tg_username,
+                "username_game": username_game,
+                "chat_id": chat_id,
+                "time": time_str,
+            })
+        else:
+            try:
+                admin_chat_id = current_bot().admin_chat_id
+                bot.send_message(admin_chat_id, admin_text)
+                bot.forward_message(admin_chat_id, chat_id, message.message_id)
+            except Exception as e:
+                log("error", "admin.notify_error", err=repr(e))
+
+        templates.send(chat_id, "username_received", username_game=username_game)
         return
 
 
-@bot.message_handler(content_types=['photo', 'document', 'video'])
+@dispatcher.content("photo", "document", "video")
 def handle_media(message):
     chat_id = message.chat.id
     upsert_user(chat_id)
 
     # --- GET FILE_ID MODE ---
-    if chat_id in debug_get_id_mode:
+    if getid_enabled(chat_id):
         if message.content_type == 'photo':
             file_id = message.photo[-1].file_id
             media_type = "ẢNH"
@@ -579,48 +3954,468 @@ def handle_media(message):
         return
 
     # --- Flow nhận ảnh chuyển khoản ---
-    state = user_state.get(chat_id)
-    if not (isinstance(state, dict) and state.get("state") == "WAITING_RECEIPT"):
+    state = get_user_flow(chat_id)
+    if state is None or state.state != "WAITING_RECEIPT":
         return
 
     if message.content_type == "photo":
-        receipt_file_id = message.photo[-1].file_id
+        receipt = message.photo[-1]
     elif message.content_type == "document":
-        receipt_file_id = message.document.file_id
+        receipt = message.document
     else:
-        bot.send_message(chat_id, "Mình gửi *ảnh chuyển khoản* giúp em nhé ạ.", parse_mode="Markdown")
+        templates.send(chat_id, "ask_receipt")
         return
 
-    username_game = state.get("username_game")
+    lead_id = state.lead_id or new_lead_id()
+    dup_of = receipt_index.check_and_add(receipt.file_unique_id, lead_id)
+    if dup_of:
+        log("warning", "leads.receipt_duplicate", lead_id=lead_id, dup_of=dup_of)
+    lead_writer.add(lead_event(
+        lead_id, chat_id, "receipt",
+        username_game=state.username_game,
+        receipt_file_id=receipt.file_id,
+        receipt_unique_id=receipt.file_unique_id,
+        receipt_dup_of=dup_of,
+    ))
+    set_user_flow(chat_id, UserFlow("WAITING_GAME", state.username_game, receipt.file_id, lead_id, dup_of,
+                                    message.content_type))
 
-    user_state[chat_id] = {
-        "state": "WAITING_GAME",
-        "receipt_file_id": receipt_file_id,
-        "username_game": username_game
-    }
+    templates.send(chat_id, "ask_tail")
+
+
+# ============ UPDATE WORKERS (THỨ TỰ THEO CHAT) ============
+
+def peek_update(data: dict):
+    """
+    Đọc nhanh từ dict JSON thô những gì webhook cần (chưa dựng object telebot):
+    -> (update_id, chat_id, chữ ký gộp spam, lý do bỏ | None).
+    Lý do bỏ: "type" (loại update không nhận) | "content" (message không handler nào nhận) | "callback".
+    chat_id = 0 nếu không có chat. Chữ ký: lệnh (/start...) hoặc "cb:" + callback_data; text thường / ảnh không gộp.
+    """
+    update_id = data.get("update_id")
+    msg = data.get("message")
+    if msg is not None:
+        chat_id = (msg.get("chat") or {}).get("id") or 0
+        if not dispatcher.routes_message(msg):
+            return update_id, chat_id, None, "content"
+        text = msg.get("text")
+        return update_id, chat_id, text if text and text.startswith("/") else None, None
+    cq = data.get("callback_query")
+    if cq is not None:
+        chat_id = ((cq.get("message") or {}).get("chat") or {}).get("id") or 0
+        cb_data = cq.get("data") or ""
+        if not dispatcher.routes_callback(cb_data):
+            return update_id, chat_id, None, "callback"
+        return update_id, chat_id, "cb:" + cb_data, None
+    return update_id, 0, None, "type"
+
+
+class ChatOrderedWorkers:
+    """
+    N worker, mỗi worker 1 queue có giới hạn. Update của cùng chat_id luôn vào cùng worker
+    -> giữ đúng thứ tự trong 1 chat, các chat khác nhau chạy song song.
+    """
+
+    _STOP = object()
+
+    def __init__(self, handler, workers: int, queue_size: int):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+        self.queues = []
+        self.threads = []
+        self.pid = None
+        self.lock = threading.Lock()
+        self.stopping = False
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queues = [queue.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+            self.threads = [
+                threading.Thread(target=self._loop, args=(q,), name=f"update-worker-{i}", daemon=True)
+                for i, q in enumerate(self.queues)
+            ]
+            for t in self.threads:
+                t.start()
+            self.pid = os.getpid()
+
+    def _loop(self, q: queue.Queue):
+        while True:
+            item = q.get()
+            try:
+                if item is self._STOP:
+                    return
+                self.handler(item)
+            except Exception as e:
+                log("error", "update.error", err=repr(e))
+            finally:
+                q.task_done()
+
+    def submit(self, update, chat_id: int, timeout: float) -> bool:
+        """
+        Đưa update vào queue của chat. Queue đầy quá timeout -> False (caller trả 503 để Telegram gửi lại sau).
+        """
+        if self.stopping:
+            return False
+        self._ensure_started()
+        try:
+            self.queues[chat_id % self.workers].put(update, timeout=timeout)
+            return True
+        except queue.Full:
+            return False
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def shutdown(self, timeout: float):
+        """
+        Ngừng nhận update mới, chờ worker xử lý nốt những gì đã xếp hàng (tối đa timeout giây).
+        """
+        if self.pid != os.getpid():
+            return
+        self.stopping = True
+        deadline = time.monotonic() + timeout
+        for q in self.queues:
+            try:
+                q.put(self._STOP, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+        for t in self.threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        left = self.depth()
+        if left:
+            log("warning", "update.shutdown_pending", "tắt khi còn update chưa xử lý", left=left)
+
+
+class UpdateDeduper:
+    """
+    Cửa sổ trượt DEDUP_WINDOW update_id gần nhất: deque (thứ tự để bỏ id cũ) + set (tra O(1)).
+    Bộ nhớ cố định, không phụ thuộc thời gian chạy.
+    """
+
+    def __init__(self, window: int):
+        self.window = max(1, window)
+        self.order = deque()
+        self.ids = set()
+        self.lock = threading.Lock()
+
+    def check_and_add(self, update_id: int) -> bool:
+        """
+        True nếu update_id mới (và ghi nhớ luôn), False nếu đã thấy.
+        """
+        with self.lock:
+            if update_id in self.ids:
+                return False
+            self.ids.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.window:
+                self.ids.discard(self.order.popleft())
+            return True
+
+    def discard(self, update_id: int):
+        # dùng khi không nhận được update (queue đầy) -> Telegram gửi lại thì phải xử lý
+        with self.lock:
+            self.ids.discard(update_id)
+
+
+update_deduper = BotScoped("update_deduper")
+DEDUP_DROPPED = metrics.counter("bot_duplicate_updates_total", "Update trùng bị bỏ qua", ["where"])
+
+
+def claim_update_db(update_id: int) -> bool:
+    """
+    Ghi update_id vào processed_updates; False nếu worker/instance khác (hoặc lần chạy trước) đã nhận.
+    Lỗi DB -> vẫn xử lý (thà trùng còn hơn mất update).
+    """
+    def _q(cur):
+        cur.execute(
+            "INSERT INTO processed_updates(update_id) VALUES (%s) ON CONFLICT DO NOTHING",
+            (update_id,),
+            prepare=DB_PREPARE,
+        )
+        return cur.rowcount == 1
+
+    try:
+        return db_run(_q, name="claim_update")
+    except Exception as e:
+        log("error", "dedup.db_error", err=repr(e))
+        return True
+
+
+def _dedup_sweep_loop():
+    while True:
+        time.sleep(3600)
+        for rt in bots.values():
+            try:
+                with use_bot(rt):
+                    db_run(lambda cur: cur.execute(
+                        "DELETE FROM processed_updates WHERE seen_at < NOW() - make_interval(hours => %s)",
+                        (DEDUP_RETENTION_HOURS,),
+                    ), name="dedup_sweep")
+            except Exception as e:
+                log("error", "dedup.sweep_error", bot=rt.id, err=repr(e))
+
+
+USE_DB_DEDUP = DEDUP_BACKEND == "postgres" and bool(DATABASE_URL)
+
+
+def process_update(item):
+    """
+    Worker nhận (BotRuntime, dict JSON thô), dựng object telebot ở đây (ngoài request webhook) rồi dispatch
+    trong ngữ cảnh của bot đó.
+    """
+    rt, data = item
+    with use_bot(rt):
+        if USE_DB_DEDUP and not claim_update_db(data["update_id"]):
+            DEDUP_DROPPED.inc("db")
+            return
+        with UPDATE_LATENCY.time(), log_context(bot=rt.id, update_id=data["update_id"], chat_id=peek_update(data)[1]):
+            update = types.Update.de_json(data)
+            update_profiler.run(dispatcher.dispatch, update)
+
+
+def _flush_lead_digests():
+    for rt in bots.values():
+        with use_bot(rt):
+            rt.lead_digest.flush()
+
+
+# atexit chạy ngược thứ tự đăng ký: worker xử lý hết update (có thể thêm lead vào digest) rồi mới flush digest
+if LEAD_DIGEST:
+    atexit.register(_flush_lead_digests)
+
+update_workers = ChatOrderedWorkers(process_update, UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+atexit.register(lambda: update_workers.shutdown(UPDATE_DRAIN_TIMEOUT))
+
+
+# ============ CHỐNG SPAM THEO CHAT (TRƯỚC KHI XỬ LÝ) ============
+
+class ChatFloodGuard:
+    """
+    Giới hạn update theo chat ở webhook, trước mọi việc tốn DB / Telegram API:
+    - GCRA (token bucket gói trong 1 số): mỗi chat chỉ lưu tat ("thời điểm lý thuyết" của update kế tiếp),
+      cho qua nếu tat - now <= (burst - 1) * interval
+    - gộp: cùng lệnh / cùng callback_data lặp lại trong collapse_window giây -> bỏ (bấm nút liên tục)
+    Entry = [tat, hash chữ ký lần trước, lúc nhận chữ ký đó, số update đã bỏ].
+    Chat đã hồi đủ lượt (tat <= now) không cần nhớ -> dọn mỗi sweep_interval giây, bộ nhớ ~ số chat đang hoạt động.
+    """
+
+    def __init__(self, rate: float, burst: int, collapse_window: float, sweep_interval: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.burst = max(1, burst)
+        self.collapse_window = collapse_window
+        self.sweep_interval = sweep_interval
+        self.chats = {}
+        self.lock = threading.Lock()
+        self.next_sweep = time.monotonic() + sweep_interval
+
+    def check(self, chat_id: int, signature: str = None):
+        """
+        None nếu cho qua, ngược lại lý do bỏ: "collapsed" | "rate".
+        """
+        if not self.interval or not chat_id:
+            return None
+        now = time.monotonic()
+        sig = hash(signature) if signature else 0
+        with self.lock:
+            if now >= self.next_sweep:
+                self._sweep(now)
+            entry = self.chats.get(chat_id)
+            if entry is None:
+                entry = self.chats[chat_id] = [now, 0, 0.0, 0]
+            if sig and sig == entry[1] and now - entry[2] < self.collapse_window:
+                entry[3] += 1
+                return "collapsed"
+            tat = max(entry[0], now)
+            if tat - now > (self.burst - 1) * self.interval:
+                entry[3] += 1
+                return "rate"
+            entry[0] = tat + self.interval
+            if sig:
+                entry[1] = sig
+                entry[2] = now
+            return None
+
+    def _sweep(self, now: float):
+        stale = [cid for cid, e in self.chats.items() if e[0] <= now and now - e[2] >= self.collapse_window]
+        for cid in stale:
+            del self.chats[cid]
+        self.next_sweep = now + self.sweep_interval
+
+    def size(self) -> int:
+        return len(self.chats)
+
+    def top_offenders(self, n: int = 5):
+        with self.lock:
+            rows = [(cid, e[3]) for cid, e in self.chats.items() if e[3]]
+        return sorted(rows, key=lambda r: r[1], reverse=True)[:n]
+
+
+flood_guard = BotScoped("flood_guard")
+FLOOD_DROPPED = metrics.counter("bot_flood_dropped_total", "Update bị bỏ do chat spam", ["reason"])
 
-    bot.send_message(
-        chat_id,
-        "🔔Dạ mình vui lòng cho em xin *4 số đuôi* của tài khoản ngân hàng 🧾 với ạ!",
-        parse_mode="Markdown"
-    )
+
+@dispatcher.command("flood_stats")
+def flood_stats_cmd(message):
+    chat_id = message.chat.id
+    if not is_admin(chat_id):
+        return bot.send_message(chat_id, "❌ Bạn không có quyền admin.")
+    dropped = {labels[0]: int(v) for labels, v in dict(FLOOD_DROPPED.values).items()}
+    lines = [
+        f"🚧 Chống spam: {FLOOD_RATE:g} update/s, burst {FLOOD_BURST}, gộp lặp {FLOOD_COLLAPSE_WINDOW:g}s",
+        f"Đã bỏ: quá nhanh {dropped.get('rate', 0)}, lặp lại {dropped.get('collapsed', 0)}",
+        f"Chat đang theo dõi: {flood_guard.size()}",
+    ]
+    lines += [f"• {cid}: bỏ {n}" for cid, n in flood_guard.top_offenders()]
+    bot.send_message(chat_id, "\n".join(lines))
+
+
+# ============ NHIỀU BOT TRONG 1 PROCESS ============
+
+class BotRuntime:
+    """
+    Phần riêng của 1 bot: token, brand (link, CSKH), admin, ảnh, template, state hội thoại,
+    chống trùng update, đếm user, check bill trùng, gom lead cho admin; DB = schema riêng.
+    Dùng chung giữa các bot: pool DB, HTTP session + hàng đợi outbound, worker update, dispatcher,
+    executor + thread broadcast, ghi lead.
+    """
+
+    def __init__(self, cfg: dict):
+        self.id = cfg["id"]
+        self.schema = cfg["schema"]
+        self.admin_chat_id = cfg["admin_chat_id"]
+        self.webhook_url = cfg["webhook_url"]
+        self.brand = BRANDS[cfg["brand"]]
+        self.bot = telebot.TeleBot(cfg["token"], threaded=False)
+        self.templates = build_templates(self.brand)
+        # file_id gắn với bot đã upload: bot khác token dùng file_id hỏng -> MediaRegistry tự upload lại từ media_dir
+        self.media = MediaRegistry({**BRAND_MEDIA[cfg["brand"]], **cfg.get("media", {})},
+                                   cfg.get("media_dir", MEDIA_DIR))
+        self.state_store = make_state_store()
+        self.update_deduper = UpdateDeduper(DEDUP_WINDOW)
+        # 1 user bấm /start ở 2 bot cùng lúc không phải spam -> chống spam tính riêng từng bot
+        self.flood_guard = ChatFloodGuard(FLOOD_RATE, FLOOD_BURST, FLOOD_COLLAPSE_WINDOW, FLOOD_SWEEP_INTERVAL)
+        self.user_counter = UserCounter(USER_COUNT_TTL)
+        self.receipt_index = ReceiptIndex(RECEIPT_CACHE_SIZE)
+        self.lead_digest = LeadDigest(self.admin_chat_id, LEAD_DIGEST_INTERVAL, LEAD_DIGEST_MAX)
+
+
+bots.update((cfg["id"], BotRuntime(cfg)) for cfg in BOT_CONFIGS)
+
+
+# ============ KHỞI ĐỘNG (SAU KHI ĐỦ BOT) ============
+
+if not DATABASE_URL:
+    log("error", "db.not_configured", "DATABASE_URL chưa có. Vào Render > Service > Environment thêm DATABASE_URL.")
+else:
+    try:
+        _t0 = time.perf_counter()
+        applied = init_db()
+        log("info", "db.schema_ready", "đã cập nhật" if applied else "sẵn sàng", version=SCHEMA_VERSION,
+            bots=len(bots), latency_ms=round((time.perf_counter() - _t0) * 1000))
+    except Exception as e:
+        log("error", "db.init_error", err=repr(e))
+    threading.Thread(target=_db_health_loop, daemon=True).start()
+    # job đang chạy dở trước khi restart -> gửi tiếp
+    broadcast_queue.start()
+    if USE_DB_DEDUP:
+        threading.Thread(target=_dedup_sweep_loop, daemon=True).start()
+
+threading.Thread(target=_state_sweep_loop, daemon=True).start()
+# kiểm tra ảnh chạy nền -> không làm chậm khởi động
+threading.Thread(target=_media_check_loop, daemon=True).start()
+threading.Thread(target=setup_webhook, name="setup-webhook", daemon=True).start()
 
 
 # ============ WEBHOOK FLASK ============
 
 @server.route("/webhook", methods=['POST'])
-def telegram_webhook():
+@server.route("/webhook/<bot_id>", methods=['POST'])
+def telegram_webhook(bot_id: str = None):
+    # /webhook (không id) = bot đầu tiên, giữ tương thích với WEBHOOK_URL của bản 1 bot
+    rt = bots.get(bot_id) if bot_id is not None else next(iter(bots.values()))
+    if rt is None:
+        return "Not found", 404
+    with WEBHOOK_LATENCY.time(), use_bot(rt):
+        return _handle_webhook(rt)
+
+
+WEBHOOK_FILTERED = metrics.counter("bot_webhook_filtered_total", "Update bỏ ngay ở webhook (không handler nhận)",
+                                   ["reason"])
+
+
+def _handle_webhook(rt):
+    # chỉ json.loads + đọc vài field; object telebot (de_json) dựng ở worker, update bị bỏ thì khỏi dựng
     try:
-        json_str = request.get_data().decode("utf-8")
-        update = telebot.types.Update.de_json(json_str)
-        bot.process_new_updates([update])
+        data = json.loads(request.get_data())
+        update_id, chat_id, signature, drop = peek_update(data)
+        if update_id is None:
+            raise ValueError("update không có update_id")
     except Exception as e:
-        # không trả 500 để tránh Telegram retry bão
-        print("[WEBHOOK ERROR]", repr(e))
+        # không trả 500 để tránh Telegram retry bão (payload lỗi gửi lại cũng vô ích)
+        log("warning", "webhook.bad_payload", err=repr(e))
         return "OK", 200
+
+    if drop:
+        WEBHOOK_FILTERED.inc(drop)
+        return "OK", 200
+
+    # Telegram gửi lại update đã nhận (timeout trước đó) -> bỏ qua, trả 200 để nó thôi gửi
+    if not update_deduper.check_and_add(update_id):
+        DEDUP_DROPPED.inc("memory")
+        return "OK", 200
+
+    # chat spam -> bỏ luôn, không tốn DB / API (admin không bị giới hạn)
+    if not is_admin(chat_id):
+        reason = flood_guard.check(chat_id, signature)
+        if reason:
+            FLOOD_DROPPED.inc(reason)
+            return "OK", 200
+
+    # xử lý ở worker nền, request trả về ngay
+    if not update_workers.submit((rt, data), chat_id, UPDATE_ENQUEUE_TIMEOUT):
+        # backpressure: queue đầy -> Telegram sẽ tự gửi lại update này sau
+        update_deduper.discard(update_id)
+        return "Busy", 503
     return "OK", 200
 
 
+metrics.gauge("bot_update_queue_depth", "Số update đang chờ worker", lambda: update_workers.depth())
+metrics.gauge("bot_state_entries", "Số entry state trong RAM (memory) / cache (postgres)",
+              lambda: sum(rt.state_store.size() for rt in bots.values()))
+metrics.gauge("bot_broadcast_jobs_running", "Job broadcast đang chạy",
+              lambda: sum(1 for j in list(broadcast_jobs.values()) if j.status == "running"))
+metrics.gauge("bot_flood_tracked_chats", "Chat đang được theo dõi chống spam",
+              lambda: sum(rt.flood_guard.size() for rt in bots.values()))
+metrics.gauge("bot_lead_write_queue", "Sự kiện lead chờ ghi DB", lambda: lead_writer.depth())
+metrics.gauge("bot_user_touch_pending", "User chờ ghi last_seen (write-behind)", lambda: user_touches.depth())
+metrics.gauge("bot_media_bad_ids", "file_id đang nằm trong negative cache",
+              lambda: sum(len(rt.media.bad) for rt in bots.values()))
+metrics.gauge("bot_http_requests", "Request HTTP ra ngoài", lambda: http_stats.snapshot()["requests"])
+metrics.gauge("bot_http_new_connections", "Connection HTTP mới (bắt tay TCP/TLS)",
+              lambda: http_stats.snapshot()["new_connections"])
+for _prio, _name in enumerate(PRIO_NAMES):
+    metrics.gauge(f"bot_outbound_queue_{_name}", f"Request Telegram mức {_name} đang chờ gửi",
+                  lambda p=_prio: outbound.depth(p))
+metrics.gauge("bot_outbound_breaker_open", "Circuit breaker Telegram đang mở (1) / đóng (0)",
+              lambda: int(time.monotonic() < outbound.open_until))
+metrics.gauge("bot_log_queue", "Dòng log chờ ghi", lambda: logger.q.qsize())
+metrics.gauge("bot_log_dropped", "Dòng log bị bỏ do hàng đợi đầy", lambda: logger.dropped)
+
+
+@server.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        auth = request.headers.get("Authorization", "")
+        if request.args.get("token") != METRICS_TOKEN and auth != f"Bearer {METRICS_TOKEN}":
+            return "Forbidden", 403
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
 @server.route("/", methods=['GET'])
 def home():
     return "Bot is running!", 200
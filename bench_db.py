@@ -0,0 +1,70 @@
+# bench_db.py
+# Đo độ trễ DB cho mỗi update (upsert_user) : connect mới mỗi lần (cách cũ) vs pool + prepared statement.
+# "after" gọi thẳng SQL_UPSERT_USER qua db_run: app.upsert_user bỏ qua DB với user đã biết (write-behind
+# last_seen), đo nó là đo RAM - dòng "buffered" để so thêm.
+#
+# Chạy với Postgres local:
+#   docker run --rm -p 5432:5432 -e POSTGRES_PASSWORD=pg postgres:16
+#   DATABASE_URL=postgresql://postgres:pg@localhost:5432/postgres python bench_db.py 500
+#
+# Script tự set BOT_TOKEN giả nếu chưa có, và KHÔNG set webhook (bỏ WEBHOOK_URL).
+
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.pop("WEBHOOK_URL", None)
+
+import psycopg  # noqa: E402
+
+import app  # noqa: E402
+
+
+def legacy_upsert(chat_id: int):
+    # đúng như db_conn() cũ: mỗi update 1 connection mới
+    with psycopg.connect(app.DATABASE_URL, connect_timeout=10, autocommit=True) as conn:
+        with conn.cursor() as cur:
+            cur.execute(app.SQL_UPSERT_USER, (chat_id,))
+
+
+def pooled_upsert(chat_id: int):
+    # 1 round-trip thật mỗi lần: pool + prepared statement, không qua buffer last_seen
+    app.db_run(lambda cur: cur.execute(app.SQL_UPSERT_USER, (chat_id,), prepare=app.DB_PREPARE), name="upsert_user")
+
+
+def measure(fn, n: int):
+    samples = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        fn(900_000_000 + (i % 50))
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def report(name: str, samples):
+    samples = sorted(samples)
+    p = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]  # noqa: E731
+    print(
+        f"{name:<10} n={len(samples):<5} mean={statistics.mean(samples):7.2f}ms "
+        f"p50={p(0.50):7.2f}ms p95={p(0.95):7.2f}ms p99={p(0.99):7.2f}ms"
+    )
+
+
+def main():
+    if not app.DATABASE_URL:
+        sys.exit("Cần DATABASE_URL trỏ tới Postgres local.")
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    app.init_db()
+    # warm-up: mở pool + prepare statement
+    measure(pooled_upsert, 10)
+
+    report("before", measure(legacy_upsert, n))
+    report("after", measure(pooled_upsert, n))
+    report("buffered", measure(app.upsert_user, n))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+# loadtest.py
+# Chạy thử tải webhook offline: Flask server của app.py + Telegram Bot API giả (ghi lại call, bơm 429/độ trễ)
+# + Postgres local (nếu có DATABASE_URL, không có thì chạy không DB).
+#
+# Ví dụ:
+#   python loadtest.py start --chats 2000 --rate 200
+#   python loadtest.py flow --chats 300 --rate 100 --api-latency-ms 80 --api-429-rate 0.02
+#   python loadtest.py broadcast --chats 5000
+#   python loadtest.py replay --file updates.jsonl --rate 50
+#   DATABASE_URL=postgresql://postgres:pg@localhost:5432/postgres python loadtest.py flow
+#
+# Kết quả: p50/p95/p99 latency của POST /webhook, updates/s, thời gian xử lý ở worker, số call DB và Telegram API.
+# Lưu ý: harness, API giả và app chạy chung 1 process (chung GIL) -> số tuyệt đối gồm cả overhead của harness,
+# dùng để so sánh trước/sau mỗi thay đổi với cùng tham số.
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+ADMIN_ID = 1000
+
+os.environ.setdefault("BOT_TOKEN", "0:loadtest")
+os.environ.setdefault("ADMIN_CHAT_ID", str(ADMIN_ID))
+os.environ.pop("WEBHOOK_URL", None)
+os.environ.pop("ENABLE_KEEP_ALIVE", None)
+
+
+# ============ TELEGRAM BOT API GIẢ ============
+
+class FakeTelegram:
+    """
+    Stub HTTP của Bot API: trả kết quả hợp lệ tối thiểu cho mọi method, đếm call theo method,
+    có thể chậm (latency_ms) và trả 429 ngẫu nhiên (rate_429) cho các method send*.
+    """
+
+    def __init__(self, latency_ms: float = 0, rate_429: float = 0, retry_after: int = 1):
+        self.latency = latency_ms / 1000
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.calls = {}
+        self.throttled = 0
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        self.httpd = None
+
+    def result_for(self, method: str, params: dict):
+        chat_id = int(params.get("chat_id", 0) or 0)
+        if method == "sendMediaGroup":
+            media = json.loads(params.get("media") or "[]")
+            return [self.result_for("sendPhoto", params) for _ in media]
+        if method.startswith("send") or method in ("forwardMessage", "copyMessage"):
+            msg = {"message_id": next(self.message_ids), "date": int(time.time()),
+                   "chat": {"id": chat_id, "type": "private"}}
+            if method == "sendPhoto":
+                msg["photo"] = [{"file_id": "FAKE_PHOTO", "file_unique_id": "FAKE", "width": 1, "height": 1}]
+            return msg
+        if method == "getFile":
+            return {"file_id": params.get("file_id"), "file_unique_id": "FAKE", "file_size": 1}
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "fake", "username": "fake_bot"}
+        return True
+
+    def handle(self, method: str, params: dict):
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            throttle = method.startswith("send") and random.random() < self.rate_429
+            if throttle:
+                self.throttled += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttle:
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry later",
+                         "parameters": {"retry_after": self.retry_after}}
+        return 200, {"ok": True, "result": self.result_for(method, params)}
+
+    def start(self) -> str:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _serve(self):
+                url = urlparse(self.path)
+                method = url.path.rsplit("/", 1)[-1]
+                params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                ctype = self.headers.get("Content-Type", "")
+                if body and ctype.startswith("application/x-www-form-urlencoded"):
+                    params.update({k: v[-1] for k, v in parse_qs(body.decode()).items()})
+                status, payload = fake.handle(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _serve
+            do_POST = _serve
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self.httpd.server_port}"
+
+
+# ============ UPDATE GIẢ ============
+
+_update_ids = itertools.count(1)
+
+
+def _user(chat_id: int) -> dict:
+    return {"id": chat_id, "is_bot": False, "first_name": f"u{chat_id}", "username": f"user{chat_id}"}
+
+
+def message_update(chat_id: int, text: str = None, photo: bool = False) -> dict:
+    uid = next(_update_ids)
+    msg = {"message_id": uid, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+           "from": _user(chat_id)}
+    if photo:
+        msg["photo"] = [{"file_id": f"RECEIPT_{uid}", "file_unique_id": f"R{uid}", "width": 1, "height": 1}]
+    else:
+        msg["text"] = text
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": uid, "message": msg}
+
+
+def callback_update(chat_id: int, data: str) -> dict:
+    uid = next(_update_ids)
+    return {"update_id": uid, "callback_query": {
+        "id": str(uid), "from": _user(chat_id), "chat_instance": "lt", "data": data,
+        "message": {"message_id": uid, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}},
+    }}
+
+
+def scenario_start(chats: int):
+    for i in range(chats):
+        yield message_update(10_000 + i, "/start")
+
+
+def scenario_flow(chats: int):
+    """
+    Flow đầy đủ: /start -> ĐÃ CÓ TK -> tên tài khoản -> ảnh bill -> 4 số đuôi. Xen kẽ các chat theo từng bước.
+    """
+    steps = [
+        lambda c: message_update(c, "/start"),
+        lambda c: callback_update(c, "have_account"),
+        lambda c: message_update(c, f"acc{c}"),
+        lambda c: message_update(c, photo=True),
+        lambda c: message_update(c, str(1000 + c % 9000)),
+    ]
+    for step in steps:
+        for i in range(chats):
+            yield step(10_000 + i)
+
+
+def scenario_broadcast(chats: int):
+    """
+    /start từ `chats` user (để có người nhận) rồi admin broadcast 1 tin text.
+    """
+    yield from scenario_start(chats)
+    yield message_update(ADMIN_ID, "/admin")
+    yield message_update(ADMIN_ID, "📣 Broadcast")
+    yield message_update(ADMIN_ID, "Khuyến mãi load test")
+    yield callback_update(ADMIN_ID, "BC_CONFIRM")
+
+
+def scenario_replay(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+# ============ CHẠY ============
+
+def update_chat(update: dict) -> int:
+    msg = update.get("message") or (update.get("callback_query") or {}).get("message") or {}
+    return (msg.get("chat") or {}).get("id", 0)
+
+
+def percentile(sorted_values, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def hist_totals(hist) -> dict:
+    with hist.lock:
+        return {labels[0] if labels else "": (v[2], v[1]) for labels, v in hist.series.items()}
+
+
+def counter_total(counter) -> float:
+    with counter.lock:
+        return sum(counter.values.values())
+
+
+def run(args):
+    fake = FakeTelegram(args.api_latency_ms, args.api_429_rate)
+    base = fake.start()
+
+    # trỏ telebot sang API giả TRƯỚC khi import app (app có thread kiểm tra media lúc import)
+    from telebot import apihelper
+    apihelper.API_URL = base + "/bot{0}/{1}"
+    apihelper.FILE_URL = base + "/file/bot{0}/{1}"
+
+    import app
+    from werkzeug.serving import make_server
+
+    if app.DATABASE_URL:
+        app.init_db()
+    if args.scenario == "broadcast" and not app.DATABASE_URL:
+        # không có DB: danh sách người nhận = các chat đã /start trong lần chạy này
+        ids = [10_000 + i for i in range(args.chats)]
+        app.iter_audience = lambda segment=None, page_size=app.BROADCAST_PAGE_SIZE: (
+            ids[i:i + page_size] for i in range(0, len(ids), page_size))
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    httpd = make_server("127.0.0.1", 0, app.server, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_port}/webhook"
+
+    if args.scenario == "start":
+        stream = scenario_start(args.chats)
+    elif args.scenario == "flow":
+        stream = scenario_flow(args.chats)
+    elif args.scenario == "broadcast":
+        stream = scenario_broadcast(args.chats)
+    else:
+        stream = scenario_replay(args.file)
+
+    import requests
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def post(update):
+        t0 = time.perf_counter()
+        try:
+            status = session.post(url, data=json.dumps(update), headers={"Content-Type": "application/json"}).status_code
+        except Exception:
+            status = "error"
+        took = time.perf_counter() - t0
+        with lock:
+            latencies.append(took)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    sent = 0
+    last_of_chat = {}   # giống Telegram: update của 1 chat gửi tuần tự, chat khác nhau gửi song song
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for update in stream:
+            if args.rate > 0:
+                delay = started + sent / args.rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            chat_id = update_chat(update)
+            prev = last_of_chat.get(chat_id)
+            if prev is not None:
+                prev.result()
+            last_of_chat[chat_id] = pool.submit(post, update)
+            sent += 1
+    ingest_took = time.perf_counter() - started
+
+    # chờ worker xử lý hết (và broadcast xong nếu có)
+    deadline = time.time() + args.drain_timeout
+    while time.time() < deadline:
+        processed = app.UPDATE_LATENCY.series.get((), [0, 0, 0])[2]
+        busy = any(j.status in ("queued", "running") for j in list(app.broadcast_jobs.values()))
+        # update trả 200 nhưng bị lọc / trùng / chống spam thì không tới worker -> không tính vào số phải chờ
+        dropped = sum(counter_total(c) for c in (app.WEBHOOK_FILTERED, app.DEDUP_DROPPED, app.FLOOD_DROPPED))
+        if processed >= statuses.get(200, 0) - dropped and not busy:
+            break
+        time.sleep(0.05)
+    total_took = time.perf_counter() - started
+
+    latencies.sort()
+    update_hist = app.UPDATE_LATENCY.series.get((), [0, 0.0, 0])
+    db = hist_totals(app.DB_LATENCY)
+    report = {
+        "scenario": args.scenario,
+        "updates": sent,
+        "http_status": statuses,
+        "webhook_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "mean": statistics.mean(latencies) * 1000 if latencies else 0,
+        },
+        "ingest_updates_per_s": sent / ingest_took if ingest_took else 0,
+        "processed_updates_per_s": update_hist[2] / total_took if total_took else 0,
+        "worker_update_ms_mean": update_hist[1] / update_hist[2] * 1000 if update_hist[2] else 0,
+        "db_calls": {k: v[0] for k, v in db.items()},
+        "api_calls": dict(sorted(fake.calls.items())),
+        "api_429_injected": fake.throttled,
+        "broadcast": [j.summary() for j in app.broadcast_jobs.values()],
+        "http_client": app.http_stats.snapshot(),
+    }
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        w = report["webhook_ms"]
+        print(f"scenario={args.scenario} updates={sent} status={statuses}")
+        print(f"webhook latency: p50={w['p50']:.2f}ms p95={w['p95']:.2f}ms p99={w['p99']:.2f}ms mean={w['mean']:.2f}ms")
+        print(f"ingest: {report['ingest_updates_per_s']:.0f} upd/s | processed: "
+              f"{report['processed_updates_per_s']:.0f} upd/s | worker mean {report['worker_update_ms_mean']:.2f}ms")
+        print(f"DB calls: {report['db_calls']}")
+        print(f"API calls: {report['api_calls']} (429 injected: {fake.throttled})")
+        for line in report["broadcast"]:
+            print("broadcast:", line.replace("\n", " | "))
+    httpd.shutdown()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Load test / replay webhook pipeline của app.py (offline).")
+    p.add_argument("scenario", choices=["start", "flow", "broadcast", "replay"])
+    p.add_argument("--chats", type=int, default=500, help="số chat giả")
+    p.add_argument("--rate", type=float, default=200, help="update/s gửi vào /webhook (0 = nhanh nhất có thể)")
+    p.add_argument("--concurrency", type=int, default=32, help="số request HTTP đồng thời")
+    p.add_argument("--file", help="file .jsonl (mỗi dòng 1 update) cho scenario replay")
+    p.add_argument("--api-latency-ms", type=float, default=30, help="độ trễ mỗi call Telegram giả")
+    p.add_argument("--api-429-rate", type=float, default=0.0, help="tỉ lệ call send* bị trả 429")
+    p.add_argument("--drain-timeout", type=float, default=120, help="chờ xử lý xong tối đa (giây)")
+    p.add_argument("--json", action="store_true", help="in kết quả dạng JSON")
+    args = p.parse_args()
+    if args.scenario == "replay" and not args.file:
+        sys.exit("replay cần --file")
+    run(args)
+
+
+if __name__ == "__main__":
+    main()